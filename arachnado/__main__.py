@@ -60,11 +60,17 @@ def main(port, host, start_manhole, manhole_port, manhole_host, loglevel, opts):
     from arachnado.storages.mongotail import MongoTailStorage
     from arachnado.domain_crawlers import DomainCrawlers
     from arachnado.cron import Cron
+    from arachnado.utils.mongo import client_registry
+    from arachnado.utils.misc import set_json_backend
+    from arachnado.storages.bodies import body_store_from_uri
+    from arachnado.storages.stats_history import StatsHistoryStorage
 
     settings = {
         'LOG_LEVEL': loglevel,
     }
 
+    set_json_backend(opts['arachnado']['json_backend'])
+
     # mongo export options
     storage_opts = opts['arachnado.storage']
     assert storage_opts['enabled'], "Storage can't be turned off"
@@ -72,6 +78,11 @@ def main(port, host, start_manhole, manhole_port, manhole_host, loglevel, opts):
     items_uri = _getval(storage_opts, 'items_uri_env', 'items_uri')
     jobs_uri = _getval(storage_opts, 'jobs_uri_env', 'jobs_uri')
     sites_uri = _getval(storage_opts, 'sites_uri_env', 'sites_uri')
+    events_uri = _getval(storage_opts, 'events_uri_env', 'events_uri') or None
+    bodies_uri = _getval(storage_opts, 'bodies_uri_env', 'bodies_uri')
+    stats_history_uri = _getval(storage_opts, 'stats_history_uri_env',
+                                'stats_history_uri')
+    client_registry.max_pool_size = int(storage_opts['max_pool_size'])
 
     scrapy_opts = opts['arachnado.scrapy']
     settings.update({k: v for k, v in scrapy_opts.items() if k.isupper()})
@@ -80,14 +91,21 @@ def main(port, host, start_manhole, manhole_port, manhole_host, loglevel, opts):
         'MONGO_EXPORT_ENABLED': storage_opts['enabled'],
         'MONGO_EXPORT_JOBS_URI': jobs_uri,
         'MONGO_EXPORT_ITEMS_URI': items_uri,
+        'MONGO_EXPORT_EVENTS_URI': events_uri,
+        'MONGO_EXPORT_BODIES_URI': bodies_uri,
+        'MONGO_EXPORT_BODIES_CODEC': storage_opts['bodies_codec'],
+        'MONGO_EXPORT_STATS_HISTORY_URI': stats_history_uri,
     })
 
-    job_storage = MongoTailStorage(jobs_uri, cache=True)
+    job_storage = MongoTailStorage(jobs_uri, cache=True, events_uri=events_uri)
     job_storage.ensure_index("urls")
     site_storage = MongoStorage(sites_uri, cache=True)
-    item_storage = MongoTailStorage(items_uri)
+    item_storage = MongoTailStorage(items_uri, events_uri=events_uri)
     item_storage.ensure_index("url")
     item_storage.ensure_index("_job_id")
+    stats_history = None
+    if stats_history_uri:
+        stats_history = StatsHistoryStorage(stats_history_uri)
 
     crawler_process = ArachnadoCrawlerProcess(settings)
 
@@ -108,7 +126,10 @@ def main(port, host, start_manhole, manhole_port, manhole_host, loglevel, opts):
     cron.start()
 
     app = get_application(crawler_process, domain_crawlers,
-                          site_storage, item_storage, job_storage, opts)
+                          site_storage, item_storage, job_storage, opts,
+                          body_store=body_store_from_uri(
+                              bodies_uri, storage_opts['bodies_codec']),
+                          stats_history=stats_history)
     app.listen(int(port), host)
     logger.info("Arachnado v%s is started on %s:%s" % (__version__, host, port))
 
@@ -165,6 +186,7 @@ def _get_opts(args):
     ensure_bool(opts, 'arachnado', 'debug')
     ensure_bool(opts, 'arachnado.storage', 'enabled')
     ensure_bool(opts, 'arachnado.manhole', 'enabled')
+    ensure_bool(opts, 'arachnado.websocket', 'compression')
     return opts
 
 
@@ -2,6 +2,8 @@
 from __future__ import absolute_import
 import logging
 import operator
+import weakref
+from collections import defaultdict
 
 import six
 from twisted.internet import defer
@@ -16,6 +18,7 @@ from scrapy.core.engine import ExecutionEngine
 from arachnado.signals import Signal
 from arachnado import stats
 from arachnado.process_stats import ProcessStatsMonitor
+from arachnado.metrics import CrawlerMetrics, LoopLagMonitor
 
 logger = logging.getLogger(__name__)
 
@@ -24,8 +27,7 @@ signals.spider_closing = object()
 signals.engine_paused = object()
 signals.engine_resumed = object()
 signals.engine_tick = object()
-signals.downloader_enqueued = object()
-signals.downloader_dequeued = object()
+signals.downloader_activity = object()
 
 
 # a signal which is fired when stats are changed in any of the spiders
@@ -52,8 +54,7 @@ SCRAPY_SIGNAL_NAMES = [
     'request_dropped',
     'response_received',
     'response_downloaded',
-    'downloader_enqueued',  # custom
-    'downloader_dequeued',  # custom
+    'downloader_activity',  # custom
 ]
 
 
@@ -81,8 +82,7 @@ def _get_crawler_process_signals_cls():
         response_downloaded = Signal('response_downloaded', False)
         item_scraped = Signal('item_scraped', True)
         item_dropped = Signal('item_dropped', True)
-        downloader_enqueued = Signal('downloader_enqueued', False)
-        downloader_dequeued = Signal('downloader_dequeued', False)
+        downloader_activity = Signal('downloader_activity', False)
 
     for name in SCRAPY_SIGNAL_NAMES:
         signal = getattr(signals, name)
@@ -116,6 +116,16 @@ class ArachnadoExecutionEngine(ExecutionEngine):
         )
         return dfd
 
+    @defer.inlineCallbacks
+    def open_spider(self, spider, start_requests=(), close_if_idle=True):
+        yield super(ArachnadoExecutionEngine, self).open_spider(
+            spider, start_requests, close_if_idle)
+        # Scrapy 1.1 creates dupefilters using from_settings,
+        # so they can't access the crawler themselves
+        dupefilter = getattr(self.slot.scheduler, 'df', None)
+        if hasattr(dupefilter, 'set_crawler'):
+            dupefilter.set_crawler(self.crawler)
+
     def pause(self):
         """Pause the execution engine"""
         super(ArachnadoExecutionEngine, self).pause()
@@ -138,27 +148,166 @@ class ArachnadoExecutionEngine(ExecutionEngine):
 class ArachnadoCrawler(Crawler):
     """
     Extended Crawler which uses ArachnadoExecutionEngine.
+    It also collects latency histograms (see CrawlerMetrics) in
+    ``metrics`` attribute.
     """
     # Should be set by caller. Currently DomainCrawlers class sets it (ugly).
     start_options = None
 
+    def __init__(self, *args, **kwargs):
+        super(ArachnadoCrawler, self).__init__(*args, **kwargs)
+        self.metrics = CrawlerMetrics()
+        self.signals.connect(self.metrics.on_response_received,
+                             signals.response_received)
+
     def _create_engine(self):
         return ArachnadoExecutionEngine(self, lambda _: self.stop())
 
 
 class ArachnadoDownloader(Downloader):
+    """
+    Extended Downloader which reports its activity using
+    ``downloader_activity`` signal.
+
+    Enqueued and dequeued requests are counted per download slot;
+    the signal is sent at most once per ``activity_interval`` seconds
+    with these counters and current queue sizes of the active slots.
+    """
+    activity_interval = 0.1
+
+    def __init__(self, crawler):
+        super(ArachnadoDownloader, self).__init__(crawler)
+        self._activity = defaultdict(lambda: [0, 0])
+        self.send_activity = CallLaterOnce(self._send_activity_signal)
+
     def _enqueue_request(self, request, spider):
         dfd = super(ArachnadoDownloader, self)._enqueue_request(request,
                                                                 spider)
-        self.signals.send_catch_log(signals.downloader_enqueued)
+        key = request.meta.get('download_slot')
+        self._activity[key][0] += 1
+        self.send_activity.schedule(self.activity_interval)
 
-        def _send_dequeued(_):
-            self.signals.send_catch_log(signals.downloader_dequeued)
+        def _count_dequeued(_):
+            self._activity[key][1] += 1
+            self.send_activity.schedule(self.activity_interval)
             return _
 
-        dfd.addBoth(_send_dequeued)
+        dfd.addBoth(_count_dequeued)
         return dfd
 
+    def close(self):
+        self.send_activity.cancel()
+        super(ArachnadoDownloader, self).close()
+
+    def _send_activity_signal(self):
+        activity, self._activity = self._activity, defaultdict(lambda: [0, 0])
+        slots = {}
+        for key, (enqueued, dequeued) in activity.items():
+            slot = self.slots.get(key)
+            slots[key] = {
+                'enqueued': enqueued,
+                'dequeued': dequeued,
+                'len(queue)': len(slot.queue) if slot is not None else 0,
+                'active': len(slot.active) if slot is not None else 0,
+            }
+        self.signals.send_catch_log(
+            signals.downloader_activity,
+            enqueued=sum(counts[0] for counts in activity.values()),
+            dequeued=sum(counts[1] for counts in activity.values()),
+            slots=slots,
+        )
+
+
+class SignalRouter(SignalManager):
+    """
+    Process-level SignalManager which aggregates signals from crawlers.
+
+    Crawler signals and ``stats_changed`` signals of crawler stats
+    collectors are re-sent as process-level signals (see
+    CrawlerProcessSignals and STAT_SIGNALS) with an extra ``crawler``
+    argument. A crawler signal is subscribed to only while at least one
+    receiver is connected to the corresponding process-level signal,
+    so signals nobody listens to are not dispatched twice.
+
+    Stats changes of all crawlers are emitted by a single ``stats_ticker``;
+    its interval depends on the number of ``agg_stats_changed`` receivers.
+    """
+    def __init__(self, sender=None):
+        super(SignalRouter, self).__init__(sender)
+        self._routes = {}  # process signal -> crawler signal
+        self._process_signals = {}  # crawler signal -> (signal, from_stats)
+        self._receivers = defaultdict(int)
+        self._crawlers = weakref.WeakSet()
+        self.stats_ticker = stats.StatsTicker()
+
+        for name in SCRAPY_SIGNAL_NAMES:
+            self.add_route(getattr(signals, name),
+                           getattr(CrawlerProcessSignals, name))
+        for stats_signal, process_signal in STAT_SIGNALS.items():
+            self.add_route(stats_signal, process_signal, from_stats=True)
+
+    def add_route(self, crawler_signal, process_signal, from_stats=False):
+        self._routes[process_signal] = crawler_signal
+        self._process_signals[crawler_signal] = process_signal, from_stats
+
+    def add_crawler(self, crawler):
+        """ Start routing signals from ``crawler`` """
+        self._crawlers.add(crawler)
+        if hasattr(crawler.stats, 'emit_changes'):
+            self.stats_ticker.add(crawler.stats)
+        for process_signal, receivers in self._receivers.items():
+            if receivers and process_signal in self._routes:
+                self._connect_route(crawler, process_signal)
+
+    def connect(self, receiver, signal, **kwargs):
+        super(SignalRouter, self).connect(receiver, signal, **kwargs)
+        self._receivers[signal] += 1
+        if self._receivers[signal] == 1 and signal in self._routes:
+            for crawler in list(self._crawlers):
+                self._connect_route(crawler, signal)
+        self._update_stats_ticker(signal)
+
+    def disconnect(self, receiver, signal, **kwargs):
+        super(SignalRouter, self).disconnect(receiver, signal, **kwargs)
+        if self._receivers[signal] <= 0:
+            return
+        self._receivers[signal] -= 1
+        if self._receivers[signal] == 0 and signal in self._routes:
+            for crawler in list(self._crawlers):
+                self._disconnect_route(crawler, signal)
+        self._update_stats_ticker(signal)
+
+    def _update_stats_ticker(self, signal):
+        if signal in STAT_SIGNALS.values():
+            self.stats_ticker.set_subscribers(self._receivers[signal])
+
+    def _crawler_signals(self, crawler, process_signal):
+        crawler_signal = self._routes[process_signal]
+        _, from_stats = self._process_signals[crawler_signal]
+        if from_stats:
+            # only EventedStatsCollector has signals
+            return getattr(crawler.stats, 'signals', None), crawler_signal
+        return crawler.signals, crawler_signal
+
+    def _connect_route(self, crawler, process_signal):
+        manager, crawler_signal = self._crawler_signals(crawler,
+                                                        process_signal)
+        if manager is not None:
+            manager.connect(self._route, crawler_signal)
+
+    def _disconnect_route(self, crawler, process_signal):
+        manager, crawler_signal = self._crawler_signals(crawler,
+                                                        process_signal)
+        if manager is not None:
+            manager.disconnect(self._route, crawler_signal)
+
+    def _route(self, signal, sender, **kwargs):
+        process_signal, from_stats = self._process_signals[signal]
+        kwargs['crawler'] = sender.crawler if from_stats else sender
+        if process_signal.supports_defer:
+            return self.send_catch_log_deferred(process_signal, **kwargs)
+        return self.send_catch_log(process_signal, **kwargs)
+
 
 class ArachnadoCrawlerProcess(CrawlerProcess):
     """
@@ -167,13 +316,15 @@ class ArachnadoCrawlerProcess(CrawlerProcess):
     issues and provides extra stats.
     """
     def __init__(self, settings=None):
-        self.signals = SignalManager(self)
+        self.signals = SignalRouter(self)
         self.signals.connect(self.on_spider_closed,
                              CrawlerProcessSignals.spider_closed)
         self._finished_jobs = []
         self._paused_jobs = set()
         self.procmon = ProcessStatsMonitor()
         self.procmon.start()
+        self.loop_lag = LoopLagMonitor()
+        self.loop_lag.start()
 
         super(ArachnadoCrawlerProcess, self).__init__(settings)
 
@@ -184,18 +335,9 @@ class ArachnadoCrawlerProcess(CrawlerProcess):
 
     def crawl(self, crawler_or_spidercls, *args, **kwargs):
         crawler = self.create_crawler(crawler_or_spidercls)
-
-        # aggregate all crawler signals
-        for name in SCRAPY_SIGNAL_NAMES:
-            crawler.signals.connect(self._resend_signal,
-                                    getattr(signals, name))
-
-        # aggregate signals from crawler EventedStatsCollectors
-        if hasattr(crawler.stats, "signals"):
-            crawler.stats.signals.connect(
-                self._resend_signal, stats.stats_changed
-            )
-
+        # aggregate crawler signals and signals from
+        # crawler EventedStatsCollectors
+        self.signals.add_crawler(crawler)
         d = super(ArachnadoCrawlerProcess, self).crawl(crawler, *args, **kwargs)
         return d
 
@@ -229,27 +371,10 @@ class ArachnadoCrawlerProcess(CrawlerProcess):
                     return crawler
         raise KeyError("Job is not known: %s" % crawl_id)
 
-    def _resend_signal(self, **kwargs):
-        # FIXME: this is a mess. Signal handling should be unified somehow:
-        # there shouldn't be two separate code paths
-        # for CrawlerProcessSignals and STAT_SIGNALS.
-        signal = kwargs['signal']
-        if signal in STAT_SIGNALS:
-            signal = STAT_SIGNALS[signal]
-            kwargs['crawler'] = kwargs.pop('sender').crawler
-        else:
-            signal = CrawlerProcessSignals.signal(signal)
-            kwargs['crawler'] = kwargs.pop('sender')
-
-        kwargs['signal'] = signal
-        if signal.supports_defer:
-            return self.signals.send_catch_log_deferred(**kwargs)
-        else:
-            return self.signals.send_catch_log(**kwargs)
-
     def stop(self):
         """ Terminate the process (exit from application). """
         self.procmon.stop()
+        self.loop_lag.stop()
         return super(ArachnadoCrawlerProcess, self).stop()
 
     def on_spider_closed(self, spider, reason):
@@ -264,13 +389,16 @@ class ArachnadoCrawlerProcess(CrawlerProcess):
     #
     # Time to move them to DomainCrawler?
 
+    def get_active_crawlers(self):
+        """ Return a list of crawlers of active jobs """
+        return [crawler for crawler in self.crawlers
+                if crawler.spider is not None and
+                isinstance(crawler, ArachnadoCrawler)]
+
     def get_jobs(self):
         """ Return a list of active jobs """
-        crawlers = [crawler for crawler in self.crawlers
-                    if crawler.spider is not None and
-                    isinstance(crawler, ArachnadoCrawler)]
         return [self._get_job_info(crawler, self._get_crawler_status(crawler))
-                for crawler in crawlers]
+                for crawler in self.get_active_crawlers()]
 
     def _get_job_info(self, crawler, status):
         start_options = getattr(crawler, 'start_options', {})
@@ -330,6 +458,11 @@ class ArachnadoCrawlerProcess(CrawlerProcess):
             return "suspended"
         return "crawling"
 
+    @property
+    def finished_jobs(self):
+        """ Finished jobs, most recent first """
+        return list(self._finished_jobs)
+
     @property
     def jobs(self):
         """ Current crawl state """
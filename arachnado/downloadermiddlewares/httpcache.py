@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+from twisted.internet import defer
+from scrapy.downloadermiddlewares.httpcache import (
+    HttpCacheMiddleware as ScrapyHttpCacheMiddleware
+)
+
+
+class HttpCacheMiddleware(ScrapyHttpCacheMiddleware):
+    """
+    HttpCacheMiddleware which supports non-blocking cache storages.
+
+    If a storage has ``retrieve_response_async(spider, request)`` method
+    which returns a Deferred, it is used instead of ``retrieve_response``,
+    so cache lookups don't block the event loop. ``close_spider``
+    of such storages may return a Deferred as well.
+    """
+    def spider_closed(self, spider):
+        return self.storage.close_spider(spider)
+
+    def process_request(self, request, spider):
+        retrieve = getattr(self.storage, 'retrieve_response_async', None)
+        if (retrieve is None or request.meta.get('dont_cache', False) or
+                not self.policy.should_cache_request(request)):
+            return super(HttpCacheMiddleware, self).process_request(
+                request, spider)
+        d = defer.maybeDeferred(retrieve, spider, request)
+        d.addCallback(self._process_cached_response, request, spider)
+        return d
+
+    def _process_cached_response(self, cachedresponse, request, spider):
+        # Scrapy's process_request handles the response (stats, freshness
+        # checks); its storage lookup returns the retrieved response
+        storage, self.storage = self.storage, _Retrieved(cachedresponse)
+        try:
+            return super(HttpCacheMiddleware, self).process_request(
+                request, spider)
+        finally:
+            self.storage = storage
+
+
+class _Retrieved(object):
+    """ A storage which returns an already retrieved response """
+    def __init__(self, response):
+        self.response = response
+
+    def retrieve_response(self, spider, request):
+        return self.response
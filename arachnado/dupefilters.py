@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import time
+import logging
+
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.utils.job import job_dir
+
+from arachnado.utils.bloom import ScalableBloomFilter
+from arachnado.utils.misc import replace_file
+
+logger = logging.getLogger(__name__)
+
+
+class BloomDupeFilter(RFPDupeFilter):
+    """
+    Duplicate requests filter which keeps request fingerprints in a
+    scalable Bloom filter instead of a set. Memory usage is about
+    2 bytes per request for the default 0.1% false positive rate
+    (``DUPEFILTER_BLOOM_ERROR_RATE``); a false positive means
+    a new URL is not crawled.
+
+    With JOBDIR the filter is saved to "requests.bloom" file when
+    the spider is closed and every ``DUPEFILTER_BLOOM_SAVE_INTERVAL``
+    seconds, and loaded back when a job is resumed. If the process
+    crashes, requests seen after the last save are crawled again
+    when the job is resumed. Fingerprints from "requests.seen" file
+    (left by Scrapy dupefilter) are added to the filter.
+
+    Filter size and estimated false positive rate are available as
+    "dupefilter/bloom/*" stats values.
+    """
+    stats_interval = 5  # seconds
+
+    def __init__(self, path=None, debug=False, initial_capacity=100000,
+                 error_rate=0.001, stats=None, save_interval=300):
+        super(RFPDupeFilter, self).__init__()  # don't open requests.seen
+        self.file = None
+        self.debug = debug
+        self.logdupes = True
+        self.logger = logger
+        self.path = path
+        self.stats = stats
+        self.save_interval = save_interval
+        self._stats_updated_at = 0
+        self._saved_at = time.time()
+        self.filter = self._load(initial_capacity, error_rate)
+
+    @classmethod
+    def from_settings(cls, settings, stats=None):
+        return cls(
+            path=job_dir(settings),
+            debug=settings.getbool('DUPEFILTER_DEBUG'),
+            initial_capacity=settings.getint(
+                'DUPEFILTER_BLOOM_INITIAL_CAPACITY', 100000),
+            error_rate=settings.getfloat('DUPEFILTER_BLOOM_ERROR_RATE', 0.001),
+            stats=stats,
+            save_interval=settings.getfloat('DUPEFILTER_BLOOM_SAVE_INTERVAL',
+                                            300),
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls.from_settings(crawler.settings, crawler.stats)
+
+    def set_crawler(self, crawler):
+        """
+        Report stats to ``crawler`` stats collector. It is called by
+        ArachnadoExecutionEngine when a spider is opened because Scrapy
+        creates dupefilters using ``from_settings``.
+        """
+        self.stats = crawler.stats
+        self._update_stats()
+
+    def request_seen(self, request):
+        seen = self.filter.add(self.request_fingerprint(request))
+        now = time.time()
+        if self.stats is not None and (now - self._stats_updated_at >
+                                       self.stats_interval):
+            self._update_stats()
+        if self.path and self.save_interval and (now - self._saved_at >
+                                                 self.save_interval):
+            self._save()
+        return seen
+
+    def log(self, request, spider):
+        super(BloomDupeFilter, self).log(request, spider)
+        if self.stats is None:
+            self.stats = spider.crawler.stats
+            self._update_stats()
+
+    def close(self, reason):
+        if self.stats is not None:
+            self._update_stats()
+        if self.path:
+            self._save()
+
+    def _update_stats(self):
+        self._stats_updated_at = time.time()
+        self.stats.set_value('dupefilter/bloom/count', len(self.filter))
+        self.stats.set_value('dupefilter/bloom/bytes', self.filter.nbytes)
+        self.stats.set_value('dupefilter/bloom/error_rate',
+                             self.filter.estimated_error_rate())
+
+    def _filter_path(self):
+        return os.path.join(self.path, 'requests.bloom')
+
+    def _load(self, initial_capacity, error_rate):
+        if self.path and os.path.exists(self._filter_path()):
+            with open(self._filter_path(), 'rb') as f:
+                bf = ScalableBloomFilter.load(f)
+        else:
+            bf = ScalableBloomFilter(initial_capacity, error_rate)
+        seen_path = self.path and os.path.join(self.path, 'requests.seen')
+        if seen_path and os.path.exists(seen_path):
+            with open(seen_path) as f:
+                for line in f:
+                    bf.add(line.rstrip())
+        return bf
+
+    def _save(self):
+        # write to a temporary file first, so that an old filter
+        # is not lost if the process is killed while saving
+        self._saved_at = time.time()
+        path = self._filter_path()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            self.filter.save(f)
+        replace_file(tmp_path, path)
+        seen_path = os.path.join(self.path, 'requests.seen')
+        if os.path.exists(seen_path):
+            os.remove(seen_path)
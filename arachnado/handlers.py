@@ -7,7 +7,10 @@ from tornado.web import Application, RequestHandler, url, HTTPError
 
 from arachnado.utils.misc import json_encode
 from arachnado.monitor import Monitor
+from arachnado.jobstate import JobsStateTracker
 from arachnado.handler_utils import ApiHandler, NoEtagsMixin
+from arachnado.metrics import MetricsExporter
+from arachnado.utils.mongo import client_registry
 
 from arachnado.rpc.data import PagesDataRpcWebsocketHandler, JobsDataRpcWebsocketHandler
 
@@ -19,14 +22,27 @@ at_root = lambda *args: os.path.join(os.path.dirname(__file__), *args)
 
 
 def get_application(crawler_process, domain_crawlers,
-                    site_storage, item_storage, job_storage, opts):
+                    site_storage, item_storage, job_storage, opts,
+                    body_store=None, stats_history=None):
     context = {
         'crawler_process': crawler_process,
         'domain_crawlers': domain_crawlers,
         'job_storage': job_storage,
         'site_storage': site_storage,
         'item_storage': item_storage,
+        'body_store': body_store,
+        'stats_history': stats_history,
         'opts': opts,
+        'jobs_state': JobsStateTracker(
+            crawler_process,
+            interval=float(opts['arachnado']['jobs_state_interval'])
+        ),
+        'metrics': MetricsExporter(
+            crawler_process,
+            cache_ttl=float(opts['arachnado']['metrics_cache_ttl']),
+            loop_lag=crawler_process.loop_lag,
+            mongo_clients=client_registry,
+        ),
     }
     debug = opts['arachnado']['debug']
 
@@ -43,6 +59,9 @@ def get_application(crawler_process, domain_crawlers,
         url(r"/crawler/status", CrawlerStatus, context, name="status"),
         url(r"/ws-updates", Monitor, context, name="ws-updates"),
 
+        # monitoring
+        url(r"/metrics", Metrics, context, name="metrics"),
+
         # RPC API
         url(r"/ws-rpc", RpcWebsocketHandler, context, name="ws-rpc"),
         url(r"/rpc", RpcHttpHandler, context, name="rpc"),
@@ -166,3 +185,15 @@ class CrawlerStatus(BaseRequestHandler):
                     if job['id'] in crawl_ids]
 
         self.write(json_encode({"jobs": jobs}))
+
+
+class Metrics(BaseRequestHandler):
+    """ Metrics in Prometheus text format. """
+    def initialize(self, metrics, **kwargs):
+        super(Metrics, self).initialize(**kwargs)
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header('Content-Type',
+                        'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.metrics.render())
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental updates of crawl jobs state.
+"""
+from __future__ import absolute_import
+import logging
+
+from tornado.ioloop import IOLoop
+from scrapy.signalmanager import SignalManager
+
+from arachnado.crawler_process import CrawlerProcessSignals as CPS
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobsStateTracker(object):
+    """
+    Tracks ``ArachnadoCrawlerProcess.jobs`` and emits only changed
+    jobs and fields ("deltas") instead of full job lists.
+
+    Crawler process signals only schedule an update; the job list is
+    recomputed and compared with the previous snapshot at most once
+    per ``interval`` seconds. Each job has a version counter which is
+    incremented when the job changes, and each delta has a sequence number,
+    so clients can detect missed updates and ask for a full snapshot.
+
+    Process signals are listened to only while there are subscribers.
+    """
+    signal_delta = object()
+
+    update_signals = [
+        CPS.spider_opened, CPS.spider_closed, CPS.spider_closing,
+        CPS.engine_paused, CPS.engine_resumed, CPS.engine_tick,
+        CPS.downloader_activity,
+    ]
+
+    def __init__(self, crawler_process, interval=0.5):
+        self.cp = crawler_process
+        self.interval = interval
+        self.signals = SignalManager(self)
+        self.seq = 0
+        self.subscribers = 0
+        self._jobs = {}
+        self._order = []
+        self._versions = {}
+        self._timeout = None
+
+    def subscribe(self, callback):
+        """ Subscribe ``callback(delta)`` to job state deltas """
+        self.signals.connect(callback, self.signal_delta)
+        self.subscribers += 1
+        if self.subscribers == 1:
+            for signal in self.update_signals:
+                self.cp.signals.connect(self.schedule_update, signal)
+
+    def unsubscribe(self, callback):
+        self.signals.disconnect(callback, self.signal_delta)
+        self.subscribers -= 1
+        if self.subscribers == 0:
+            for signal in self.update_signals:
+                self.cp.signals.disconnect(self.schedule_update, signal)
+            self._cancel_update()
+
+    def snapshot(self):
+        """
+        Return an up-to-date list of all jobs; each job has a "version" key.
+        Pending changes are sent to subscribers first.
+        """
+        self.update()
+        return [dict(self._jobs[job_id], version=self._versions[job_id])
+                for job_id in self._order]
+
+    def schedule_update(self, **kwargs):
+        if self._timeout is None:
+            self._timeout = IOLoop.current().call_later(self.interval,
+                                                        self.update)
+
+    def update(self):
+        """ Compare jobs with the previous snapshot and emit a delta """
+        self._cancel_update()
+        delta = self.compute_delta(self.cp.jobs)
+        if delta is not None:
+            self.signals.send_catch_log(self.signal_delta, delta=delta)
+
+    def compute_delta(self, jobs):
+        """
+        Update the snapshot using a new ``jobs`` list;
+        return a delta or None if nothing is changed.
+        """
+        changed = []
+        order = []
+        new_jobs = {}
+        for job in jobs:
+            job_id = job['id']
+            job = _copy_job(job)
+            order.append(job_id)
+            new_jobs[job_id] = job
+            old_job = self._jobs.get(job_id)
+            if old_job is None:
+                changes = job
+            else:
+                changes = _diff_job(old_job, job)
+                if not changes:
+                    continue
+            self._versions[job_id] = self._versions.get(job_id, 0) + 1
+            changed.append({
+                'id': job_id,
+                'version': self._versions[job_id],
+                'full': old_job is None,
+                'changes': changes,
+            })
+
+        removed = [job_id for job_id in self._order
+                   if job_id not in new_jobs]
+        for job_id in removed:
+            self._versions.pop(job_id, None)
+        order_changed = order != self._order
+        self._jobs, self._order = new_jobs, order
+
+        if not changed and not removed and not order_changed:
+            return None
+        self.seq += 1
+        delta = {'seq': self.seq, 'jobs': changed, 'removed': removed}
+        if order_changed:
+            delta['order'] = order
+        return delta
+
+    def _cancel_update(self):
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+
+
+def _copy_job(job):
+    # stats dict is shared with a stats collector, so it must be copied
+    # to be compared later
+    job = dict(job)
+    job['stats'] = dict(job.get('stats') or {})
+    return job
+
+
+def _diff_job(old, new):
+    """
+    Return fields which are changed in a job; for "stats" only
+    changed keys are returned, and removed stats keys are returned
+    in "stats_removed" list.
+
+    >>> _diff_job({'status': 'crawling', 'stats': {'a': 1, 'b': 2}},
+    ...           {'status': 'crawling', 'stats': {'a': 1, 'b': 3}})
+    {'stats': {'b': 3}}
+    >>> _diff_job({'status': 'crawling', 'stats': {}},
+    ...           {'status': 'suspended', 'stats': {}})
+    {'status': 'suspended'}
+    >>> _diff_job({'stats': {'a': 1, 'b': 2}}, {'stats': {'b': 2}})
+    {'stats_removed': ['a']}
+    """
+    changes = {}
+    for key, value in new.items():
+        old_value = old.get(key)
+        if key == 'stats':
+            old_value = old_value or {}
+            stats = {k: v for k, v in value.items()
+                     if k not in old_value or old_value[k] != v}
+            if stats:
+                changes[key] = stats
+            removed = sorted(k for k in old_value if k not in value)
+            if removed:
+                changes['stats_removed'] = removed
+        elif old_value != value:
+            changes[key] = value
+    return changes
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics in Prometheus text exposition format.
+"""
+from __future__ import absolute_import, division
+import re
+import time
+import bisect
+from collections import defaultdict
+
+from tornado.ioloop import IOLoop
+
+
+# IOLoop.time() is time.time() unless IOLoop is configured otherwise
+_monotonic = getattr(time, 'monotonic', None) or (
+    lambda: IOLoop.current().time())
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """
+    A cumulative histogram of observed values.
+
+    >>> h = Histogram(buckets=(0.1, 1.0))
+    >>> for value in [0.05, 0.5, 0.7, 3]:
+    ...     h.observe(value)
+    >>> h.cumulative_counts()
+    [(0.1, 1), (1.0, 3), ('+Inf', 4)]
+    >>> h.count, h.sum
+    (4, 4.25)
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        result, total = [], 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class CrawlerMetrics(object):
+    """
+    Latency histograms of a crawler which are not available from stats:
+    download latency per download slot and MongoDB export latency.
+    At most ``max_slots`` slots are tracked separately; latencies of
+    other slots are added to "other" slot.
+    """
+    max_slots = 100
+
+    def __init__(self):
+        self.download_latency = {}  # slot -> Histogram
+        self.mongo_export_latency = Histogram()
+
+    def on_response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is None:
+            return
+        slot = request.meta.get('download_slot') or ''
+        histogram = self.download_latency.get(slot)
+        if histogram is None:
+            if len(self.download_latency) >= self.max_slots:
+                slot = 'other'
+            histogram = self.download_latency.setdefault(slot, Histogram())
+        histogram.observe(latency)
+
+
+class LoopLagMonitor(object):
+    """
+    Measures event loop lag: how late a callback scheduled
+    every ``interval`` seconds is called. Lag is measured using
+    a monotonic clock (if available), so wall clock adjustments
+    are not reported as lag.
+    """
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.histogram = Histogram()
+        self.last_lag = 0
+        self._expected = None
+        self._handle = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._handle is not None:
+            IOLoop.current().remove_timeout(self._handle)
+            self._handle = None
+
+    def _schedule(self):
+        self._expected = _monotonic() + self.interval
+        self._handle = IOLoop.current().call_later(self.interval, self._tick)
+
+    def _tick(self):
+        self.last_lag = max(0, _monotonic() - self._expected)
+        self.histogram.observe(self.last_lag)
+        self._schedule()
+
+
+class MetricsExporter(object):
+    """
+    Renders crawler process metrics in Prometheus text format.
+    A rendered page is cached for ``cache_ttl`` seconds, so frequent
+    scrapes by several monitoring servers are cheap.
+
+    Job counters are exported for each active job (labelled with job id
+    and spider name) and as totals over all jobs of the process,
+    including finished ones.
+    """
+    # metric name -> stats key of job counters
+    JOB_COUNTERS = [
+        ('requests', 'downloader/request_count'),
+        ('items', 'item_scraped_count'),
+        ('response_bytes', 'downloader/response_bytes'),
+        ('errors', 'log_count/ERROR'),
+    ]
+    RESPONSE_STATUS_KEY = 'downloader/response_status_count/'
+
+    def __init__(self, crawler_process, cache_ttl=1.0, loop_lag=None,
+                 mongo_clients=None):
+        self.crawler_process = crawler_process
+        self.cache_ttl = cache_ttl
+        self.loop_lag = loop_lag
+        self.mongo_clients = mongo_clients
+        self._cached = None
+        self._cached_at = 0
+
+    def render(self):
+        now = time.time()
+        if self._cached is None or now - self._cached_at > self.cache_ttl:
+            self._cached = self._render()
+            self._cached_at = now
+        return self._cached
+
+    def _render(self):
+        out = _MetricsWriter()
+        self._render_process(out)
+        if self.mongo_clients is not None:
+            self._render_mongo_clients(out)
+        active, finished = self._get_crawlers()
+        self._render_jobs(out, active, finished)
+        self._render_slots(out, active)
+        return out.getvalue()
+
+    def _get_crawlers(self):
+        cp = self.crawler_process
+        finished = cp.finished_jobs
+        finished_ids = {job['id'] for job in finished}
+        active = [crawler for crawler in cp.get_active_crawlers()
+                  if crawler.spider.crawl_id not in finished_ids]
+        return active, finished
+
+    def _render_process(self, out):
+        proc = self.crawler_process.procmon.get_recent()
+        for name, key, help_ in [
+            ('arachnado_process_cpu_percent', 'cpu_percent',
+             "CPU usage of Arachnado process, percent"),
+            ('arachnado_process_resident_memory_bytes', 'ram_rss',
+             "Resident memory size"),
+            ('arachnado_process_open_fds', 'num_fds',
+             "Number of open file descriptors"),
+        ]:
+            if key in proc:
+                out.header(name, 'gauge', help_)
+                out.sample(name, {}, proc[key])
+
+        if self.loop_lag is not None:
+            out.header('arachnado_event_loop_lag_seconds', 'histogram',
+                       "Event loop lag")
+            out.histogram('arachnado_event_loop_lag_seconds', {},
+                          self.loop_lag.histogram)
+
+    def _render_mongo_clients(self, out):
+        stats = self.mongo_clients.get_stats()
+        out.header('arachnado_mongo_clients', 'gauge',
+                   "Number of shared MongoDB clients")
+        out.sample('arachnado_mongo_clients', {}, stats['clients_count'])
+        gauges = [
+            ('arachnado_mongo_client_refs', 'refs',
+             "Number of users of a MongoDB client"),
+            ('arachnado_mongo_pool_max_size', 'max_pool_size',
+             "Max size of a MongoDB connection pool"),
+            ('arachnado_mongo_pool_open_connections', 'open_connections',
+             "Open connections in a MongoDB connection pool"),
+            ('arachnado_mongo_pool_checked_out_connections',
+             'checked_out_connections',
+             "Connections in use in a MongoDB connection pool"),
+            ('arachnado_mongo_pool_waiting', 'waiting_count',
+             "Operations waiting for a MongoDB connection"),
+        ]
+        for name, key, help_ in gauges:
+            out.header(name, 'gauge', help_)
+            for client in stats['clients']:
+                if key in client:
+                    out.sample(name, {'uri': client['uri']}, client[key])
+        name = 'arachnado_mongo_pool_wait_seconds'
+        out.header(name, 'histogram',
+                   "Time spent waiting for a MongoDB connection")
+        for client in stats['clients']:
+            if 'wait_time' in client:
+                out.histogram(name, {'uri': client['uri']},
+                              client['wait_time'])
+
+    def _render_jobs(self, out, active, finished):
+        job_stats = [(self._job_labels(c), c.stats.get_stats())
+                     for c in active]
+        all_stats = [stats for _, stats in job_stats]
+        all_stats += [job['stats'] for job in finished]
+
+        for name, key in self.JOB_COUNTERS:
+            job_name = 'arachnado_job_%s_total' % name
+            out.header(job_name, 'counter', "Per-job %s" % key)
+            for labels, stats in job_stats:
+                out.sample(job_name, labels, stats.get(key, 0))
+            total_name = 'arachnado_%s_total' % name
+            out.header(total_name, 'counter', "Total %s" % key)
+            out.sample(total_name, {},
+                       sum(stats.get(key, 0) for stats in all_stats))
+
+        out.header('arachnado_job_responses_total', 'counter',
+                   "Per-job responses by HTTP status")
+        totals = defaultdict(int)
+        for labels, stats in job_stats:
+            for status, count in self._responses(stats):
+                out.sample('arachnado_job_responses_total',
+                           dict(labels, status=status), count)
+        for stats in all_stats:
+            for status, count in self._responses(stats):
+                totals[status] += count
+        out.header('arachnado_responses_total', 'counter',
+                   "Total responses by HTTP status")
+        for status in sorted(totals):
+            out.sample('arachnado_responses_total', {'status': status},
+                       totals[status])
+
+        out.header('arachnado_job_scheduler_depth', 'gauge',
+                   "Number of requests in a job scheduler queue")
+        for labels, stats in job_stats:
+            out.sample('arachnado_job_scheduler_depth', labels,
+                       stats.get('scheduler/enqueued', 0) -
+                       stats.get('scheduler/dequeued', 0))
+
+        out.header('arachnado_jobs', 'gauge', "Number of jobs")
+        out.sample('arachnado_jobs', {'state': 'active'}, len(active))
+        out.sample('arachnado_jobs', {'state': 'finished'}, len(finished))
+
+        name = 'arachnado_mongo_export_latency_seconds'
+        out.header(name, 'histogram', "Latency of storing items to MongoDB")
+        for crawler in active:
+            metrics = getattr(crawler, 'metrics', None)
+            if metrics is not None:
+                out.histogram(name, self._job_labels(crawler),
+                              metrics.mongo_export_latency)
+
+    def _render_slots(self, out, active):
+        gauges = [
+            ('arachnado_slot_concurrency', "Download slot concurrency",
+             lambda slot: slot.concurrency),
+            ('arachnado_slot_active_requests', "Active requests in a slot",
+             lambda slot: len(slot.active)),
+            ('arachnado_slot_transferring_requests',
+             "Requests being downloaded in a slot",
+             lambda slot: len(slot.transferring)),
+            ('arachnado_slot_queued_requests', "Requests queued in a slot",
+             lambda slot: len(slot.queue)),
+        ]
+        slots = []
+        for crawler in active:
+            labels = self._job_labels(crawler)
+            for key, slot in crawler.engine.downloader.slots.items():
+                slots.append((dict(labels, slot=key), slot))
+        for name, help_, get_value in gauges:
+            out.header(name, 'gauge', help_)
+            for labels, slot in slots:
+                out.sample(name, labels, get_value(slot))
+
+        name = 'arachnado_download_latency_seconds'
+        out.header(name, 'histogram', "Download latency")
+        for crawler in active:
+            metrics = getattr(crawler, 'metrics', None)
+            if metrics is None:
+                continue
+            labels = self._job_labels(crawler)
+            for slot, histogram in sorted(metrics.download_latency.items()):
+                out.histogram(name, dict(labels, slot=slot), histogram)
+
+    def _responses(self, stats):
+        prefix = self.RESPONSE_STATUS_KEY
+        for key, value in stats.items():
+            if key.startswith(prefix):
+                yield key[len(prefix):], value
+
+    def _job_labels(self, crawler):
+        return {'job': crawler.spider.crawl_id, 'spider': crawler.spider.name}
+
+
+class _MetricsWriter(object):
+    """
+    Writer for Prometheus text format.
+
+    >>> out = _MetricsWriter()
+    >>> out.header('x_total', 'counter', 'Some "x"')
+    >>> out.sample('x_total', {'job': 'a"b'}, 5)
+    >>> print(out.getvalue().strip())
+    # HELP x_total Some "x"
+    # TYPE x_total counter
+    x_total{job="a\\"b"} 5
+    """
+    def __init__(self):
+        self.lines = []
+
+    def header(self, name, type_, help_):
+        self.lines.append('# HELP %s %s' % (name, _escape_help(help_)))
+        self.lines.append('# TYPE %s %s' % (name, type_))
+
+    def sample(self, name, labels, value):
+        self.lines.append('%s%s %s' % (name, _format_labels(labels),
+                                       _format_value(value)))
+
+    def histogram(self, name, labels, histogram):
+        for bound, count in histogram.cumulative_counts():
+            self.sample(name + '_bucket', dict(labels, le=bound), count)
+        self.sample(name + '_sum', labels, histogram.sum)
+        self.sample(name + '_count', labels, histogram.count)
+
+    def getvalue(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+_LABEL_ESCAPE_RE = re.compile(r'[\\"\n]')
+
+
+def _escape_label(value):
+    return _LABEL_ESCAPE_RE.sub(
+        lambda m: {'\\': r'\\', '"': r'\"', '\n': r'\n'}[m.group()],
+        '%s' % value)
+
+
+def _escape_help(text):
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape_label(value))
+                             for key, value in sorted(labels.items()))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return '%s' % value
@@ -3,11 +3,7 @@ from __future__ import absolute_import
 import logging
 from tornado.ioloop import PeriodicCallback
 
-from arachnado.crawler_process import (
-    ArachnadoCrawlerProcess,
-    agg_stats_changed,
-    CrawlerProcessSignals as CPS,
-)
+from arachnado.crawler_process import agg_stats_changed
 from arachnado.process_stats import ProcessStatsMonitor
 from arachnado.wsbase import BaseWSHandler
 
@@ -42,63 +38,73 @@ logger = logging.getLogger(__name__)
 #
 
 
+_last_stats_event = (None, None)
+
+
+def stats_changed_event(changes, crawler):
+    """
+    Return "stats:changed" event data. The same ``changes`` object is
+    passed to all clients; event data is created once for it, so that
+    the message is also encoded once (see json_encode_broadcast).
+    """
+    global _last_stats_event
+    last_changes, data = _last_stats_event
+    if last_changes is not changes:
+        data = [crawler.spider.crawl_id, changes]
+        _last_stats_event = changes, data
+    return data
+
+
 class Monitor(BaseWSHandler):
     """
     WebSocket handler which pushes CrawlerProcess events to a client.
+
+    A full list of jobs is sent as "jobs:state" event when a client
+    connects or asks for it using "jobs:resync" event; after that only
+    changes are sent as "jobs:delta" events
+    (see :class:`arachnado.jobstate.JobsStateTracker`).
     """
-    engine_signals = [
-        CPS.spider_closing, CPS.engine_paused, CPS.engine_resumed,
-        CPS.engine_tick, CPS.downloader_enqueued, CPS.downloader_dequeued
-    ]
 
-    def initialize(self, crawler_process, opts, **kwargs):
+    def initialize(self, crawler_process, opts, jobs_state, **kwargs):
         """
         :param ArachnadoCrawlerProcess crawler_process: crawler process
+        :param JobsStateTracker jobs_state: jobs state tracker
         """
         self.cp = crawler_process
         self.opts = opts
+        self.jobs_state = jobs_state
+        self.init_transport(opts)
 
     def on_open(self):
         logger.debug("new connection")
+        # Jobs state is sent before subscribing to deltas: taking
+        # a snapshot sends pending changes to other clients, and this
+        # client would get a delta for jobs it doesn't know yet.
+        self._send_jobs_state()
+        self.jobs_state.subscribe(self.on_jobs_delta)
         self.cp.signals.connect(self.on_stats_changed, agg_stats_changed)
-        self.cp.signals.connect(self.on_spider_opened, CPS.spider_opened)
-        self.cp.signals.connect(self.on_spider_closed, CPS.spider_closed)
-
-        for signal in self.engine_signals:
-            self.cp.signals.connect(self.on_engine_state_changed, signal)
-
         self.cp.procmon.signals.connect(self.on_process_stats, ProcessStatsMonitor.signal_updated)
-        self.write_event("jobs:state", self.cp.jobs)
 
     def on_close(self):
         logger.debug("connection closed")
         self.cp.signals.disconnect(self.on_stats_changed, agg_stats_changed)
-        self.cp.signals.disconnect(self.on_spider_opened, CPS.spider_opened)
-        self.cp.signals.disconnect(self.on_spider_closed, CPS.spider_closed)
-        for signal in self.engine_signals:
-            self.cp.signals.disconnect(self.on_engine_state_changed, signal)
+        self.jobs_state.unsubscribe(self.on_jobs_delta)
         self.cp.procmon.signals.disconnect(self.on_process_stats, ProcessStatsMonitor.signal_updated)
 
-    def on_spider_opened(self, spider):
-        self._send_jobs_state()
-
-    def on_spider_closed(self, spider, reason):
-        self._send_jobs_state()
-
-    def on_engine_state_changed(self, crawler):
-        self._send_jobs_state()
+    def on_event(self, event, data):
+        if event == "jobs:resync":
+            self._send_jobs_state()
 
-    def on_tick(self):
-        self._send_jobs_state()
+    def on_jobs_delta(self, delta):
+        self.write_event("jobs:delta", delta)
 
     def on_stats_changed(self, changes, crawler):
         # Don't log anything here! Log events are counted by stats collector,
         # so logging a message will trigger more on_stats_changed events.
-        crawl_id = crawler.spider.crawl_id
-        self.write_event("stats:changed", [crawl_id, changes])
+        self.write_event("stats:changed", stats_changed_event(changes, crawler))
 
     def on_process_stats(self, stats):
         self.write_event("process:stats", stats)
 
     def _send_jobs_state(self):
-        self.write_event("jobs:state", self.cp.jobs)
+        self.write_event("jobs:state", self.jobs_state.snapshot())
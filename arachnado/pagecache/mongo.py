@@ -1,35 +1,489 @@
+import logging
+import datetime
+
 import pymongo
-from scrapy.http import Headers
+import pymongo.errors
+import six
+from bson.son import SON
+from six.moves.urllib.parse import urlparse
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from twisted.internet import defer
+from scrapy.http import Headers, TextResponse
 from scrapy.responsetypes import responsetypes
+from scrapy.utils.request import request_fingerprint
+
+from arachnado.storages.bodies import body_store_from_uri, body_hash
+from arachnado.utils.mongo import client_uri, motor_from_uri, release_client
+from arachnado.utils.twistedtornado import wrap_future
+from arachnado.utils.lru import LRUCache
+from arachnado.utils.misc import approx_doc_size
+from arachnado.spidermiddlewares.pageitems import raw_body
+
+
+logger = logging.getLogger(__name__)
+
+_NOT_CACHED = object()
+
+TTL_INDEX_KEY = [('stored_at', pymongo.ASCENDING)]
+# MongoDB error code returned when an index exists with other options,
+# e.g. when HTTPCACHE_EXPIRATION_SECS is changed
+INDEX_OPTIONS_CONFLICT = 85
 
 
 class MongoCacheStorage(object):
-    """A read-only cache storage that uses Arachnado MongoDB for retrieving
-    responses"""
+    """
+    HTTP cache storage which uses Arachnado MongoDB.
+
+    Responses are stored in ``HTTPCACHE_MONGO_URI`` collection (default is
+    "httpcache" collection in items database) keyed by request fingerprint,
+    with their status and headers. If ``MONGO_EXPORT_BODIES_URI`` is set,
+    bodies are stored in the body store.
+
+    Entries older than ``HTTPCACHE_EXPIRATION_SECS`` are expired;
+    MongoDB removes them using a TTL index; the index is updated when
+    ``HTTPCACHE_EXPIRATION_SECS`` is changed. Set ``HTTPCACHE_POLICY`` to
+    RFC2616Policy to revalidate stale responses using
+    If-Modified-Since / If-None-Match requests; note that pages
+    from the items collection have no freshness headers, so they are
+    always stale for this policy.
+
+    If a response is not in the cache, a page stored by
+    MongoExportPipeline for the same URL is used (if
+    ``HTTPCACHE_MONGO_USE_ITEMS`` is True).
+
+    Cache hit rate is available as "mongo_cache/hit_rate" stats value.
+
+    Lookup results are cached in memory, in a LRU cache limited to
+    ``HTTPCACHE_MONGO_LRU_ITEMS`` entries and ``HTTPCACHE_MONGO_LRU_BYTES``
+    bytes; "not found" results are cached for
+    ``HTTPCACHE_MONGO_NEGATIVE_TTL`` seconds. Set
+    ``HTTPCACHE_MONGO_LRU_ITEMS`` to 0 to disable it.
+
+    This storage uses blocking pymongo calls; see
+    :class:`AsyncMongoCacheStorage` for a non-blocking version.
+    """
 
     def __init__(self, settings):
-        self.db_name = settings.get('MOTOR_PIPELINE_DB_NAME')
-        self.db_uri = settings.get('MOTOR_PIPELINE_URI')
+        self.items_uri = settings.get('MONGO_EXPORT_ITEMS_URI')
+        self.cache_uri = (settings.get('HTTPCACHE_MONGO_URI') or
+                          _sibling_uri(self.items_uri, 'httpcache'))
+        self.use_items = settings.getbool('HTTPCACHE_MONGO_USE_ITEMS', True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        # bodies stored out of line by MongoExportPipeline
+        self.body_store = body_store_from_uri(
+            settings.get('MONGO_EXPORT_BODIES_URI'),
+            settings.get('MONGO_EXPORT_BODIES_CODEC', 'zlib'),
+        )
+        self.lru = LRUCache(
+            max_items=settings.getint('HTTPCACHE_MONGO_LRU_ITEMS', 1000),
+            max_bytes=settings.getint('HTTPCACHE_MONGO_LRU_BYTES',
+                                      64*1024*1024),
+        )
+        self.negative_ttl = settings.getfloat('HTTPCACHE_MONGO_NEGATIVE_TTL',
+                                              10)
 
     def open_spider(self, spider):
-        self.db = pymongo.MongoClient(self.db_uri)
-        self.col = self.db[self.db_name]['items']
-        self.col.ensure_index('url')
+        self.stats = spider.crawler.stats
+        self.clients = {}
+        self.cache_col = self._collection(self.cache_uri)
+        self.items_col = self._collection(self.items_uri)
+        if self.expiration_secs > 0:
+            try:
+                self.cache_col.create_index(
+                    TTL_INDEX_KEY, expireAfterSeconds=self.expiration_secs)
+            except pymongo.errors.OperationFailure as e:
+                if e.code != INDEX_OPTIONS_CONFLICT:
+                    raise
+                self.cache_col.database.command(
+                    _update_ttl_command(self.cache_col, self.expiration_secs))
+        if self.use_items:
+            self.items_col.ensure_index('url')
 
     def close_spider(self, spider):
-        self.db.close()
+        self.lru.clear()
+        for client in self.clients.values():
+            client.close()
+        if self.body_store is not None:
+            self.body_store.close()
 
     def retrieve_response(self, spider, request):
-        doc = self.col.find_one({'url': request.url})
-        if doc is None:
-            return  # not cached
-        status = 200
+        self.stats.inc_value('mongo_cache/lookup_count')
+        fingerprint = request_fingerprint(request)
+        entry = self._lru_get(fingerprint)
+        if entry is _NOT_CACHED:
+            doc = self.cache_col.find_one({'_id': fingerprint})
+            if doc is None and self.use_items:
+                doc = self.items_col.find_one({'url': request.url},
+                                              sort=[('_id', -1)])
+                if doc is not None:
+                    self.stats.inc_value('mongo_cache/items_hit_count')
+            entry = None
+            if doc is not None:
+                body = None if self._is_expired(doc) else self._get_body(doc)
+                entry = doc, body
+            self._lru_put(fingerprint, entry)
+        return self._response_from_entry(entry)
+
+    def store_response(self, spider, request, response):
+        doc = self._make_doc(request, response)
+        if self.body_store is not None:
+            self.body_store.put_sync(doc['body_hash'], response.body)
+        self.cache_col.update({'_id': doc['_id']}, doc, upsert=True)
+        self.stats.inc_value('mongo_cache/store_count')
+        self._lru_put(doc['_id'], (doc, response.body))
+
+    def _response_from_entry(self, entry):
+        """
+        Return a response for an entry, which is a (doc, body) tuple
+        (body is None if it is not loaded) or None if a document
+        is not found.
+        """
+        response = None
+        if entry is not None:
+            doc, body = entry
+            if self._is_expired(doc):
+                self.stats.inc_value('mongo_cache/expired_count')
+            elif body is not None:
+                response = self._build_response(doc, body)
+        self._update_hit_stats(response is not None)
+        return response
+
+    def _lru_get(self, fingerprint):
+        entry = self.lru.get(fingerprint, _NOT_CACHED)
+        if entry is _NOT_CACHED:
+            self.stats.inc_value('mongo_cache/lru_miss_count')
+        else:
+            self.stats.inc_value('mongo_cache/lru_hit_count')
+        return entry
+
+    def _lru_put(self, fingerprint, entry):
+        if entry is None or entry[1] is None:
+            # not found, expired or lost; it can be stored soon
+            size, ttl = 0, self.negative_ttl
+        else:
+            doc, body = entry
+            if 'body' in doc:
+                # don't keep two copies of a body
+                doc = dict(doc)
+                del doc['body']
+                entry = doc, body
+            size, ttl = len(body) + approx_doc_size(doc), None
+        evicted = self.lru.put(fingerprint, entry, size=size, ttl=ttl)
+        if evicted:
+            self.stats.inc_value('mongo_cache/lru_eviction_count', evicted)
+
+    def _make_doc(self, request, response):
+        doc = {
+            '_id': request_fingerprint(request),
+            'url': response.url,
+            'status': response.status,
+            'headers': [
+                [_to_native_str(key), [raw_body(v) for v in values]]
+                for key, values in response.headers.items()
+            ],
+            'stored_at': datetime.datetime.utcnow(),
+        }
+        if isinstance(response, TextResponse):
+            doc['body_encoding'] = response.encoding
+        if self.body_store is not None:
+            doc['body_hash'] = body_hash(response.body)
+        else:
+            doc['body'] = raw_body(response.body)
+        return doc
+
+    def _is_expired(self, doc):
+        if self.expiration_secs <= 0:
+            return False
+        stored_at = doc.get('stored_at') or doc.get('crawled_at')
+        if stored_at is None:
+            return False
+        age = datetime.datetime.utcnow() - stored_at
+        return age.total_seconds() > self.expiration_secs
+
+    def _collection(self, uri):
+        key = client_uri(uri)
+        if key not in self.clients:
+            self.clients[key] = pymongo.MongoClient(key)
+        db_name, col_name = urlparse(uri).path.split('/')[1:]
+        return self.clients[key][db_name][col_name]
+
+    def _update_hit_stats(self, hit):
+        self.stats.inc_value('mongo_cache/hit_count' if hit else
+                             'mongo_cache/miss_count')
+        hits = self.stats.get_value('mongo_cache/hit_count', 0)
+        lookups = self.stats.get_value('mongo_cache/lookup_count')
+        self.stats.set_value('mongo_cache/hit_rate',
+                             round(float(hits) / lookups, 4))
+
+    def _build_response(self, doc, body):
+        if body is None:
+            return  # body is lost
         url = doc['url']
         headers = Headers(doc['headers'])
-        body = doc['body'].encode('utf-8')
         respcls = responsetypes.from_args(headers=headers, url=url)
-        response = respcls(url=url, headers=headers, status=status, body=body)
-        return response
+        kwargs = {}
+        if issubclass(respcls, TextResponse):
+            # raw bodies are in their original encoding,
+            # decoded bodies are stored as UTF-8
+            kwargs['encoding'] = doc.get('body_encoding') or 'utf-8'
+        return respcls(url=url, headers=headers, status=doc.get('status', 200),
+                       body=body, **kwargs)
+
+    def _get_body(self, doc):
+        if 'body' in doc:
+            return _body_bytes(doc['body'])
+        if doc.get('body_hash') and self.body_store is not None:
+            body = self.body_store.get_sync(doc['body_hash'])
+            if body is not None:
+                return body
+        # body is not changed since a previous crawl
+        source = doc.get('unchanged_since')
+        if source:
+            source_doc = self.items_col.find_one({'_id': source['item_id']},
+                                                 {'body': True})
+            if source_doc is not None and 'body' in source_doc:
+                return _body_bytes(source_doc['body'])
+
+
+class AsyncMongoCacheStorage(MongoCacheStorage):
+    """
+    Non-blocking version of :class:`MongoCacheStorage` which uses Motor.
+    It should be used with
+    :class:`arachnado.downloadermiddlewares.httpcache.HttpCacheMiddleware`;
+    other middlewares (e.g. the stock Scrapy one) make blocking lookups
+    using :class:`MongoCacheStorage`, and a warning is logged.
+
+    Lookups made in the same event loop iteration are sent to MongoDB
+    as a single query; responses are stored in background
+    using bulk writes.
+    """
+    def __init__(self, settings):
+        super(AsyncMongoCacheStorage, self).__init__(settings)
+        self.settings = settings
+        self._sync_storage = None
+
+    def open_spider(self, spider):
+        self.stats = spider.crawler.stats
+        self.motor_clients = []
+        self.cache_col = self._motor_collection(self.cache_uri)
+        self.items_col = self._motor_collection(self.items_uri)
+        self._lookups = []
+        self._writes = []
+        self._flush_scheduled = False
+        self._running = set()
+        if self.expiration_secs > 0:
+            self._track(self._ensure_ttl_index())
+        if self.use_items:
+            self._track(self.items_col.ensure_index('url'))
+
+    def close_spider(self, spider):
+        return wrap_future(self._close())
+
+    def retrieve_response_async(self, spider, request):
+        self.stats.inc_value('mongo_cache/lookup_count')
+        fingerprint = request_fingerprint(request)
+        entry = self._lru_get(fingerprint)
+        if entry is not _NOT_CACHED:
+            return defer.succeed(self._response_from_entry(entry))
+        future = Future()
+        self._lookups.append((fingerprint, request.url, future))
+        self._schedule_flush()
+        return wrap_future(future)
+
+    def retrieve_response(self, spider, request):
+        if self._sync_storage is None:
+            logger.warning(
+                "AsyncMongoCacheStorage is used with a middleware which "
+                "doesn't support non-blocking lookups; HTTP cache lookups "
+                "will block. Use "
+                "arachnado.downloadermiddlewares.httpcache.HttpCacheMiddleware "
+                "instead of Scrapy's HttpCacheMiddleware.")
+            self._sync_storage = MongoCacheStorage(self.settings)
+            self._sync_storage.lru = self.lru
+            self._sync_storage.open_spider(spider)
+        return self._sync_storage.retrieve_response(spider, request)
 
     def store_response(self, spider, request, response):
-        pass
+        doc = self._make_doc(request, response)
+        self._writes.append((doc, response.body))
+        self._lru_put(doc['_id'], (doc, response.body))
+        self._schedule_flush()
+
+    @gen.coroutine
+    def _close(self):
+        self.lru.clear()
+        if self._sync_storage is not None:
+            self._sync_storage.close_spider(None)
+            self._sync_storage = None
+        self._flush()
+        while self._running:
+            yield list(self._running)
+        for client in self.motor_clients:
+            release_client(client)
+        if self.body_store is not None:
+            self.body_store.close()
+
+    def _motor_collection(self, uri):
+        client, _, _, _, col = motor_from_uri(uri)
+        self.motor_clients.append(client)
+        return col
+
+    @gen.coroutine
+    def _ensure_ttl_index(self):
+        try:
+            yield self.cache_col.create_index(
+                TTL_INDEX_KEY, expireAfterSeconds=self.expiration_secs)
+        except pymongo.errors.OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            yield self.cache_col.database.command(
+                _update_ttl_command(self.cache_col, self.expiration_secs))
+
+    def _track(self, future):
+        self._running.add(future)
+        future.add_done_callback(self._running.discard)
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            IOLoop.current().add_callback(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        lookups, self._lookups = self._lookups, []
+        writes, self._writes = self._writes, []
+        if lookups:
+            self._track(self._lookup(lookups))
+        if writes:
+            self._track(self._write(writes))
+
+    @gen.coroutine
+    def _lookup(self, lookups):
+        try:
+            docs = yield self._find_docs(lookups)
+        except Exception:
+            logger.error("Error reading HTTP cache", exc_info=True)
+            self.stats.inc_value('mongo_cache/retrieve_error_count')
+            docs = {}
+        found = [docs.get(fingerprint) or docs.get(url)
+                 for fingerprint, url, _ in lookups]
+        bodies = yield [self._lookup_body(doc) for doc in found]
+        for (fingerprint, url, future), doc, body in zip(lookups, found,
+                                                         bodies):
+            entry = None if doc is None else (doc, body)
+            self._lru_put(fingerprint, entry)
+            future.set_result(self._response_from_entry(entry))
+
+    @gen.coroutine
+    def _lookup_body(self, doc):
+        if doc is None or self._is_expired(doc):
+            return
+        try:
+            body = yield self._get_body_async(doc)
+        except Exception:
+            logger.error("Error reading HTTP cache", exc_info=True)
+            self.stats.inc_value('mongo_cache/retrieve_error_count')
+            return
+        raise gen.Return(body)
+
+    @gen.coroutine
+    def _find_docs(self, lookups):
+        """
+        Return a dict with cached documents (keyed by fingerprint) and
+        stored pages (keyed by URL) for ``lookups``.
+        """
+        fingerprints = [fingerprint for fingerprint, _, _ in lookups]
+        docs = {}
+        cursor = self.cache_col.find({'_id': {'$in': fingerprints}})
+        while (yield cursor.fetch_next):
+            doc = cursor.next_object()
+            docs[doc['_id']] = doc
+
+        urls = [url for fingerprint, url, _ in lookups
+                if fingerprint not in docs]
+        if not urls or not self.use_items:
+            raise gen.Return(docs)
+
+        # find the latest page for each URL, then fetch these pages
+        latest = {}
+        cursor = self.items_col.find({'url': {'$in': urls}},
+                                     {'url': True}).sort('_id', -1)
+        while (yield cursor.fetch_next):
+            doc = cursor.next_object()
+            latest.setdefault(doc['url'], doc['_id'])
+        if latest:
+            cursor = self.items_col.find({'_id': {'$in': list(latest.values())}})
+            while (yield cursor.fetch_next):
+                doc = cursor.next_object()
+                docs[doc['url']] = doc
+                self.stats.inc_value('mongo_cache/items_hit_count')
+        raise gen.Return(docs)
+
+    @gen.coroutine
+    def _get_body_async(self, doc):
+        if 'body' in doc:
+            raise gen.Return(_body_bytes(doc['body']))
+        if doc.get('body_hash') and self.body_store is not None:
+            body = yield self.body_store.get(doc['body_hash'])
+            if body is not None:
+                raise gen.Return(body)
+        source = doc.get('unchanged_since')
+        if source:
+            source_doc = yield self.items_col.find_one(
+                {'_id': source['item_id']}, {'body': True})
+            if source_doc is not None and 'body' in source_doc:
+                raise gen.Return(_body_bytes(source_doc['body']))
+
+    @gen.coroutine
+    def _write(self, writes):
+        try:
+            bulk = self.cache_col.initialize_unordered_bulk_op()
+            for doc, body in writes:
+                if self.body_store is not None:
+                    yield self.body_store.put(doc['body_hash'], body)
+                bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+            yield bulk.execute()
+            self.stats.inc_value('mongo_cache/store_count', len(writes))
+        except Exception:
+            logger.error("Error writing to HTTP cache", exc_info=True)
+            self.stats.inc_value('mongo_cache/store_error_count')
+
+
+def _body_bytes(body):
+    if isinstance(body, six.text_type):
+        return body.encode('utf-8')
+    return bytes(body)  # raw body, stored as BSON binary
+
+
+def _to_native_str(value):
+    # header names are ASCII; values are stored as binary
+    if isinstance(value, bytes) and not six.PY2:
+        return value.decode('latin1')
+    return value
+
+
+def _update_ttl_command(col, expiration_secs):
+    """
+    Return a command which changes expiration time of an existing
+    TTL index.
+
+    >>> class Col(object): name = 'httpcache'
+    >>> cmd = _update_ttl_command(Col(), 60)
+    >>> list(cmd), cmd['collMod'], cmd['index']['expireAfterSeconds']
+    (['collMod', 'index'], 'httpcache', 60)
+    """
+    return SON([
+        ('collMod', col.name),
+        ('index', {'keyPattern': dict(TTL_INDEX_KEY),
+                   'expireAfterSeconds': expiration_secs}),
+    ])
+
+
+def _sibling_uri(uri, col_name):
+    """
+    >>> _sibling_uri('mongodb://localhost/arachnado/items', 'httpcache')
+    'mongodb://localhost/arachnado/httpcache'
+    """
+    return uri.rsplit('/', 1)[0] + '/' + col_name
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered unordered bulk inserts used by MongoExportPipeline.
+"""
+from __future__ import absolute_import
+import time
+import logging
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+from pymongo.errors import BulkWriteError
+
+from arachnado.utils.misc import approx_doc_size
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchInserter(object):
+    """
+    Collects documents in memory and inserts them to ``col`` using
+    unordered bulk inserts. A batch is flushed when it has ``max_items``
+    documents, when its approximate size reaches ``max_bytes`` bytes or
+    when the first document in a batch waited for ``linger`` seconds.
+
+    :meth:`put` waits while ``max_pending`` documents are buffered or
+    being written; this way a slow MongoDB slows down item processing
+    instead of growing the buffer without bound. Per-document work
+    which must finish before a document is written (e.g. storing its
+    body elsewhere) can be passed as ``prepare`` to :meth:`put`; it runs
+    concurrently, so the batch is filled without waiting for it.
+
+    Results are stored in ``<stats_prefix>/*`` stats keys;
+    ``on_written`` callback (if any) is called with a number of
+    inserted documents after each batch; flush latencies are also
+    observed by ``latency_histogram`` (an arachnado.metrics.Histogram),
+    if it is set.
+    """
+    def __init__(self, col, stats, max_items=100, max_bytes=4*1024*1024,
+                 linger=1.0, max_pending=None, stats_prefix='mongo_export',
+                 on_written=None, latency_histogram=None):
+        self.col = col
+        self.stats = stats
+        self.on_written = on_written
+        self.latency_histogram = latency_histogram
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.max_pending = max_pending or max_items * 4
+        self.stats_prefix = stats_prefix
+        self._batch = []
+        self._batch_bytes = 0
+        self._pending = 0
+        self._timeout = None
+        self._cond = Condition()
+
+    @gen.coroutine
+    def put(self, doc, prepare=None):
+        """
+        Add a document to the current batch. If ``prepare`` is set,
+        it is called without arguments and should return a Future;
+        the document is added to a batch when this Future is resolved,
+        but :meth:`put` doesn't wait for it.
+        """
+        while self._pending >= self.max_pending:
+            self._inc('backpressure_wait_count')
+            yield self._cond.wait()
+        self._pending += 1
+        if prepare is None:
+            self._add(doc)
+        else:
+            IOLoop.current().add_future(
+                prepare(), lambda future: self._prepared(doc, future))
+
+    def _prepared(self, doc, future):
+        try:
+            future.result()
+        except Exception:
+            self._inc('prepare_error_count')
+            logger.error("Error preparing a document", exc_info=True)
+        self._add(doc)
+        # join() may be waiting for this document
+        self._cond.notify_all()
+
+    def _add(self, doc):
+        self._batch.append(doc)
+        self._batch_bytes += approx_doc_size(doc)
+        if (len(self._batch) >= self.max_items or
+                self._batch_bytes >= self.max_bytes):
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = IOLoop.current().call_later(self.linger,
+                                                        self.flush)
+
+    def flush(self):
+        """
+        Start writing the current batch. Return a Future which is resolved
+        when the batch is written.
+        """
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        if not self._batch:
+            return gen.maybe_future(None)
+        batch, self._batch = self._batch, []
+        self._batch_bytes = 0
+        return self._write(batch)
+
+    @gen.coroutine
+    def join(self):
+        """ Flush the buffer and wait until all pending writes are finished """
+        self.flush()
+        while self._pending:
+            yield self._cond.wait()
+            self.flush()
+
+    @gen.coroutine
+    def _write(self, batch):
+        start_time = time.time()
+        bulk = self.col.initialize_unordered_bulk_op()
+        for doc in batch:
+            bulk.insert(doc)
+        try:
+            result = yield bulk.execute()
+        except BulkWriteError as e:
+            result = e.details
+            self._inc('batch_partial_failure_count')
+            self._store_errors(len(result.get('writeErrors', [])), e)
+        except Exception as e:
+            result = {'nInserted': 0}
+            self._inc('batch_failure_count')
+            self._store_errors(len(batch), e)
+        finally:
+            self._pending -= len(batch)
+            self._cond.notify_all()
+
+        latency = time.time() - start_time
+        self._inc('items_stored_count', result.get('nInserted', 0))
+        self._inc('batch_count')
+        self.stats.set_value(self._key('batch_size_last'), len(batch))
+        self.stats.max_value(self._key('batch_size_max'), len(batch))
+        self.stats.set_value(self._key('flush_latency_last'), latency)
+        self.stats.max_value(self._key('flush_latency_max'), latency)
+        if self.latency_histogram is not None:
+            self.latency_histogram.observe(latency)
+        if self.on_written is not None:
+            self.on_written(result.get('nInserted', 0))
+
+    def _store_errors(self, count, exc):
+        self._inc('store_error_count', count)
+        self._inc('store_error_count/' + exc.__class__.__name__, count)
+        logger.error("Error storing %d items", count, exc_info=True)
+
+    def _inc(self, key, count=1):
+        if count:
+            self.stats.inc_value(self._key(key), count)
+
+    def _key(self, key):
+        return self.stats_prefix + '/' + key
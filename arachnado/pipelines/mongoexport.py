@@ -5,24 +5,36 @@ Async MongoDB item exporter using Motor_.
 .. _Motor: https://github.com/mongodb/motor
 """
 from __future__ import absolute_import
+import time
 import logging
 import datetime
 import copy
+import itertools
 
-from tornado import gen
+import six
+from tornado import gen, locks
 from tornado.ioloop import PeriodicCallback
 from bson.objectid import ObjectId
+import pymongo
 import scrapy
 from scrapy.exceptions import NotConfigured
 from scrapy import signals
 
 from arachnado.utils.twistedtornado import tt_coroutine
+from arachnado.pipelines.batching import BatchInserter
+from arachnado.storages.notifier import EventPublisher
+from arachnado.storages.bodies import body_store_from_uri, body_hash, to_bytes
+from arachnado.storages.stats_history import StatsHistoryStorage, get_sample
 from arachnado.utils.misc import json_encode
-from arachnado.utils.mongo import motor_from_uri, replace_dots
+from arachnado.utils.mongo import (
+    motor_from_uri, release_client, replace_dots
+)
 
 
 logger = logging.getLogger(__name__)
 
+_MISSING = object()
+
 
 def scrapy_item_to_dict(son):
     """Recursively convert scrapy.Item to dict"""
@@ -52,7 +64,45 @@ class MongoExportPipeline(object):
 
     If MONGO_EXPORT_DUMP_PERIOD is non-zero then updated job stats are saved
     to Mongo periodically every ``MONGO_EXPORT_DUMP_PERIOD`` seconds
-    (default is 60).
+    (default is 60). Stats are stored in "stats_dict" field of the job, with
+    dots in key names replaced by underscores; original names of such keys
+    are stored in "stats_keys" field (see
+    :func:`arachnado.utils.mongo.restore_stats_keys`). Only stats changed
+    since the previous update are written. If MONGO_EXPORT_STATS_JSON is True
+    then stats are also stored as a JSON string in "stats" field, as in
+    previous Arachnado versions.
+
+    If MONGO_EXPORT_STATS_HISTORY_URI is set then samples of job counters
+    (pages, items, bytes, errors, queue size) are stored to this collection
+    every ``MONGO_EXPORT_STATS_HISTORY_PERIOD`` seconds (default is 10),
+    see :mod:`arachnado.storages.stats_history`.
+
+    If MONGO_EXPORT_BATCH_SIZE is non-zero then items are not inserted
+    one-by-one; they are buffered and written using unordered bulk inserts
+    of up to ``MONGO_EXPORT_BATCH_SIZE`` items. A batch is also flushed when
+    its approximate size reaches ``MONGO_EXPORT_BATCH_MAX_BYTES`` or
+    when it is older than ``MONGO_EXPORT_BATCH_LINGER`` seconds. Item
+    processing waits when more than ``MONGO_EXPORT_BATCH_MAX_PENDING``
+    items are not stored yet. Remaining items are flushed when
+    spider is closing.
+
+    If MONGO_EXPORT_EVENTS_URI is set then notifications about new items
+    and jobs are written to a capped collection at this URI; Arachnado
+    uses them to push new data to clients when MongoDB change streams
+    are not available.
+
+    If MONGO_EXPORT_BODIES_URI is set then item bodies are stored
+    in a separate content-addressed body store (GridFS or a local folder,
+    see :mod:`arachnado.storages.bodies`), compressed using
+    ``MONGO_EXPORT_BODIES_CODEC``; stored items get "body_hash" and
+    "body_length" fields instead of "body".
+
+    If MONGO_EXPORT_DEDUP_BODIES is True then a body is not stored
+    if the latest stored page with the same URL has the same body (e.g.
+    when a website is recrawled periodically); such page gets
+    "body_hash", "body_length" and "unchanged_since" fields instead of
+    "body". "unchanged_since" is ``{"job_id": ..., "item_id": ...}``
+    of a page which has this body.
     """
 
     def __init__(self, crawler):
@@ -75,7 +125,60 @@ class MongoExportPipeline(object):
         crawler.signals.connect(self.spider_closing, signals.spider_closing)
 
         self.dump_period = settings.getfloat('MONGO_EXPORT_DUMP_PERIOD', 60.0)
+        self.stats_json = settings.getbool('MONGO_EXPORT_STATS_JSON', False)
         self._dump_pc = None
+        self._dumped_stats = {}  # stats stored in the job document
+        self._stats_fields = {}  # stat key -> escaped field name
+        self._stats_names = set()  # escaped names which are used
+        self._stats_keys = {}  # escaped name -> stat key, if they differ
+        self._unsaved_stats_keys = {}
+        self._stats_lock = locks.Lock()
+
+        self.stats_history = None
+        self._history_pc = None
+        history_uri = settings.get('MONGO_EXPORT_STATS_HISTORY_URI')
+        if history_uri:
+            self.stats_history = StatsHistoryStorage(history_uri)
+            self.history_period = settings.getfloat(
+                'MONGO_EXPORT_STATS_HISTORY_PERIOD', 10.0)
+
+        self.events_uri = settings.get('MONGO_EXPORT_EVENTS_URI')
+        self._items_events = self._jobs_events = None
+        if self.events_uri:
+            self._items_events = EventPublisher(self.events_uri,
+                                                self.items_col.name)
+            self._jobs_events = EventPublisher(self.events_uri,
+                                               self.jobs_col.name)
+
+        self.body_store = body_store_from_uri(
+            settings.get('MONGO_EXPORT_BODIES_URI'),
+            settings.get('MONGO_EXPORT_BODIES_CODEC', 'zlib'),
+        )
+
+        self.dedup_bodies = settings.getbool('MONGO_EXPORT_DEDUP_BODIES',
+                                             False)
+
+        # latency histogram for /metrics endpoint; only ArachnadoCrawler
+        # has it.
+        metrics = getattr(crawler, 'metrics', None)
+        self._latency_histogram = (metrics.mongo_export_latency
+                                   if metrics is not None else None)
+
+        self.batch_size = settings.getint('MONGO_EXPORT_BATCH_SIZE', 0)
+        self._inserter = None
+        if self.batch_size:
+            self._inserter = BatchInserter(
+                col=self.items_col,
+                stats=crawler.stats,
+                on_written=self._items_stored,
+                latency_histogram=self._latency_histogram,
+                max_items=self.batch_size,
+                max_bytes=settings.getint('MONGO_EXPORT_BATCH_MAX_BYTES',
+                                          4*1024*1024),
+                linger=settings.getfloat('MONGO_EXPORT_BATCH_LINGER', 1.0),
+                max_pending=settings.getint('MONGO_EXPORT_BATCH_MAX_PENDING',
+                                            0),
+            )
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -94,6 +197,14 @@ class MongoExportPipeline(object):
         try:
             yield self.items_col.ensure_index(self.job_id_key)
             yield self.jobs_col.ensure_index('id', unique=True)
+            if self.dedup_bodies:
+                yield self.items_col.ensure_index('body_hash', sparse=True)
+                # covers _find_unchanged_body query and sort
+                yield self.items_col.ensure_index([('url', pymongo.ASCENDING),
+                                                   ('_id', pymongo.DESCENDING)])
+            for events in [self._items_events, self._jobs_events]:
+                if events is not None:
+                    yield events.open()
 
             job = yield self.jobs_col.find_and_modify({
                 'id': spider.crawl_id,
@@ -107,6 +218,8 @@ class MongoExportPipeline(object):
             }, upsert=True, new=True)
             self.job_id = str(job['_id'])
             spider.motor_job_id = str(self.job_id)
+            if self._jobs_events is not None:
+                self._jobs_events.publish()
             logger.info("Crawl job generated id: %s", self.job_id,
                         extra={'crawler': self.crawler})
 
@@ -115,6 +228,12 @@ class MongoExportPipeline(object):
                                                  self.dump_period * 1000)
                 self._dump_pc.start()
 
+            if self.stats_history is not None:
+                yield self.stats_history.ensure_indexes()
+                self._history_pc = PeriodicCallback(
+                    self.append_stats_history, self.history_period * 1000)
+                self._history_pc.start()
+
         except Exception:
             self.job_id = None
             logger.error(
@@ -126,24 +245,26 @@ class MongoExportPipeline(object):
     @tt_coroutine
     def spider_closed(self, spider, reason, **kwargs):
         self._stop_periodic_tasks()
+        yield self._flush_items()
 
         if self.job_id is None:  # what's this?
-            self.jobs_client.close()
-            self.items_client.close()
+            self._release_clients()
             return
 
         # update the job one more time because something might
         # have happened while the spider is closing
         yield self._update_finished_job(reason)
+        if self.stats_history is not None:
+            yield self.append_stats_history(final=True)
 
-        self.jobs_client.close()
-        self.items_client.close()
+        self._release_clients()
         logger.info("Info is saved for a closed job %s", self.job_id,
                     extra={'crawler': self.crawler})
 
     @tt_coroutine
     def spider_closing(self, spider, reason, **kwargs):
         self._stop_periodic_tasks()
+        yield self._flush_items()
         if self.job_id is None:  # what's this?
             return
         yield self._update_finished_job(reason)
@@ -155,9 +276,24 @@ class MongoExportPipeline(object):
         mongo_item = scrapy_item_to_dict(item)
         if self.job_id_key:
             mongo_item[self.job_id_key] = self.job_id
+        process_body = 'body' in mongo_item and (
+            self.dedup_bodies or self.body_store is not None)
+        if self._inserter is not None:
+            # body is processed concurrently with filling the batch
+            prepare = None
+            if process_body:
+                prepare = lambda: self._process_body(mongo_item)
+            yield self._inserter.put(mongo_item, prepare)
+            raise gen.Return(item)
+        if process_body:
+            yield self._process_body(mongo_item)
         try:
+            start_time = time.time()
             yield self.items_col.insert(mongo_item)
+            if self._latency_histogram is not None:
+                self._latency_histogram.observe(time.time() - start_time)
             self.crawler.stats.inc_value("mongo_export/items_stored_count")
+            self._items_stored(1)
         except Exception as e:
             self.crawler.stats.inc_value("mongo_export/store_error_count")
             self.crawler.stats.inc_value("mongo_export/store_error_count/" +
@@ -167,41 +303,230 @@ class MongoExportPipeline(object):
             })
         raise gen.Return(item)
 
+    @gen.coroutine
+    def _process_body(self, mongo_item):
+        data = to_bytes(mongo_item['body'])
+        key = body_hash(data)
+        if self.dedup_bodies and mongo_item.get('url'):
+            source = yield self._find_unchanged_body(mongo_item, key)
+            self._update_dedup_stats(source is not None, len(data))
+            if source is not None:
+                del mongo_item['body']
+                mongo_item['body_hash'] = key
+                mongo_item['body_length'] = len(data)
+                mongo_item['unchanged_since'] = source
+                return
+        if self.body_store is not None:
+            yield self._store_body(mongo_item, data, key)
+        else:
+            # hash is stored to detect unchanged bodies later
+            mongo_item['body_hash'] = key
+            mongo_item['body_length'] = len(data)
+
+    @gen.coroutine
+    def _find_unchanged_body(self, mongo_item, key):
+        """
+        Return {"job_id": ..., "item_id": ...} of a page with the same
+        body if the latest stored page with the same URL has it;
+        return None otherwise.
+        """
+        try:
+            previous = yield self.items_col.find_one(
+                {'url': mongo_item['url']},
+                {'body_hash': True, 'unchanged_since': True,
+                 self.job_id_key or '_id': True},
+                sort=[('_id', -1)],
+            )
+        except Exception:
+            logger.warning("Error looking up a previous page body",
+                           exc_info=True, extra={'crawler': self.crawler})
+            return
+        if previous is None or previous.get('body_hash') != key:
+            return
+        if previous.get('unchanged_since'):
+            raise gen.Return(previous['unchanged_since'])
+        raise gen.Return({
+            'job_id': previous.get(self.job_id_key) if self.job_id_key else None,
+            'item_id': previous['_id'],
+        })
+
+    def _update_dedup_stats(self, hit, size):
+        stats = self.crawler.stats
+        if hit:
+            stats.inc_value("mongo_export/dedup_hit_count")
+            stats.inc_value("mongo_export/dedup_bytes_saved", size)
+        else:
+            stats.inc_value("mongo_export/dedup_miss_count")
+        hits = stats.get_value("mongo_export/dedup_hit_count", 0)
+        misses = stats.get_value("mongo_export/dedup_miss_count", 0)
+        stats.set_value("mongo_export/dedup_hit_rate",
+                        round(float(hits) / (hits + misses), 4))
+
+    @gen.coroutine
+    def _store_body(self, mongo_item, data, key):
+        """
+        Move item body to the body store. If it can't be stored
+        the body is kept in the item.
+        """
+        stats = self.crawler.stats
+        try:
+            written = yield self.body_store.put(key, data)
+        except Exception as e:
+            stats.inc_value("mongo_export/body_store_error_count")
+            stats.inc_value("mongo_export/body_store_error_count/" +
+                            e.__class__.__name__)
+            logger.error("Error storing item body", exc_info=True, extra={
+                'crawler': self.crawler
+            })
+            return
+        del mongo_item['body']
+        mongo_item['body_hash'] = key
+        mongo_item['body_length'] = len(data)
+        stats.inc_value("mongo_export/body_bytes", len(data))
+        if written:
+            stats.inc_value("mongo_export/bodies_stored_count")
+            stats.inc_value("mongo_export/body_stored_bytes", written)
+
+    def _flush_items(self):
+        if self._inserter is None:
+            return gen.maybe_future(None)
+        return self._inserter.join()
+
     def _update_finished_job(self, reason):
         status = 'finished'
         if reason == 'shutdown':
             status = 'shutdown'
-        return self.jobs_col.update(
-            {'_id': ObjectId(self.job_id)},
-            {'$set': {
-                'finished_at': datetime.datetime.utcnow(),
-                'status': status,
-                'stats': self._get_stats_json(),
-                'stats_dict': self._get_stats_escaped(),
-            }}
-        )
+        return self._update_stats({
+            'finished_at': datetime.datetime.utcnow(),
+            'status': status,
+        })
+
+    def _items_stored(self, count):
+        if self._items_events is not None and count:
+            self._items_events.publish(count)
+
+    def _release_clients(self):
+        # clients are shared, so they are not closed here
+        release_client(self.jobs_client)
+        release_client(self.items_client)
+        if self.body_store is not None:
+            self.body_store.close()
+        for events in [self._items_events, self._jobs_events]:
+            if events is not None:
+                events.close()
+        if self.stats_history is not None:
+            self.stats_history.close()
 
     def _stop_periodic_tasks(self):
-        if self._dump_pc is not None and self._dump_pc.is_running():
-            self._dump_pc.stop()
-
-    def _get_stats_json(self):
-        # json is to fix an issue with dots in key names
-        return json_encode(self.crawler.stats.get_stats())
+        for task in [self._dump_pc, self._history_pc]:
+            if task is not None and task.is_running():
+                task.stop()
 
-    def _get_stats_escaped(self):
-        return replace_dots(copy.deepcopy(self.crawler.stats.get_stats()))
+    @gen.coroutine
+    def append_stats_history(self, final=False):
+        sample = get_sample(self.crawler.stats.get_stats())
+        try:
+            yield self.stats_history.append(self.job_id, time.time(), sample,
+                                            force=final)
+        except Exception:
+            logger.error("Error storing stats history", exc_info=True,
+                         extra={'crawler': self.crawler})
 
     @gen.coroutine
     def dump_stats(self):
-        # json is to fix an issue with dots in key names
-        stats = self._get_stats_json()
-        yield self.jobs_col.update(
-            {'_id': ObjectId(self.job_id)},
-            {'$set': {
-                'stats': stats,
-                'stats_dict': self._get_stats_escaped(),
-            }}
-        )
-        logger.info("Stats are stored for job %s" % self.job_id,
-                    extra={'crawler': self.crawler})
+        updated = yield self._update_stats()
+        if updated:
+            logger.info("Stats are stored for job %s" % self.job_id,
+                        extra={'crawler': self.crawler})
+
+    @gen.coroutine
+    def _update_stats(self, fields=None):
+        """
+        Update changed stats and ``fields`` of the job document.
+        Return False if there was nothing to update.
+        """
+        with (yield self._stats_lock.acquire()):
+            stats = self.crawler.stats.get_stats()
+            update, changed, removed = self._get_stats_update(stats)
+            if fields:
+                update.setdefault('$set', {}).update(fields)
+            if not update:
+                raise gen.Return(False)
+            if self.stats_json:
+                # json is to fix an issue with dots in key names
+                update.setdefault('$set', {})['stats'] = json_encode(stats)
+            try:
+                yield self.jobs_col.update({'_id': ObjectId(self.job_id)},
+                                           update)
+            except Exception:
+                # don't use $inc until all stats are $set again
+                self._dumped_stats = {}
+                self._unsaved_stats_keys = dict(self._stats_keys)
+                raise
+            self._unsaved_stats_keys = {}
+            self._dumped_stats.update(changed)
+            for key in removed:
+                del self._dumped_stats[key]
+            raise gen.Return(True)
+
+    def _get_stats_update(self, stats):
+        """
+        Return a MongoDB update for "stats_dict" field with stats changed
+        since the last update, changed stats and removed stat keys.
+        Integer stats are updated using $inc.
+        """
+        dumped = self._dumped_stats
+        to_set, to_inc, changed = {}, {}, {}
+        for key, value in stats.items():
+            old_value = dumped.get(key, _MISSING)
+            if old_value == value:
+                continue
+            field = self._stats_field(key)
+            if _is_counter(old_value) and _is_counter(value):
+                to_inc[field] = value - old_value
+            elif isinstance(value, dict):
+                to_set[field] = replace_dots(copy.deepcopy(value))
+            else:
+                to_set[field] = value
+            if isinstance(value, (dict, list)):
+                value = copy.deepcopy(value)
+            changed[key] = value
+        removed = [key for key in dumped if key not in stats]
+
+        update = {}
+        if to_set:
+            update['$set'] = to_set
+        if to_inc:
+            update['$inc'] = to_inc
+        if removed:
+            update['$unset'] = {self._stats_field(key): ''
+                                for key in removed}
+        if update and self._unsaved_stats_keys:
+            update.setdefault('$set', {}).update(
+                ('stats_keys.' + name, key)
+                for name, key in self._unsaved_stats_keys.items())
+        return update, changed, removed
+
+    def _stats_field(self, key):
+        # stat keys are escaped once: there are hundreds of them,
+        # but the same keys are updated again and again
+        field = self._stats_fields.get(key)
+        if field is None:
+            name = key.replace('.', '_')
+            used = self._stats_names
+            if name in used:
+                # e.g. "a.b" and "a_b" keys; each needs its own field
+                # for $inc updates to be correct
+                name = next('%s_%d' % (name, i) for i in itertools.count(1)
+                            if '%s_%d' % (name, i) not in used)
+            used.add(name)
+            if name != key:
+                self._stats_keys[name] = key
+                self._unsaved_stats_keys[name] = key
+            field = self._stats_fields[key] = 'stats_dict.' + name
+        return field
+
+
+def _is_counter(value):
+    return (isinstance(value, six.integer_types) and
+            not isinstance(value, bool))
@@ -2,6 +2,9 @@ import logging
 import json
 import sys
 from collections import deque
+from functools import partial
+
+import six
 from tornado import gen
 import tornado.ioloop
 from bson.objectid import ObjectId
@@ -14,7 +17,9 @@ from arachnado.rpc.pages import Pages
 
 from arachnado.crawler_process import agg_stats_changed, CrawlerProcessSignals as CPS
 from arachnado.rpc.ws import RpcWebsocketHandler
+from arachnado.spidermiddlewares.pageitems import truncate_raw_body
 from arachnado.utils.misc import json_encode
+from arachnado.utils.mongo import restore_stats_keys
 
 logger = logging.getLogger(__name__)
 
@@ -62,6 +67,8 @@ class DataRpcWebsocketHandler(RpcWebsocketHandler):
         self.dispatcher = Dispatcher()
         self.dispatcher["cancel_subscription"] = self.cancel_subscription
         self.dispatcher["set_max_message_size"] = self.set_max_message_size
+        self.dispatcher["get_transport_stats"] = self.get_transport_stats
+        self.init_transport(kwargs.get('opts'))
 
     def on_close(self):
         logger.info("connection closed")
@@ -85,6 +92,7 @@ class JobsDataRpcWebsocketHandler(DataRpcWebsocketHandler):
     mongo_id_mapping = None
     job_url_mapping = None
     stored_jobs_stats = None
+    _last_stats_event = None  # (changes, _id, urls, event data)
 
     @gen.coroutine
     def subscribe_to_jobs(self, include=None, exclude=None, update_delay=0, last_job_id=None):
@@ -105,11 +113,19 @@ class JobsDataRpcWebsocketHandler(DataRpcWebsocketHandler):
 
     @gen.coroutine
     def write_event(self, data, aggregate=False):
-        event_data = dict(data)
+        # data is copied only if it is changed: the same object
+        # is usually sent to all clients and encoded only once
+        event_data = data
+        if 'stats' not in event_data and 'stats_dict' in event_data:
+            # jobs store stats as a JSON string only if
+            # MONGO_EXPORT_STATS_JSON is set
+            event_data = dict(event_data,
+                              stats=restore_stats_keys(event_data))
         if 'stats' in event_data:
             if not isinstance(event_data['stats'], dict):
                 try:
-                    event_data['stats'] = json.loads(event_data['stats'])
+                    event_data = dict(event_data,
+                                      stats=json.loads(event_data['stats']))
                 except Exception as ex:
                     logger.warning("Invalid stats field in job {}".format(event_data.get("_id", "MISSING MONGO ID")))
         if aggregate and self.delay_mode:
@@ -118,7 +134,9 @@ class JobsDataRpcWebsocketHandler(DataRpcWebsocketHandler):
                 if item_id in self.stored_jobs_stats:
                     self.stored_jobs_stats[item_id]["stats"].update(event_data["stats"])
                 else:
-                    item = event_data
+                    # stored item is updated later, so it is copied
+                    item = dict(event_data,
+                                stats=dict(event_data.get("stats") or {}))
                     self.stored_jobs_stats[item_id] = item
             else:
                 logger.warning("Job data without _id field from event {}".format(event))
@@ -135,10 +153,16 @@ class JobsDataRpcWebsocketHandler(DataRpcWebsocketHandler):
     def initialize(self, *args, **kwargs):
         super(JobsDataRpcWebsocketHandler, self).initialize(*args, **kwargs)
         self.dispatcher["subscribe_to_jobs"] = self.subscribe_to_jobs
+        self.dispatcher["get_job_stats_history"] = self.get_job_stats_history
         self.mongo_id_mapping = {}
         self.job_url_mapping = {}
         self.stored_jobs_stats = {}
 
+    def get_job_stats_history(self, job_id, start=None, end=None,
+                              resolution=None):
+        jobs = Jobs(self, *self.i_args, **self.i_kwargs)
+        return jobs.get_stats_history(job_id, start, end, resolution)
+
     def on_close(self):
         logger.debug("connection closed")
         if self.cp:
@@ -155,18 +179,31 @@ class JobsDataRpcWebsocketHandler(DataRpcWebsocketHandler):
 
     def on_stats_changed(self, changes, crawler):
         job_id = crawler.spider.crawl_id
-        data = {"stats": changes}
-        # same as crawl_id
-        data["id"] = job_id
-        # mongo id
-        data["_id"] = self.mongo_id_mapping.get(job_id, "")
-        # job url
-        data["urls"] = self.job_url_mapping.get(job_id, "")
         allowed = False
         for storage in self.storages.values():
             allowed = allowed or job_id in storage.job_ids
         if allowed:
-            self.write_event(data, aggregate=True)
+            self.write_event(self._stats_event(changes, job_id),
+                             aggregate=True)
+
+    def _stats_event(self, changes, job_id):
+        # Event data is reused by all clients which have the same job info
+        # (usually all of them), so that it is encoded once.
+        mongo_id = self.mongo_id_mapping.get(job_id, "")
+        urls = self.job_url_mapping.get(job_id, "")
+        cls = JobsDataRpcWebsocketHandler
+        last = cls._last_stats_event
+        if (last is not None and last[0] is changes and
+                last[1] == mongo_id and last[2] == urls):
+            return last[3]
+        data = {
+            "stats": changes,
+            "id": job_id,  # same as crawl_id
+            "_id": mongo_id,
+            "urls": urls,
+        }
+        cls._last_stats_event = changes, mongo_id, urls, data
+        return data
 
     def on_spider_closed(self, spider):
         if self.cp:
@@ -191,29 +228,43 @@ class PagesDataRpcWebsocketHandler(DataRpcWebsocketHandler):
     """ pages API"""
 
     @gen.coroutine
-    def subscribe_to_pages(self, urls=None, url_groups=None):
+    def subscribe_to_pages(self, urls=None, url_groups=None, fields=None,
+                           body_max_length=None):
+        """
+        Subscribe to pages of jobs started for ``urls`` / ``url_groups``.
+
+        ``fields`` is a list of page fields to send (or a MongoDB
+        projection dict); other fields are not fetched from MongoDB.
+        If ``body_max_length`` is set, longer page bodies are truncated.
+        """
+        options = {
+            "fields": body_projection(normalize_projection(fields),
+                                      body_max_length),
+            "body_max_length": body_max_length,
+        }
         result = {
             "datatype": "pages_subscription_id",
             "single_subscription_id": "",
             "id": {},
         }
         if urls:
-            result["single_subscription_id"] = yield self.create_subscribtion_to_urls(urls)
+            result["single_subscription_id"] = yield self.create_subscribtion_to_urls(urls, **options)
         if url_groups:
             res = {}
             for group_id in url_groups:
-                res[group_id] = yield self.create_subscribtion_to_urls(url_groups[group_id])
+                res[group_id] = yield self.create_subscribtion_to_urls(url_groups[group_id], **options)
             result["id"] = res
         if not urls and not url_groups:
-            stor_id, storage = self.add_storage()
+            stor_id, storage = self.add_storage(**options)
             result["single_subscription_id"] = stor_id
-            storage.pages.subscribe(query={})
+            storage.subscribe_to_pages(require_filters=False)
         raise gen.Return(result)
 
     @gen.coroutine
-    def create_subscribtion_to_urls(self, urls):
+    def create_subscribtion_to_urls(self, urls, fields=None, body_max_length=None):
         jobs_to_subscribe = []
-        stor_id, storage = self.add_storage()
+        stor_id, storage = self.add_storage(fields=fields,
+                                            body_max_length=body_max_length)
         result = stor_id
         for url in urls:
             last_id = urls[url]
@@ -249,6 +300,11 @@ class PagesDataRpcWebsocketHandler(DataRpcWebsocketHandler):
     def initialize(self, *args, **kwargs):
         super(PagesDataRpcWebsocketHandler, self).initialize(*args, **kwargs)
         self.dispatcher["subscribe_to_pages"] = self.subscribe_to_pages
+        self.dispatcher["get_page_body"] = self.get_page_body
+
+    def get_page_body(self, body_hash, encoding=None):
+        pages = Pages(self, *self.i_args, **self.i_kwargs)
+        return pages.get_body(body_hash, encoding)
 
     @gen.coroutine
     def job_query_callback(self, data, callback_meta=None):
@@ -260,6 +316,11 @@ class PagesDataRpcWebsocketHandler(DataRpcWebsocketHandler):
             logger.warning("Jobs callback with incomplete data")
 
     def on_pages_tailed(self, data, callback_meta=None):
+        # text bodies are already truncated by MongoDB, see
+        # body_projection; binary bodies can't be cut by it
+        storage = self.storages.get(callback_meta)
+        if storage is not None:
+            data = truncate_raw_body(data, storage.body_max_length)
         self.write_event(data)
 
     def create_jobs_query(self, url):
@@ -268,11 +329,12 @@ class PagesDataRpcWebsocketHandler(DataRpcWebsocketHandler):
         else:
             return {}
 
-    def add_storage(self):
+    def add_storage(self, fields=None, body_max_length=None):
         new_id = str(len(self.storages))
         pages = Pages(self, *self.i_args, **self.i_kwargs)
-        pages.callback = self.on_pages_tailed
-        self.storages[new_id] = DataSubscription(pages)
+        pages.callback = partial(self.on_pages_tailed, callback_meta=new_id)
+        self.storages[new_id] = DataSubscription(
+            pages, fields=fields, body_max_length=body_max_length)
         return new_id, self.storages[new_id]
 
     def cancel_subscription(self, subscription_id):
@@ -286,8 +348,10 @@ class PagesDataRpcWebsocketHandler(DataRpcWebsocketHandler):
 
 class DataSubscription(object):
 
-    def __init__(self, pages_storage=None):
+    def __init__(self, pages_storage=None, fields=None, body_max_length=None):
         self.pages = pages_storage
+        self.fields = fields
+        self.body_max_length = body_max_length
         self.jobs = []
         self.job_ids = set([])
         self.filters = []
@@ -301,11 +365,11 @@ class DataSubscription(object):
     def subscribe_to_pages(self, require_filters=True):
         if self.filters:
             if len(self.filters) == 1:
-                self.pages.subscribe(query=self.filters[0])
+                self.pages.subscribe(query=self.filters[0], fields=self.fields)
             elif len(self.filters) > 1:
-                self.pages.subscribe(query={"$or": self.filters})
+                self.pages.subscribe(query={"$or": self.filters}, fields=self.fields)
         elif not require_filters:
-            self.pages.subscribe(query={})
+            self.pages.subscribe(query={}, fields=self.fields)
         else:
             logger.warning("No subscription - empty filter list")
 
@@ -365,4 +429,91 @@ class DataSubscription(object):
             jobs_q = conditions[0]
         elif len(conditions):
             jobs_q = {"$and": conditions }
-        return jobs_q
\ No newline at end of file
+        return jobs_q
+
+
+def normalize_projection(fields):
+    """
+    Convert a list of field names or a projection dict to a MongoDB
+    projection which always includes ``_id`` (it is required
+    to resume tailing).
+
+    >>> normalize_projection(None)
+    >>> sorted(normalize_projection(['url', 'status']).items())
+    [('_id', True), ('status', True), ('url', True)]
+    >>> normalize_projection({'body': 0, '_id': 0})
+    {'body': 0}
+
+    MongoDB doesn't allow to mix included and excluded fields:
+
+    >>> normalize_projection({'url': 1, 'body': 0})
+    Traceback (most recent call last):
+    ...
+    ValueError: Projection can't both include and exclude fields: {'url': 1, 'body': 0}
+    """
+    if not fields:
+        return None
+    if isinstance(fields, six.string_types):
+        fields = [fields]
+    if isinstance(fields, dict):
+        projection = {key: value for key, value in fields.items()
+                      if key != '_id'}
+        for value in projection.values():
+            if not isinstance(value, (bool, six.integer_types)):
+                raise ValueError("Invalid projection value: %r" % (value,))
+        included = set(bool(value) for value in projection.values())
+        if len(included) > 1:
+            raise ValueError("Projection can't both include and exclude "
+                             "fields: %r" % (fields,))
+        if True in included:
+            projection['_id'] = True
+        return projection
+    projection = {field: True for field in fields}
+    projection['_id'] = True
+    return projection
+
+
+def body_projection(projection, max_length):
+    """
+    Return a projection (see :func:`normalize_projection`) which makes
+    MongoDB truncate text page bodies to ``max_length`` characters,
+    so that full bodies are not transferred; "body_length" and
+    "body_truncated" fields are added to truncated pages. Raw (binary)
+    bodies are truncated after they are fetched, see
+    ``arachnado.spidermiddlewares.pageitems.truncate_raw_body``. Computed
+    fields are handled by MongoTailStorage.find_cursor; they require
+    MongoDB >= 3.6.
+
+    >>> sorted(body_projection({'url': True, '_id': True}, 100).items())
+    [('_id', True), ('url', True)]
+    >>> sorted(body_projection({'body': True, '_id': True}, 100))
+    ['_id', 'body', 'body_length', 'body_truncated']
+    >>> sorted(body_projection(None, 100))
+    ['body', 'body_length', 'body_truncated']
+    >>> body_projection({'body': 0}, 100)
+    {'body': 0}
+    """
+    if not max_length:
+        return projection
+    if max_length < 0 or not isinstance(max_length, six.integer_types):
+        raise ValueError("Invalid body_max_length: %r" % (max_length,))
+    if projection and any(projection.values()):
+        has_body = bool(projection.get('body'))
+    else:
+        has_body = projection is None or 'body' not in projection
+    if not has_body:
+        return projection
+    truncated = {'$and': [
+        {'$eq': [{'$type': '$body'}, 'string']},
+        {'$gt': [{'$strLenCP': '$body'}, max_length]},
+    ]}
+    projection = dict(projection or {})
+    projection.update({
+        'body': {'$cond': [truncated,
+                           {'$substrCP': ['$body', 0, max_length]},
+                           '$body']},
+        'body_length': {'$cond': [truncated, {'$strLenCP': '$body'},
+                                  '$body_length']},
+        'body_truncated': {'$cond': [truncated, True, '$$REMOVE']},
+    })
+    return projection
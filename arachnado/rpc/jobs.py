@@ -1,6 +1,7 @@
 import logging
 
 from arachnado.storages.mongotail import MongoTailStorage
+from arachnado.storages.stats_history import StatsHistoryStorage
 
 
 class Jobs(object):
@@ -12,15 +13,26 @@ class Jobs(object):
     callback = None
     logger = logging.getLogger(__name__)
 
-    def __init__(self, handler, job_storage, **kwargs):
+    def __init__(self, handler, job_storage, stats_history=None, **kwargs):
         self.handler = handler
         self.storage = job_storage  # type: MongoTailStorage
+        self.history_storage = stats_history  # type: StatsHistoryStorage
 
     def subscribe(self, last_id=0, query=None, fields=None):
         """ Subscribe for job updates. """
         self.storage.subscribe('tailed', self._publish, last_id=last_id,
                                query=query, fields=fields)
 
+    def get_stats_history(self, job_id, start=None, end=None,
+                          resolution=None):
+        """
+        Return job stats samples between ``start`` and ``end``
+        (unix timestamps); see StatsHistoryStorage.fetch.
+        """
+        if self.history_storage is None:
+            raise ValueError("Stats history is not enabled")
+        return self.history_storage.fetch(job_id, start, end, resolution)
+
     def _on_close(self):
         self.storage.unsubscribe('tailed')
 
@@ -1,4 +1,6 @@
-from arachnado.storages.mongotail import MongoTailStorage
+from tornado import gen
+
+from arachnado.storages.hub import get_tail_hub
 
 
 class Pages(object):
@@ -6,27 +8,71 @@ class Pages(object):
     handler_id = None
     callback = None
 
-    def __init__(self, handler, item_storage, **kwargs):
+    def __init__(self, handler, item_storage, body_store=None, **kwargs):
         self.handler = handler
-        self.storage = MongoTailStorage(item_storage.mongo_uri,
-                                        item_storage.cache_flag)
+        self.item_storage = item_storage
+        self.body_store = body_store
+        # tails are shared by all Pages objects subscribed to the same query
+        self.hub = get_tail_hub(item_storage)
+        self._subscription_id = None
 
     def subscribe(self, last_id=0, query=None, fields=None, fetch_delay=None):
-        if fetch_delay:
-            self.storage.fetch_delay = fetch_delay
-        self.storage.subscribe('tailed', self._publish, last_id=last_id,
-                               query=query, fields=fields)
+        self.unsubscribe()
+        self._subscription_id = self.hub.subscribe(
+            self._publish, query=query, fields=fields, last_id=last_id,
+            fetch_delay=fetch_delay
+        )
+
+    @gen.coroutine
+    def get_body(self, body_hash, encoding=None):
+        """
+        Return a body of a page which is stored out of line or is not
+        changed since a previous crawl (see "body_hash" field of a page),
+        or None if it is not found. ``encoding`` is "body_encoding"
+        field of a page; it is only set for pages with raw bodies.
+        """
+        encoding = encoding or 'utf8'
+        if self.body_store is not None:
+            body = yield self.body_store.get(body_hash)
+            if body is not None:
+                raise gen.Return(body.decode(encoding, 'replace'))
+        doc = yield self.item_storage.col.find_one(
+            {'body_hash': body_hash, 'body': {'$exists': True}},
+            {'body': True, 'body_encoding': True}
+        )
+        raise gen.Return(body_text(doc) if doc else None)
 
     def _on_close(self):
-        self.storage.unsubscribe('tailed')
+        self.unsubscribe()
 
     def unsubscribe(self):
-        self.storage.unsubscribe('tailed')
+        if self._subscription_id is not None:
+            self.hub.unsubscribe(self._subscription_id)
+            self._subscription_id = None
 
     def _publish(self, data):
         if self.callback:
             _callback = self.callback
         else:
             _callback = self.handler.write_event
-        if self.storage.tailing:
+        if self._subscription_id is not None:
+            if isinstance(data.get('body'), bytes):
+                # the document is shared by all subscribers; don't change it
+                data = dict(data, body=body_text(data))
             _callback(data)
+
+
+def body_text(page):
+    """
+    Return page body as unicode; raw bodies are decoded using
+    "body_encoding" field.
+
+    >>> body_text({'body': b'caf\\xe9', 'body_encoding': 'cp1252'}) == u'caf\\xe9'
+    True
+    >>> body_text({'body': u'text'}) == u'text'
+    True
+    """
+    body = page['body']
+    if isinstance(body, bytes):
+        return body.decode(page.get('body_encoding') or 'utf8', 'replace')
+    return body
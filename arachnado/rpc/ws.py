@@ -8,41 +8,90 @@ from tornado.concurrent import Future
 from tornado.web import RequestHandler
 from tornado import websocket, gen
 
-from arachnado.utils.misc import json_encode
+from arachnado.utils.misc import (
+    json_encode, json_encode_async, approx_doc_size, msgpack,
+    msgpack_encode_async, msgpack_decode, JSON_THREAD_THRESHOLD
+)
 from arachnado.rpc import ArachnadoRPC
+from arachnado.wsbase import WSTransportMixin
 
 
 logger = logging.getLogger(__name__)
 
 
-class RpcWebsocketHandler(ArachnadoRPC, websocket.WebSocketHandler):
+class RpcWebsocketHandler(ArachnadoRPC, WSTransportMixin,
+                          websocket.WebSocketHandler):
     """ JsonRpc router for WS stream.
+
+    Messages are JSON-encoded by default; clients which connect with
+    ``?format=msgpack`` query argument get binary msgpack-encoded messages
+    and may send msgpack-encoded requests.
     """
+    message_format = 'json'
+    _pinger = None
+
+    def initialize(self, *args, **kwargs):
+        super(RpcWebsocketHandler, self).initialize(*args, **kwargs)
+        self.init_transport(kwargs.get('opts'))
+        self.dispatcher["get_transport_stats"] = self.get_transport_stats
 
     def on_message(self, message):
+        self.count_message_in(message)
+        if isinstance(message, bytes) and self.message_format == 'msgpack':
+            try:
+                message = json_encode(msgpack_decode(message))
+            except Exception as e:
+                logger.warning("Invalid msgpack message skipped: %s", e)
+                return
         self.handle_request(message)
 
     def send_data(self, data):
         self.write_event(data)
 
-    @gen.coroutine
     def write_event(self, data, max_message_size=0):
+        """
+        Send ``data`` to the client. Large messages are encoded in a thread,
+        but messages are sent in the order this method is called.
+        """
+        binary = self.message_format == 'msgpack' and not isinstance(
+            data, six.string_types)
+        future = self._encode_event(data, max_message_size)
+        self.write_ordered(future, binary=binary)
+        return future
+
+    @gen.coroutine
+    def _encode_event(self, data, max_message_size):
+        """ Return an encoded message or None if it is too large """
         if isinstance(data, six.string_types):
             message = data
         else:
-            message = json_encode(data)
-        try:
-            if sys.getsizeof(message) < max_message_size or not max_message_size:
-                self.write_message(message)
-            else:
+            # the size is only needed to compare it with these limits
+            limit = max(max_message_size, JSON_THREAD_THRESHOLD)
+            size = approx_doc_size(data, limit=limit)
+            if max_message_size and size > max_message_size:
+                # don't spend time encoding a message which won't be sent
                 logger.info("Message size exceeded. Message wasn't sent.")
-        except websocket.WebSocketClosedError:
-            pass
+                return
+            if self.message_format == 'msgpack':
+                message = yield msgpack_encode_async(data, size)
+            else:
+                message = yield json_encode_async(data, size)
+        if max_message_size and sys.getsizeof(message) >= max_message_size:
+            logger.info("Message size exceeded. Message wasn't sent.")
+            return
+        raise gen.Return(message)
 
     def open(self):
         """ Forward open event to resource objects.
         """
         logger.debug("Connection opened %s", self)
+        self.message_format = self.get_argument('format', 'json')
+        if self.message_format not in {'json', 'msgpack'}:
+            self.close(1003, "Unsupported message format")
+            return
+        if self.message_format == 'msgpack' and msgpack is None:
+            self.close(1003, "msgpack is not installed on the server")
+            return
         for resource in self.rpc_objects:
             if hasattr(resource, '_on_open'):
                 resource._on_open()
@@ -57,4 +106,5 @@ class RpcWebsocketHandler(ArachnadoRPC, websocket.WebSocketHandler):
         for resource in self.rpc_objects:
             if hasattr(resource, '_on_close'):
                 resource._on_close()
-        self._pinger.stop()
+        if self._pinger is not None:
+            self._pinger.stop()
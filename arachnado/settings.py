@@ -5,11 +5,20 @@ Default settings for Arachnado Scrapy spiders.
 
 DEPTH_STATS_VERBOSE = True
 DEPTH_PRIORITY = 1
-SCHEDULER_DISK_QUEUE = 'scrapy.squeues.PickleFifoDiskQueue'
+SCHEDULER_DISK_QUEUE = 'arachnado.squeues.CompactFifoDiskQueue'
 SCHEDULER_MEMORY_QUEUE = 'scrapy.squeues.FifoMemoryQueue'
 LOG_UNSERIALIZABLE_REQUESTS = True
 DISK_QUEUES_ROOT = './.scrapy/jobs'
 
+# Use a Bloom filter instead of a set of fingerprints for duplicate requests;
+# it uses much less memory for large crawls, but a small share of new URLs
+# (DUPEFILTER_BLOOM_ERROR_RATE) is not crawled:
+# DUPEFILTER_CLASS = 'arachnado.dupefilters.BloomDupeFilter'
+DUPEFILTER_BLOOM_INITIAL_CAPACITY = 100000
+DUPEFILTER_BLOOM_ERROR_RATE = 0.001
+# With JOBDIR the filter is also saved every N seconds, not only on close
+DUPEFILTER_BLOOM_SAVE_INTERVAL = 300
+
 # Turn it ON if the goal is to crawl the whole webiste
 # (vs crawling most recent content):
 PREFER_PAGINATION = False
@@ -56,6 +65,8 @@ DOWNLOADER_MIDDLEWARES = {
     'autologin_middleware.AutologinMiddleware': 605,
     'scrapy.downloadermiddlewares.cookies.CookiesMiddleware': None,
     'autologin_middleware.ExposeCookiesMiddleware': 700,
+    'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': None,
+    'arachnado.downloadermiddlewares.httpcache.HttpCacheMiddleware': 900,
 }
 
 ITEM_PIPELINES = {
@@ -66,8 +77,42 @@ EXTENSIONS = {
     'arachnado.extensions.queuesize.QueueSizeExtension': 100,
 }
 
+# Store page bodies as original bytes instead of decoding them
+PAGEITEMS_RAW_BODY = False
+
 MONGO_EXPORT_ENABLED = True
 MONGO_EXPORT_JOBID_KEY = '_job_id'
+# Set MONGO_EXPORT_BATCH_SIZE to a non-zero value to store items
+# using bulk inserts instead of inserting them one-by-one.
+MONGO_EXPORT_BATCH_SIZE = 0
+MONGO_EXPORT_BATCH_MAX_BYTES = 4 * MB
+MONGO_EXPORT_BATCH_LINGER = 1.0  # seconds
+MONGO_EXPORT_BATCH_MAX_PENDING = 0  # default is 4 * MONGO_EXPORT_BATCH_SIZE
+# Set MONGO_EXPORT_BODIES_URI to store page bodies out of line, compressed:
+# either 'mongodb://host/db_name/bucket_name' (GridFS) or a folder path.
+MONGO_EXPORT_BODIES_URI = ''
+MONGO_EXPORT_BODIES_CODEC = 'zlib'  # 'zlib', 'zstd' or 'none'
+# Don't store page bodies which are not changed since the previous crawl
+MONGO_EXPORT_DEDUP_BODIES = False
+# Also store job stats as a JSON string in "stats" field of jobs
+# (in addition to "stats_dict"), for tools which read this field.
+MONGO_EXPORT_STATS_JSON = False
+# Set MONGO_EXPORT_STATS_HISTORY_URI to store time series of job counters
+MONGO_EXPORT_STATS_HISTORY_URI = ''
+MONGO_EXPORT_STATS_HISTORY_PERIOD = 10.0  # seconds
 HTTPCACHE_ENABLED = False
-# This storage is read-only. Responses are stored by PageExport middleware
-HTTPCACHE_STORAGE = 'arachnado.pagecache.mongo.MongoCacheStorage'
+# Use MongoCacheStorage with Scrapy's HttpCacheMiddleware; it is blocking.
+HTTPCACHE_STORAGE = 'arachnado.pagecache.mongo.AsyncMongoCacheStorage'
+# Set to 'scrapy.extensions.httpcache.RFC2616Policy' to revalidate stale
+# responses using conditional requests; pages from the items collection
+# (HTTPCACHE_MONGO_USE_ITEMS) have no freshness headers, so this policy
+# refetches them.
+HTTPCACHE_POLICY = 'scrapy.extensions.httpcache.DummyPolicy'
+# Default is "httpcache" collection in MONGO_EXPORT_ITEMS_URI database
+HTTPCACHE_MONGO_URI = ''
+# Use pages stored by MongoExportPipeline if a response is not cached
+HTTPCACHE_MONGO_USE_ITEMS = True
+# In-memory LRU cache for HTTP cache lookups
+HTTPCACHE_MONGO_LRU_ITEMS = 1000
+HTTPCACHE_MONGO_LRU_BYTES = 64 * MB
+HTTPCACHE_MONGO_NEGATIVE_TTL = 10  # seconds
@@ -8,7 +8,9 @@ from scrapy.linkextractors import LinkExtractor
 from scrapy.http.response.html import HtmlResponse
 from autologin_middleware import link_looks_like_logout
 
-from arachnado.utils.misc import add_scheme_if_missing, get_netloc
+from arachnado.utils.misc import (
+    add_scheme_if_missing, get_netloc, domain_matcher
+)
 
 
 class ArachnadoSpider(scrapy.Spider):
@@ -55,6 +57,8 @@ class CrawlWebsiteSpider(ArachnadoSpider):
     custom_settings = {
         'DEPTH_LIMIT': 10,
     }
+    # link extractor and URL matcher are cached for this allow_domain
+    _extractor_domain = None
 
     def __init__(self, *args, **kwargs):
         super(CrawlWebsiteSpider, self).__init__(*args, **kwargs)
@@ -86,10 +90,24 @@ class CrawlWebsiteSpider(ArachnadoSpider):
 
     @property
     def link_extractor(self):
-        return LinkExtractor(
-            allow_domains=[self.state['allow_domain']],
-            canonicalize=False,
-        )
+        self._update_link_extractor()
+        return self._link_extractor
+
+    @property
+    def url_matcher(self):
+        """ A function which returns True for URLs allowed to crawl """
+        self._update_link_extractor()
+        return self._url_matcher
+
+    def _update_link_extractor(self):
+        allow_domain = self.state['allow_domain']
+        if allow_domain != self._extractor_domain:
+            self._link_extractor = LinkExtractor(
+                allow_domains=[allow_domain],
+                canonicalize=False,
+            )
+            self._url_matcher = domain_matcher([allow_domain])
+            self._extractor_domain = allow_domain
 
     @property
     def get_links(self):
@@ -125,13 +143,13 @@ class CrawlWebsiteSpider(ArachnadoSpider):
 
     def _pagination_urls(self, response):
         import autopager
-        return [url for url in autopager.urls(response)
-                if self.link_extractor.matches(url)]
+        matches = self.url_matcher
+        return [url for url in autopager.urls(response) if matches(url)]
 
     def should_drop_request(self, request):
         if 'allow_domain' not in self.state:  # first request
             return
-        if not self.link_extractor.matches(request.url):
+        if not self.url_matcher(request.url):
             return True
 
 
@@ -1,36 +1,94 @@
 from __future__ import absolute_import
 import logging
 import datetime
+
+import six
 import scrapy
+from bson.binary import Binary
 from scrapy.exceptions import NotConfigured
 
 logger = logging.getLogger(__name__)
 
 
 class PageItemsMiddleware(object):
+    """
+    Replaces scraped items with a single "page" item which contains
+    response data and scraped items.
+
+    By default page body is decoded to unicode. If PAGEITEMS_RAW_BODY
+    is True then body is stored as original bytes (BSON binary)
+    and the encoding of the response is stored in "body_encoding" field;
+    it avoids decoding and re-encoding bodies and uses less memory.
+    """
 
     def __init__(self, crawler):
         if not crawler.settings.getbool('PAGEITEMS_ENABLED', True):
             raise NotConfigured('PAGEITEMS_ENABLED=False')
+        self.raw_body = crawler.settings.getbool('PAGEITEMS_RAW_BODY', False)
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(crawler)
 
     def process_spider_output(self, response, result, spider):
-        result = list(result)
-        items = [r for r in result if isinstance(r, (scrapy.Item, dict))]
-        requests = [r for r in result if isinstance(r, scrapy.Request)]
-        page_item = self.get_page_item(response, items)
-        return [page_item] + requests
+        # Requests are passed through as soon as the spider produces them;
+        # the page item is emitted after the spider callback is finished.
+        items = []
+        for r in result:
+            if isinstance(r, (scrapy.Item, dict)):
+                items.append(r)
+            elif isinstance(r, scrapy.Request):
+                yield r
+        yield self.get_page_item(response, items)
 
     def get_page_item(self, response, items, type_='page'):
-        return {
+        item = {
             'crawled_at': datetime.datetime.utcnow(),
             'url': response.url,
             'status': response.status,
             'headers': response.headers.to_unicode_dict(),
-            'body': response.body_as_unicode(),
             'items': items,
             '_type': type_,
         }
+        if self.raw_body:
+            item['body'] = raw_body(response.body)
+            item['body_encoding'] = getattr(response, 'encoding', None)
+        else:
+            item['body'] = response.text
+        return item
+
+
+def raw_body(body):
+    # Python 3 bytes are stored as BSON binary as-is, without copying;
+    # Python 2 str must be wrapped, otherwise it is stored as a string.
+    if six.PY2:
+        return Binary(body)
+    return body
+
+
+def truncate_raw_body(page, max_length):
+    """
+    Return ``page`` with a raw (binary) body truncated to ``max_length``
+    bytes; "body_length" (the original length) and "body_truncated"
+    fields are added to truncated pages. ``page`` itself is not changed,
+    it can be shared with other subscribers. Text bodies are truncated
+    by MongoDB, see ``arachnado.rpc.data.body_projection``.
+
+    >>> page = {'url': 'http://example.com', 'body': b'0123456789'}
+    >>> truncated = truncate_raw_body(page, 4)
+    >>> truncated['body'] == b'0123', truncated['body_length']
+    (True, 10)
+    >>> truncated['body_truncated'], len(page['body'])
+    (True, 10)
+    >>> truncate_raw_body(page, 10) is page
+    True
+    >>> text_page = {'body': u'text'}
+    >>> truncate_raw_body(text_page, 2) is text_page
+    True
+    """
+    body = page.get('body')
+    if (not max_length or not isinstance(body, six.binary_type) or
+            len(body) <= max_length):
+        return page
+    return dict(page, body=body[:max_length], body_length=len(body),
+                body_truncated=True)
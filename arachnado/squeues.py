@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+Disk queues for Scrapy scheduler.
+
+``CompactFifoDiskQueue`` is a replacement for
+``scrapy.squeues.PickleFifoDiskQueue``: it uses a more compact
+request serialization and stores requests in large memory-mapped
+segment files which are appended to in batches.
+"""
+from __future__ import absolute_import
+import os
+import json
+import mmap
+import struct
+import marshal
+from collections import deque
+
+from six.moves import cPickle as pickle
+from queuelib.queue import FifoDiskQueue as LegacyFifoDiskQueue
+
+from arachnado.utils.misc import replace_file
+
+
+_HEADER = struct.Struct('>L')
+_MISSING = object()
+
+
+class SegmentFifoDiskQueue(object):
+    """
+    Persistent FIFO queue of byte strings.
+
+    Records are stored in append-only segment files of about
+    ``segment_size`` bytes. Pushed records are buffered and written to disk
+    in batches of ``batch_size`` records (or ``batch_bytes`` bytes);
+    records are read from memory-mapped segment files, and a segment file
+    is removed when it is read. If the queue is drained faster than it is
+    filled, records are popped from the write buffer without touching
+    the disk.
+
+    Read and write positions are saved to "segments.json" after each
+    batch (and when a segment is removed): a batch is fsynced, then
+    the positions are replaced atomically. After a crash the queue
+    is reopened in the state of the last saved batch: buffered records
+    are lost, records popped after it are returned again, and a partially
+    written batch is discarded. Records which are not written to disk yet
+    are written when the queue is closed.
+
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> q = SegmentFifoDiskQueue(path)
+    >>> for i in range(3):
+    ...     q.push(str(i).encode('ascii'))
+    >>> len(q)
+    3
+    >>> q.pop() == b'0'
+    True
+    >>> q.close()
+    >>> q = SegmentFifoDiskQueue(path)
+    >>> [q.pop() == v for v in [b'1', b'2']], q.pop(), len(q)
+    ([True, True], None, 0)
+    >>> q.close()
+    >>> os.path.exists(path)
+    False
+    """
+    segment_size = 64 * 1024 * 1024
+    batch_size = 1000
+    batch_bytes = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        info = self._load_info()
+        self.read_segment, self.read_offset = info['read']
+        self.write_segment, write_offset = info['write']
+        self._on_disk = info['size']  # records written and not popped yet
+        self._buffer = deque()
+        self._buffer_bytes = 0
+        self._map = None
+        self._recover(write_offset)
+        self._write_file = self._open_segment(self.write_segment)
+
+    def push(self, data):
+        if not isinstance(data, bytes):
+            raise TypeError("Unsupported type: %s" % type(data).__name__)
+        self._buffer.append(data)
+        self._buffer_bytes += len(data)
+        if (len(self._buffer) >= self.batch_size or
+                self._buffer_bytes >= self.batch_bytes):
+            self.flush()
+
+    def pop(self):
+        if self._on_disk:
+            return self._read()
+        if self._buffer:
+            data = self._buffer.popleft()
+            self._buffer_bytes -= len(data)
+            return data
+
+    def flush(self):
+        """ Write buffered records to disk and save queue positions """
+        if not self._buffer:
+            self._save_info()
+            return
+        parts = []
+        for data in self._buffer:
+            parts.append(_HEADER.pack(len(data)))
+            parts.append(data)
+        f = self._write_file
+        f.write(b''.join(parts))
+        f.flush()
+        os.fsync(f.fileno())
+        self._on_disk += len(self._buffer)
+        self._buffer.clear()
+        self._buffer_bytes = 0
+        if f.tell() >= self.segment_size:
+            f.close()
+            self.write_segment += 1
+            self._write_file = self._open_segment(self.write_segment)
+        self._save_info()
+
+    def close(self):
+        self.flush()
+        self._unmap()
+        self._write_file.close()
+        if not len(self):
+            self._cleanup()
+
+    def __len__(self):
+        return self._on_disk + len(self._buffer)
+
+    def _read(self):
+        while self._map is None or self.read_offset >= len(self._map):
+            self._remap()
+        m, offset = self._map, self.read_offset
+        size, = _HEADER.unpack_from(m, offset)
+        offset += _HEADER.size
+        data = m[offset:offset + size]
+        self.read_offset = offset + size
+        self._on_disk -= 1
+        return data
+
+    def _remap(self):
+        """
+        Map the current read segment again (it may have grown)
+        or switch to the next segment if the current one is read.
+        """
+        self._unmap()
+        path = self._segment_path(self.read_segment)
+        size = os.path.getsize(path)
+        if self.read_offset >= size:
+            if self.read_segment >= self.write_segment:
+                raise IOError("Queue %s is corrupted" % self.path)
+            self.read_segment += 1
+            self.read_offset = 0
+            # the segment is removed only when positions don't refer to it
+            self._save_info()
+            os.remove(path)
+            return
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, 's%05d' % number)
+
+    def _open_segment(self, number):
+        f = open(self._segment_path(number), 'ab')
+        f.seek(0, os.SEEK_END)
+        return f
+
+    def _info_path(self):
+        return os.path.join(self.path, 'segments.json')
+
+    def _load_info(self):
+        path = self._info_path()
+        if not os.path.exists(path):
+            return {'read': [0, 0], 'write': [0, 0], 'size': 0}
+        with open(path) as f:
+            info = json.load(f)
+        if not isinstance(info['write'], list):
+            # saved on close by older versions; segments are complete
+            segment = info['write']
+            path = self._segment_path(segment)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            info['write'] = [segment, size]
+        return info
+
+    def _save_info(self):
+        info = {
+            'read': [self.read_segment, self.read_offset],
+            'write': [self.write_segment, self._write_file.tell()],
+            'size': self._on_disk,
+        }
+        path = self._info_path()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(info, f)
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(tmp_path, path)
+        _fsync_dir(self.path)
+
+    def _recover(self, write_offset):
+        """
+        Remove data which is not referred by saved positions:
+        segments which are read, and records written after
+        the positions were saved.
+        """
+        for name in os.listdir(self.path):
+            if len(name) != 6 or name[0] != 's' or not name[1:].isdigit():
+                continue
+            number = int(name[1:])
+            if number < self.read_segment or number > self.write_segment:
+                os.remove(os.path.join(self.path, name))
+        path = self._segment_path(self.write_segment)
+        if os.path.exists(path) and os.path.getsize(path) > write_offset:
+            with open(path, 'r+b') as f:
+                f.truncate(write_offset)
+
+    def _cleanup(self):
+        for number in range(self.read_segment, self.write_segment + 1):
+            path = self._segment_path(number)
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.exists(self._info_path()):
+            os.remove(self._info_path())
+        if not os.listdir(self.path):
+            os.rmdir(self.path)
+
+
+def _fsync_dir(path):
+    """ Make a rename in ``path`` directory durable (if supported) """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class CompactFifoDiskQueue(SegmentFifoDiskQueue):
+    """
+    SegmentFifoDiskQueue for request dicts, serialized
+    using :func:`compact_dumps`.
+
+    Requests left by ``scrapy.squeues.PickleFifoDiskQueue`` in the same
+    directory (e.g. when a job started by a previous Arachnado version
+    is resumed) are moved to this queue.
+    """
+    def __init__(self, path):
+        super(CompactFifoDiskQueue, self).__init__(path)
+        if os.path.exists(os.path.join(path, 'info.json')):
+            self._import_legacy_queue()
+
+    def push(self, obj):
+        super(CompactFifoDiskQueue, self).push(compact_dumps(obj))
+
+    def pop(self):
+        data = super(CompactFifoDiskQueue, self).pop()
+        if data is not None:
+            return compact_loads(data)
+
+    def _import_legacy_queue(self):
+        legacy = LegacyFifoDiskQueue(self.path)
+        while True:
+            data = legacy.pop()
+            if data is None:
+                break
+            self.push(pickle.loads(data))
+        # legacy files are removed when the queue is closed
+        self.flush()
+        legacy.close()
+
+
+def _request_defaults():
+    # default values of request_to_dict fields
+    return {
+        'callback': None,
+        'errback': None,
+        'method': 'GET',
+        'headers': {},
+        'body': b'',
+        'cookies': {},
+        'meta': {},
+        '_encoding': 'utf-8',
+        'priority': 0,
+        'dont_filter': False,
+        'flags': [],
+    }
+
+
+_REQUEST_DEFAULTS = _request_defaults()
+
+
+def compact_dumps(obj):
+    """
+    Serialize an object; if the object is a request dict
+    (a result of ``scrapy.utils.reqser.request_to_dict``) fields
+    with default values are not stored. marshal is used if possible
+    because it is faster and more compact than pickle; objects which
+    marshal can't serialize (e.g. custom classes in request.meta)
+    are pickled. ValueError is raised for objects which can't be
+    serialized, like in Scrapy queues.
+
+    marshal format may change between Python versions, so queues are
+    not portable between them.
+
+    >>> req = {'url': u'http://example.com', 'method': 'GET', 'body': b'',
+    ...        'meta': {'depth': 1}, 'priority': 0, 'dont_filter': False}
+    >>> data = compact_dumps(req)
+    >>> len(data) < len(pickle.dumps(req, protocol=2))
+    True
+    >>> compact_loads(data) == dict(_request_defaults(), **req)
+    True
+
+    Objects not supported by marshal are pickled:
+
+    >>> import datetime
+    >>> obj = {'date': datetime.date(2016, 1, 1)}
+    >>> data = compact_dumps(obj)
+    >>> data[:1] == b'M', compact_loads(data) == obj
+    (True, True)
+    """
+    kind = b'm'
+    if isinstance(obj, dict) and 'url' in obj:
+        kind = b'r'
+        obj = {key: value for key, value in obj.items()
+               if _REQUEST_DEFAULTS.get(key, _MISSING) != value}
+    try:
+        return kind + marshal.dumps(obj, 2)
+    except ValueError:
+        pass
+    try:
+        return kind.upper() + pickle.dumps(obj, protocol=2)
+    except Exception as e:
+        raise ValueError(str(e))
+
+
+def compact_loads(data):
+    """ Deserialize an object serialized by :func:`compact_dumps` """
+    kind, data = data[:1], data[1:]
+    if kind.islower():
+        obj = marshal.loads(data)
+    else:
+        obj = pickle.loads(data)
+    if kind in (b'r', b'R'):
+        request = _request_defaults()
+        request.update(obj)
+        return request
+    return obj
@@ -7,6 +7,7 @@ var API = require("../utils/ArachnadoAPI");
 
 export var Actions = Reflux.createActions([
     "setAll",
+    "applyDelta",
     "updateStats",
     "startCrawl",
     "stopCrawl",
@@ -18,6 +19,8 @@ export var Actions = Reflux.createActions([
 export var store = Reflux.createStore({
     init: function () {
         this.jobs = [];
+        this.lastSeq = null;
+        this.resyncPending = false;
         this.listenToMany(Actions);
         this.triggerDebounced = debounce(this.trigger, 200);
     },
@@ -28,9 +31,52 @@ export var store = Reflux.createStore({
 
     onSetAll: function (jobs) {
         this.jobs = jobs;
+        this.lastSeq = null;
+        this.resyncPending = false;
         this.triggerDebounced(jobs);
     },
 
+    onApplyDelta: function (delta) {
+        if (this.resyncPending) {
+            // changes are included in the snapshot which is on its way
+            return;
+        }
+        var byId = {};
+        this.jobs.forEach(job => { byId[job.id] = job; });
+        var missed = this.lastSeq !== null && delta.seq !== this.lastSeq + 1;
+        // a partial update for unknown job means we missed its creation
+        missed = missed || delta.jobs.some(update => !update.full && !byId[update.id]);
+        if (missed) {
+            this.resyncPending = true;
+            socket.send("jobs:resync", null);
+            return;
+        }
+        delta.jobs.forEach(update => {
+            var job = byId[update.id];
+            if (update.full) {
+                job = byId[update.id] = update.changes;
+            } else {
+                Object.keys(update.changes).forEach(key => {
+                    if (key == "stats") {
+                        job.stats = Object.assign(job.stats || {}, update.changes.stats);
+                    } else if (key == "stats_removed") {
+                        update.changes.stats_removed.forEach(statKey => {
+                            if (job.stats) { delete job.stats[statKey]; }
+                        });
+                    } else {
+                        job[key] = update.changes[key];
+                    }
+                });
+            }
+            job.version = update.version;
+        });
+        delta.removed.forEach(jobId => { delete byId[jobId]; });
+        var order = delta.order || this.jobs.map(job => job.id);
+        this.jobs = order.filter(jobId => byId[jobId]).map(jobId => byId[jobId]);
+        this.lastSeq = delta.seq;
+        this.triggerDebounced(this.jobs);
+    },
+
     onUpdateStats: function (crawlId, changes) {
         this.jobs.filter(job => job.id == crawlId).forEach(job => {
             job.stats = Object.assign(job.stats || {}, changes);
@@ -61,6 +107,10 @@ socket.on("jobs:state", (jobs) => {
     Actions.setAll(jobs);
 });
 
+socket.on("jobs:delta", (delta) => {
+    Actions.applyDelta(delta);
+});
+
 socket.on("stats:changed", (data) => {
     var [crawlId, changes] = data;
     Actions.updateStats(crawlId, changes);
@@ -1,68 +1,129 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-import functools
+import weakref
 
 from tornado.ioloop import PeriodicCallback
 from scrapy.statscollectors import StatsCollector
 from scrapy.signalmanager import SignalManager
 
 from arachnado.signals import Signal
-from arachnado.utils.misc import decorate_methods
-
-
-def store_changed_value(meth):
-    @functools.wraps(meth)
-    def wrapper(self, key, *args, **kwargs):
-        old_value = self._stats.get(key)
-        meth(self, key, *args, **kwargs)
-        value = self._stats.get(key)
-        if value != old_value:
-            self._changes[key] = value
-    return wrapper
-
-
-def store_changed_stats(meth):
-    @functools.wraps(meth)
-    def wrapper(self, *args, **kwargs):
-        meth(self, *args, **kwargs)
-        self._changes = self._stats
-    return wrapper
 
 
 stats_changed = Signal("stats_changed", False)
+_MISSING = object()
 
 
-@decorate_methods(["set_value", "inc_value", "max_value", "min_value"], store_changed_value)
-@decorate_methods(["set_stats", "clear_stats"], store_changed_stats)
 class EventedStatsCollector(StatsCollector):
     """
     Stats Collector which allows to subscribe to value changes.
-    Update notifications are throttled: interval between updates is no shorter
-    than ``accumulate_time``.
+    Update notifications are sent when ``emit_changes`` is called;
+    a shared :class:`StatsTicker` calls it for all crawlers of a process.
 
     It is assumed that stat keys are never deleted.
-    """
-    accumulate_time = 0.1  # value is in seconds
 
+    Stats methods only mark updated keys as dirty; values which are
+    changed since the previous notification are found when
+    a notification is sent.
+    """
     def __init__(self, crawler):
         super(EventedStatsCollector, self).__init__(crawler)
         self.signals = SignalManager(self)
-        self._changes = {}
-        self._task = PeriodicCallback(self.emit_changes, self.accumulate_time*1000)
-        self._task.start()
+        self._dirty = set()
+        self._emitted = {}  # values sent in previous notifications
+        self._send_all = False
 
         # FIXME: this is ugly
         self.crawler = crawler  # used by ArachnadoCrawlerProcess
 
+    def set_value(self, key, value, spider=None):
+        self._stats[key] = value
+        self._dirty.add(key)
+
+    def inc_value(self, key, count=1, start=0, spider=None):
+        d = self._stats
+        d[key] = d.setdefault(key, start) + count
+        self._dirty.add(key)
+
+    def max_value(self, key, value, spider=None):
+        d = self._stats
+        d[key] = max(d.setdefault(key, value), value)
+        self._dirty.add(key)
+
+    def min_value(self, key, value, spider=None):
+        d = self._stats
+        d[key] = min(d.setdefault(key, value), value)
+        self._dirty.add(key)
+
+    def set_stats(self, stats, spider=None):
+        super(EventedStatsCollector, self).set_stats(stats, spider)
+        self._send_all = True
+
+    def clear_stats(self, spider=None):
+        super(EventedStatsCollector, self).clear_stats(spider)
+        self._send_all = True
+
     def emit_changes(self):
-        if self._changes:
-            changes, self._changes = self._changes, {}
+        changes = self._get_changes()
+        if changes:
             self.signals.send_catch_log(stats_changed, changes=changes)
 
-    def open_spider(self, spider):
-        super(EventedStatsCollector, self).open_spider(spider)
-        self._task.start()
-
-    def close_spider(self, spider, reason):
-        super(EventedStatsCollector, self).close_spider(spider, reason)
-        self._task.stop()
+    def _get_changes(self):
+        stats, emitted = self._stats, self._emitted
+        if self._send_all:
+            # values which were emitted before are removed
+            self._send_all = False
+            emitted = self._emitted = {}
+            changes = dict(stats)
+        else:
+            changes = {}
+            for key in self._dirty:
+                value = stats[key]
+                if emitted.get(key, _MISSING) != value:
+                    changes[key] = value
+        self._dirty = set()
+        emitted.update(changes)
+        return changes
+
+
+class StatsTicker(object):
+    """
+    Calls ``emit_changes`` of all registered stats collectors
+    with a single timer.
+
+    The interval depends on a number of subscribers (e.g. websocket
+    connections which receive stats): it is ``min_interval`` for
+    a single subscriber and grows as a square root of their number,
+    up to ``max_interval``, because each update is sent to every
+    subscriber. Without subscribers changes are not emitted; they are
+    accumulated by collectors until a subscriber appears.
+
+    >>> ticker = StatsTicker()
+    >>> ticker.get_interval(1), ticker.get_interval(4), ticker.get_interval(400)
+    (0.1, 0.2, 1.0)
+    """
+    def __init__(self, min_interval=0.1, max_interval=1.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.subscribers = 0
+        self._collectors = weakref.WeakSet()
+        self._task = PeriodicCallback(self.tick, min_interval*1000)
+
+    def add(self, collector):
+        self._collectors.add(collector)
+
+    def set_subscribers(self, subscribers):
+        self.subscribers = subscribers
+        if not subscribers:
+            self._task.stop()
+            return
+        self._task.callback_time = self.get_interval(subscribers) * 1000
+        if not self._task.is_running():
+            self._task.start()
+
+    def get_interval(self, subscribers):
+        interval = self.min_interval * max(subscribers, 1) ** 0.5
+        return min(round(interval, 3), self.max_interval)
+
+    def tick(self):
+        for collector in list(self._collectors):
+            collector.emit_changes()
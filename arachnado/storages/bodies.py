@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed storages for page bodies.
+
+Page bodies dominate the size of items collection; when a body store
+is configured, MongoExportPipeline stores bodies out of line,
+compressed, and items keep only "body_hash" and "body_length" fields.
+Bodies are addressed by a SHA1 hash of their (uncompressed) content,
+so a body which is seen several times is stored once.
+"""
+from __future__ import absolute_import
+import os
+import zlib
+import errno
+import hashlib
+import logging
+import tempfile
+
+import six
+from six.moves.urllib.parse import urlparse
+import gridfs
+import motor
+import pymongo
+from gridfs.errors import FileExists, NoFile
+from tornado import gen
+
+from arachnado.utils.mongo import motor_from_uri, release_client, client_uri
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without "futures" package
+    ThreadPoolExecutor = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS = {
+    'none': (bytes, bytes),
+    'zlib': (zlib.compress, zlib.decompress),
+}
+if zstandard is not None:
+    CODECS['zstd'] = (_zstd_compress, _zstd_decompress)
+
+
+def compress_body(data, codec):
+    """
+    >>> data = b'<html>' * 10
+    >>> decompress_body(compress_body(data, 'zlib'), 'zlib') == data
+    True
+    """
+    return CODECS[codec][0](data)
+
+
+def decompress_body(data, codec):
+    return CODECS[codec][1](data)
+
+
+def body_hash(data):
+    """
+    Return a key of a body in a body store.
+
+    >>> body_hash(b'<html></html>')
+    '941efb7368e46b27b937d34b07fc4d41da01b002'
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+def to_bytes(body):
+    if isinstance(body, six.text_type):
+        return body.encode('utf8')
+    return body
+
+
+_executor = None
+
+
+@gen.coroutine
+def run_in_thread(func, *args):
+    """
+    Run ``func(*args)`` in a worker thread; return a Future with the result.
+    Bodies are often hundreds of KB, so compression and file I/O would
+    block the event loop shared by all crawlers and websockets.
+    """
+    global _executor
+    if ThreadPoolExecutor is None:
+        raise gen.Return(func(*args))
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2)
+    result = yield _executor.submit(func, *args)
+    raise gen.Return(result)
+
+
+class FileBodyStore(object):
+    """
+    Stores compressed bodies as files in a local directory;
+    a body with hash "abcdef..." is stored at ``root/ab/cd/abcdef....<codec>``.
+    """
+    def __init__(self, root, codec='zlib'):
+        self.root = root
+        self.codec = codec
+
+    def _path(self, key, codec):
+        return os.path.join(self.root, key[:2], key[2:4],
+                            '%s.%s' % (key, codec))
+
+    def _find(self, key):
+        for codec in [self.codec] + sorted(CODECS):
+            path = self._path(key, codec)
+            if os.path.exists(path):
+                return path, codec
+        return None, None
+
+    def exists(self, key):
+        return self._find(key)[0] is not None
+
+    def put_sync(self, key, data):
+        """
+        Store ``data`` under ``key`` unless it is already stored.
+        Return a number of bytes written.
+        """
+        if self.exists(key):
+            return 0
+        path = self._path(key, self.codec)
+        folder = os.path.dirname(path)
+        try:
+            os.makedirs(folder)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        compressed = compress_body(data, self.codec)
+        fd, tmp_path = tempfile.mkstemp(dir=folder)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(compressed)
+        os.rename(tmp_path, path)  # readers never see partial files
+        return len(compressed)
+
+    def get_sync(self, key):
+        """ Return a body or None if it is not stored """
+        path, codec = self._find(key)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return decompress_body(f.read(), codec)
+
+    def put(self, key, data):
+        return run_in_thread(self.put_sync, key, data)
+
+    def get(self, key):
+        return run_in_thread(self.get_sync, key)
+
+    def close(self):
+        pass
+
+
+class GridFSBodyStore(object):
+    """
+    Stores compressed bodies in GridFS; file ids are body hashes and
+    a codec is stored in "codec" metadata field.
+
+    ``uri`` is a MongoDB URI like ``mongodb://host/db_name/bucket_name``.
+    Coroutine methods (:meth:`put`, :meth:`get`) use Motor;
+    ``*_sync`` methods use pymongo and are meant to be used from
+    Scrapy components which are not asynchronous.
+    """
+    def __init__(self, uri, codec='zlib'):
+        self.uri = uri
+        self.codec = codec
+        self._motor = None
+        self._sync = None
+
+    def _motor_fs(self):
+        if self._motor is None:
+            client, _, db, bucket, _ = motor_from_uri(self.uri)
+            self._motor = client, motor.MotorGridFS(db, bucket)
+        return self._motor[1]
+
+    def _sync_fs(self):
+        if self._sync is None:
+            client = pymongo.MongoClient(client_uri(self.uri))
+            db_name, bucket = urlparse(self.uri).path.split('/')[1:]
+            self._sync = client, gridfs.GridFS(client[db_name], bucket)
+        return self._sync[1]
+
+    @gen.coroutine
+    def put(self, key, data):
+        compressed = yield run_in_thread(compress_body, data, self.codec)
+        try:
+            yield self._motor_fs().put(compressed, _id=key, codec=self.codec)
+        except FileExists:
+            raise gen.Return(0)  # already stored
+        raise gen.Return(len(compressed))
+
+    @gen.coroutine
+    def get(self, key):
+        try:
+            grid_out = yield self._motor_fs().get(key)
+        except NoFile:
+            raise gen.Return(None)
+        data = yield grid_out.read()
+        body = yield run_in_thread(decompress_body, data, grid_out.codec)
+        raise gen.Return(body)
+
+    def exists(self, key):
+        return self._sync_fs().exists(key)
+
+    def put_sync(self, key, data):
+        fs = self._sync_fs()
+        if fs.exists(key):
+            return 0
+        compressed = compress_body(data, self.codec)
+        try:
+            fs.put(compressed, _id=key, codec=self.codec)
+        except FileExists:
+            return 0
+        return len(compressed)
+
+    def get_sync(self, key):
+        try:
+            grid_out = self._sync_fs().get(key)
+        except NoFile:
+            return None
+        return decompress_body(grid_out.read(), grid_out.codec)
+
+    def close(self):
+        if self._motor is not None:
+            release_client(self._motor[0])
+            self._motor = None
+        if self._sync is not None:
+            self._sync[0].close()
+            self._sync = None
+
+
+def body_store_from_uri(uri, codec='zlib'):
+    """
+    Return a body store for ``uri``: ``mongodb://host/db_name/bucket_name``
+    for GridFS, ``file:///path/to/folder`` or a plain path for local files.
+    Return None if ``uri`` is empty.
+    """
+    if not uri:
+        return None
+    if codec not in CODECS:
+        raise ValueError("Unsupported body codec: %r" % codec)
+    if uri.startswith('mongodb://'):
+        return GridFSBodyStore(uri, codec)
+    if uri.startswith('file://'):
+        uri = urlparse(uri).path
+    return FileBodyStore(os.path.expanduser(uri), codec)
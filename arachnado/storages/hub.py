@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Process-level fan-out of tailed MongoDB queries.
+"""
+from __future__ import absolute_import
+import copy
+import json
+import logging
+import itertools
+
+import six
+from tornado import gen
+from bson.objectid import ObjectId
+
+from arachnado.storages.mongotail import MongoTailStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+class TailHub(object):
+    """
+    Subscription hub for tailed queries. Only one MongoTailStorage
+    (i.e. one tailing cursor) is used for each distinct (query, fields)
+    pair; each document is multicast to all subscribers of the query.
+
+    Each subscriber keeps its own replay position: it receives documents
+    with ``_id`` greater than its ``last_id``. Subscribers which join
+    a running tail with an older position get older documents from
+    a separate catch-up query.
+
+    A tail sends documents with the largest ``fetch_delay`` requested
+    by its current subscribers.
+    """
+    def __init__(self, mongo_uri, cache=False, events_uri=None):
+        self.mongo_uri = mongo_uri
+        self.cache = cache
+        self.events_uri = events_uri
+        self._tails = {}
+        self._subscribers = {}
+        self._ids = itertools.count()
+
+    def subscribe(self, callback, query=None, fields=None, last_id=None,
+                  fetch_delay=None):
+        """
+        Subscribe ``callback`` to documents matching ``query``.
+        Return a subscription id which should be passed
+        to :meth:`unsubscribe`.
+        """
+        query, last_id = split_last_id(query, last_id)
+        key = query_key(query, fields)
+        tail = self._tails.get(key)
+        subscriber = _Subscriber(next(self._ids), callback, last_id,
+                                 fetch_delay)
+        if tail is None:
+            storage = MongoTailStorage(self.mongo_uri, self.cache,
+                                       self.events_uri)
+            tail = self._tails[key] = _SharedTail(key, storage, query, fields)
+            tail.subscribers[subscriber.id] = subscriber
+            tail.start(last_id)
+        else:
+            tail.subscribers[subscriber.id] = subscriber
+            tail.catch_up(subscriber)
+        tail.update_fetch_delay()
+        self._subscribers[subscriber.id] = tail
+        return subscriber.id
+
+    def unsubscribe(self, subscription_id):
+        tail = self._subscribers.pop(subscription_id, None)
+        if tail is None:
+            return
+        tail.subscribers.pop(subscription_id, None)
+        if not tail.subscribers:
+            tail.stop()
+            del self._tails[tail.key]
+        else:
+            tail.update_fetch_delay()
+
+    def get_stats(self):
+        return {
+            'tails_count': len(self._tails),
+            'subscribers_count': len(self._subscribers),
+        }
+
+
+class _Subscriber(object):
+    def __init__(self, id, callback, last_id, fetch_delay=None):
+        self.id = id
+        self.callback = callback
+        self.last_id = last_id
+        self.fetch_delay = fetch_delay or 0
+        self.pending = None  # documents received during a catch-up
+
+    def send(self, doc):
+        if self.pending is not None:
+            self.pending.append(doc)
+            return
+        if self.last_id is not None and doc['_id'] <= self.last_id:
+            return
+        self.last_id = doc['_id']
+        try:
+            self.callback(doc)
+        except Exception:
+            logger.error("Error in a tailed query subscriber", exc_info=True)
+
+
+class _SharedTail(object):
+    def __init__(self, key, storage, query, fields):
+        self.key = key
+        self.storage = storage
+        self.query = query
+        self.fields = fields
+        self.subscribers = {}
+        self.start_id = None
+        self.position = None
+
+    def start(self, last_id):
+        self.start_id = last_id
+        self.storage.subscribe('tailed', self._on_document, last_id=last_id,
+                               query=copy.deepcopy(self.query),
+                               fields=self.fields)
+
+    def stop(self):
+        self.storage.unsubscribe('tailed')
+        self.storage.close()
+
+    def update_fetch_delay(self):
+        self.storage.fetch_delay = max(
+            [s.fetch_delay for s in self.subscribers.values()] or [0])
+
+    def _on_document(self, data):
+        self.position = data['_id']
+        for subscriber in list(self.subscribers.values()):
+            subscriber.send(data)
+
+    @gen.coroutine
+    def catch_up(self, subscriber):
+        """
+        Send ``subscriber`` the documents which were sent before
+        it joined. Sending stops if it unsubscribes meanwhile.
+        """
+        upper = self.position if self.position is not None else self.start_id
+        if upper is None:
+            return  # the tail hasn't sent anything yet
+        if subscriber.last_id is not None and subscriber.last_id >= upper:
+            return
+        subscriber.pending = []
+        conditions = [self.storage._objectify(copy.deepcopy(self.query)),
+                      {'_id': {'$lte': upper}}]
+        if subscriber.last_id is not None:
+            conditions.append({'_id': {'$gt': subscriber.last_id}})
+        try:
+            cursor = self.storage.find_cursor({'$and': conditions},
+                                              self.fields, sort_by_id=True)
+            while (yield cursor.fetch_next):
+                if not self._is_subscribed(subscriber):
+                    return
+                doc = cursor.next_object()
+                subscriber.last_id = doc['_id']
+                subscriber.callback(doc)
+        except Exception:
+            logger.error("Error replaying a tailed query", exc_info=True)
+        finally:
+            pending, subscriber.pending = subscriber.pending, None
+            for doc in pending:
+                if not self._is_subscribed(subscriber):
+                    break
+                subscriber.send(doc)
+
+    def _is_subscribed(self, subscriber):
+        return self.subscribers.get(subscriber.id) is subscriber
+
+
+def split_last_id(query, last_id=None):
+    """
+    Move ``{"_id": {"$gt": last_id}}`` condition out of a query,
+    so that queries which differ only in a replay position
+    can share a cursor.
+
+    >>> split_last_id({'$and': [{'_job_id': '1'},
+    ...                         {'_id': {'$gt': '5749d89da8cb9c1f286e3a90'}}]})
+    ({'_job_id': '1'}, ObjectId('5749d89da8cb9c1f286e3a90'))
+    >>> split_last_id({'_job_id': '1'}, 0)
+    ({'_job_id': '1'}, None)
+    >>> split_last_id(None)
+    ({}, None)
+    """
+    query = query or {}
+    last_id = _to_object_id(last_id)
+    conditions = query.get('$and') if len(query) == 1 else None
+    if conditions is None:
+        conditions = [query]
+    rest = []
+    for condition in conditions:
+        gt = _gt_id(condition)
+        if gt is None:
+            rest.append(condition)
+        elif last_id is None or gt > last_id:
+            last_id = gt
+    if len(rest) == len(conditions):
+        return query, last_id
+    if len(rest) == 0:
+        return {}, last_id
+    if len(rest) == 1:
+        return rest[0], last_id
+    return {'$and': rest}, last_id
+
+
+def query_key(query, fields=None):
+    """
+    Return a string which identifies a query.
+
+    >>> query_key({'b': 1, 'a': [2]}) == query_key({'a': [2], 'b': 1})
+    True
+    """
+    return json.dumps([query, fields], sort_keys=True, default=str)
+
+
+def _gt_id(condition):
+    if list(condition.keys()) != ['_id']:
+        return None
+    value = condition['_id']
+    if not isinstance(value, dict) or list(value.keys()) != ['$gt']:
+        return None
+    return _to_object_id(value['$gt'])
+
+
+def _to_object_id(value):
+    if not value:
+        return None
+    if isinstance(value, six.string_types):
+        if value.startswith('ObjectId('):
+            value = value[9:-1]
+        return ObjectId(value)
+    return value
+
+
+_HUBS = {}
+
+
+def get_tail_hub(storage):
+    """ Return a shared TailHub for a MongoTailStorage collection """
+    key = storage.mongo_uri, storage.events_uri
+    if key not in _HUBS:
+        _HUBS[key] = TailHub(storage.mongo_uri, storage.cache_flag,
+                             storage.events_uri)
+    return _HUBS[key]
@@ -5,7 +5,7 @@ from tornado.gen import coroutine, Return
 from bson.objectid import ObjectId
 from scrapy.signalmanager import SignalManager
 
-from arachnado.utils.mongo import motor_from_uri, replace_dots
+from arachnado.utils.mongo import motor_from_uri, release_client, replace_dots
 
 
 class MongoStorage(object):
@@ -16,7 +16,7 @@ class MongoStorage(object):
     """
     def __init__(self, mongo_uri, cache=False):
         self.mongo_uri = mongo_uri
-        _, _, _, _, self.col = motor_from_uri(mongo_uri)
+        self.client, _, _, _, self.col = motor_from_uri(mongo_uri)
         self.signal_manager = SignalManager()
         # Used for unsubscribe
         # disconnect() requires reference to original callback
@@ -65,6 +65,12 @@ class MongoStorage(object):
                 # FIXME: when can it happen?
                 pass
 
+    def close(self):
+        """ Release MongoDB client used by this storage """
+        if self.client is not None:
+            release_client(self.client)
+            self.client = None
+
     @property
     def available_events(self):
         return list(self.signals.keys())
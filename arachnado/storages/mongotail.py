@@ -1,18 +1,36 @@
 import six
 from bson.objectid import ObjectId
 from tornado.gen import sleep, coroutine
+from tornado.ioloop import IOLoop
 
 from arachnado.storages.mongo import MongoStorage
+from arachnado.storages.notifier import acquire_notifier, release_notifier
 
 
 class MongoTailStorage(MongoStorage):
     """
     This MongoStorage subclass allows to subscribe to a mongo query.
+
+    When there are no new results the query is re-executed after
+    ``poll_interval`` seconds. If MongoDB can push notifications about
+    new documents (see :class:`arachnado.storages.notifier.ChangeNotifier`)
+    the query is re-executed when a notification arrives, but not more
+    often than once per ``poll_interval`` seconds (notifications are sent
+    for all new documents in a collection, not only for those which
+    match the query), and only once per ``idle_poll_interval`` seconds
+    when there are no notifications.
+
+    ``fields`` projection may contain computed fields (aggregation
+    expressions, e.g. a truncated page body); such queries are executed
+    using the aggregation framework, see :meth:`find_cursor`.
     """
     fetch_delay = 0
+    poll_interval = 1
+    idle_poll_interval = 30
 
-    def __init__(self, mongo_uri, *args, **kwargs):
-        super(MongoTailStorage, self).__init__(mongo_uri, *args, **kwargs)
+    def __init__(self, mongo_uri, cache=False, events_uri=None):
+        super(MongoTailStorage, self).__init__(mongo_uri, cache)
+        self.events_uri = events_uri
         self.tailing = False
         self.signals['tailed'] = object()
 
@@ -55,24 +73,69 @@ class MongoTailStorage(MongoStorage):
                 else:
                     return {'$and': [{'_id': {'$gt': last_object_id}}, query]}
 
-        cursor = self.col.find(tail_query(), fields)
-
-        while self.tailing:
-            if (yield cursor.fetch_next):
-                doc = cursor.next_object()
-                self.signal_manager.send_catch_log(
-                    self.signals['tailed'], data=doc
-                )
-                last_object_id = doc['_id']
-                if self.fetch_delay:
-                    yield sleep(self.fetch_delay)
-            else:
-                yield sleep(1)
-                cursor = self.col.find(tail_query(), fields)
+        notifier = acquire_notifier(self.mongo_uri, self.events_uri)
+        # notifications which arrive after this point are not lost,
+        # even if they arrive while documents are being sent
+        generation = notifier.generation
+        queried_at = IOLoop.current().time()
+        cursor = self.find_cursor(tail_query(), fields)
+
+        try:
+            while self.tailing:
+                if (yield cursor.fetch_next):
+                    doc = cursor.next_object()
+                    self.signal_manager.send_catch_log(
+                        self.signals['tailed'], data=doc
+                    )
+                    last_object_id = doc['_id']
+                    if self.fetch_delay:
+                        yield sleep(self.fetch_delay)
+                else:
+                    if notifier.active:
+                        yield notifier.wait(self.idle_poll_interval,
+                                            generation)
+                        delay = (queried_at + self.poll_interval -
+                                 IOLoop.current().time())
+                        if delay > 0:
+                            yield sleep(delay)
+                    else:
+                        yield sleep(self.poll_interval)
+                    generation = notifier.generation
+                    queried_at = IOLoop.current().time()
+                    cursor = self.find_cursor(tail_query(), fields)
+        finally:
+            release_notifier(notifier)
 
     def untail(self):
         self.tailing = False
 
+    def find_cursor(self, query, fields=None, sort_by_id=False):
+        """
+        Return a cursor for ``query``. Values of ``fields`` projection
+        which are dicts are computed fields; a query with computed fields
+        is executed as an aggregation, so that e.g. large values can be
+        cut by MongoDB instead of being transferred.
+        """
+        computed = {key: value for key, value in (fields or {}).items()
+                    if isinstance(value, dict)}
+        if not computed:
+            cursor = self.col.find(query, fields)
+            if sort_by_id:
+                cursor.sort('_id', 1)
+            return cursor
+        plain = {key: value for key, value in fields.items()
+                 if key not in computed}
+        pipeline = [{'$match': query}]
+        if sort_by_id:
+            pipeline.append({'$sort': {'_id': 1}})
+        if any(plain.values()):  # inclusion projection
+            pipeline.append({'$project': dict(plain, **computed)})
+        else:
+            if plain:
+                pipeline.append({'$project': plain})
+            pipeline.append({'$addFields': computed})
+        return self.col.aggregate(pipeline, cursor={})
+
     def _objectify(self, query):
         ''' Convert ObjectID strings to actual ObjectID in ``query``. '''
 
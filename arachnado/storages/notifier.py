@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Push notifications about new MongoDB documents for MongoTailStorage.
+"""
+from __future__ import absolute_import
+import logging
+import datetime
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+from bson.objectid import ObjectId
+from pymongo.errors import CollectionInvalid
+
+from arachnado.utils.mongo import motor_from_uri, release_client
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeNotifier(object):
+    """
+    Wakes up tailing storages when new documents are inserted to
+    a collection, so that they don't have to poll MongoDB.
+
+    Two push backends are tried, in order:
+
+    * MongoDB change streams, if both the driver (Motor >= 1.2, which
+      has ``watch``) and the server (a MongoDB >= 3.6 replica set)
+      support them;
+    * a tailable cursor on a capped "events" collection
+      (see ``MONGO_EXPORT_EVENTS_URI`` option of MongoExportPipeline).
+
+    If none of them works :attr:`active` is False and storages
+    should keep polling. If none of them is available at all (old Motor
+    and no events collection) the notifier doesn't try them again;
+    otherwise it retries with an increasing delay, up to
+    ``max_retry_delay`` seconds.
+
+    Wake-ups are coalesced: waiters are notified at most once
+    per ``notify_delay`` seconds. :attr:`generation` is incremented
+    on each notification; pass its value read before a query to
+    :meth:`wait`, so that notifications which arrived while the query
+    was running are not lost. Notifications are not filtered by query,
+    so storages shouldn't re-query more often than they'd poll.
+    """
+    notify_delay = 0.05
+    retry_delay = 10
+    max_retry_delay = 300
+
+    def __init__(self, mongo_uri, events_uri=None):
+        self.mongo_uri = mongo_uri
+        self.events_uri = events_uri
+        self.mode = None
+        self.refs = 0
+        self.generation = 0
+        self._cond = Condition()
+        self._notify_scheduled = False
+        self._running = False
+        self._unavailable = False
+        self._was_active = False
+        self._cursor = None
+
+    @property
+    def active(self):
+        return self.mode is not None
+
+    def wait(self, timeout, generation=None):
+        """
+        Return a Future which is resolved when new documents arrive or
+        when ``timeout`` seconds pass. If ``generation`` is passed and
+        there were notifications since it was read, the Future is
+        resolved immediately.
+        """
+        if generation is not None and generation != self.generation:
+            return gen.maybe_future(True)
+        return self._cond.wait(timeout=datetime.timedelta(seconds=timeout))
+
+    def start(self):
+        if not self._running and not self._unavailable:
+            self._running = True
+            IOLoop.current().add_callback(self._run)
+
+    def stop(self):
+        self._running = False
+        self.mode = None
+        # wake up the change stream or the tailable cursor
+        # so that _run can exit and release the client
+        cursor, self._cursor = self._cursor, None
+        if cursor is not None:
+            IOLoop.current().add_callback(cursor.close)
+
+    @gen.coroutine
+    def _run(self):
+        client, _, _, col_name, col = motor_from_uri(self.mongo_uri)
+        try:
+            if not hasattr(col, 'watch') and not self.events_uri:
+                logger.debug("No push notifications for %s: change streams "
+                             "are not supported by Motor and events "
+                             "collection is not set", self.mongo_uri)
+                self._running = False
+                self._unavailable = True
+                return
+            retry_delay = self.retry_delay
+            while self._running:
+                self._was_active = False
+                yield self._watch_change_stream(col)
+                if self._running and self.events_uri:
+                    yield self._tail_events(col_name)
+                self.mode = None
+                if self._was_active:
+                    retry_delay = self.retry_delay
+                if self._running:
+                    yield gen.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, self.max_retry_delay)
+        finally:
+            release_client(client)
+
+    @gen.coroutine
+    def _watch_change_stream(self, col):
+        if not hasattr(col, 'watch'):
+            return
+        try:
+            # documents themselves are not needed, only resume tokens
+            stream = self._cursor = col.watch([
+                {'$match': {'operationType': 'insert'}},
+                {'$project': {'_id': 1}},
+            ])
+            self._set_mode('change_stream')
+            while self._running:
+                yield stream.next()
+                self._notify()
+        except Exception as e:
+            if self._running:
+                logger.debug("Change streams are not available for %s: %s",
+                             self.mongo_uri, e)
+        finally:
+            self.mode = None
+            self._cursor = None
+
+    @gen.coroutine
+    def _tail_events(self, col_name):
+        client, _, _, _, events_col = motor_from_uri(self.events_uri)
+        try:
+            query = {
+                'col': col_name,
+                '_id': {'$gt': ObjectId.from_datetime(
+                    datetime.datetime.utcnow())},
+            }
+            while self._running:
+                cursor = self._cursor = events_col.find(
+                    query, tailable=True, await_data=True)
+                self._set_mode('capped_collection')
+                while self._running and cursor.alive:
+                    if (yield cursor.fetch_next):
+                        doc = cursor.next_object()
+                        query['_id'] = {'$gt': doc['_id']}
+                        self._notify()
+                # tailable cursor dies e.g. if the collection is empty
+                yield gen.sleep(1)
+        except Exception as e:
+            if self._running:
+                logger.warning("Can't tail events collection %s: %s",
+                               self.events_uri, e)
+        finally:
+            self.mode = None
+            self._cursor = None
+            release_client(client)
+
+    def _set_mode(self, mode):
+        self.mode = mode
+        self._was_active = True
+
+    def _notify(self):
+        self.generation += 1
+        if not self._notify_scheduled:
+            self._notify_scheduled = True
+            IOLoop.current().call_later(self.notify_delay, self._notify_all)
+
+    def _notify_all(self):
+        self._notify_scheduled = False
+        self._cond.notify_all()
+
+
+class EventPublisher(object):
+    """
+    Writes "new documents" events for collection ``col_name`` to a capped
+    collection at ``events_uri``; ChangeNotifier tails these events when
+    change streams are not available.
+
+    Events are throttled: several :meth:`publish` calls made within
+    ``delay`` seconds produce a single event.
+    """
+    def __init__(self, events_uri, col_name, size=1024*1024, delay=0.1):
+        self.events_uri = events_uri
+        self.col_name = col_name
+        self.size = size
+        self.delay = delay
+        self.client, _, self.db, self.events_col_name, self.events_col = \
+            motor_from_uri(events_uri)
+        self._count = 0
+        self._timeout = None
+
+    @gen.coroutine
+    def open(self):
+        """ Create the capped collection if it doesn't exist yet """
+        names = yield self.db.collection_names()
+        if self.events_col_name not in names:
+            try:
+                yield self.db.create_collection(self.events_col_name,
+                                                capped=True, size=self.size)
+            except CollectionInvalid:
+                pass  # created concurrently
+
+    def publish(self, count=1):
+        self._count += count
+        if self._timeout is None:
+            self._timeout = IOLoop.current().call_later(self.delay,
+                                                        self._write)
+
+    @gen.coroutine
+    def close(self):
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            yield self._write()
+        release_client(self.client)
+
+    @gen.coroutine
+    def _write(self):
+        self._timeout = None
+        count, self._count = self._count, 0
+        try:
+            yield self.events_col.insert({'col': self.col_name,
+                                          'count': count})
+        except Exception:
+            logger.warning("Error writing event to %s", self.events_uri,
+                           exc_info=True)
+
+
+_NOTIFIERS = {}
+
+
+def acquire_notifier(mongo_uri, events_uri=None):
+    """
+    Return a shared ChangeNotifier for a collection; start it if needed.
+    """
+    key = mongo_uri, events_uri
+    notifier = _NOTIFIERS.get(key)
+    if notifier is None:
+        notifier = _NOTIFIERS[key] = ChangeNotifier(mongo_uri, events_uri)
+    notifier.refs += 1
+    notifier.start()
+    return notifier
+
+
+def release_notifier(notifier):
+    """ Stop a notifier if it is no longer used. """
+    notifier.refs -= 1
+    if notifier.refs <= 0:
+        notifier.stop()
+        _NOTIFIERS.pop((notifier.mongo_uri, notifier.events_uri), None)
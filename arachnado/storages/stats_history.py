@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Time series of job stats.
+
+Samples of job counters are stored in MongoDB "buckets": each document
+holds up to ``bucket_points`` samples of a job at a single resolution.
+Samples are written at several resolutions
+(see ``StatsHistoryStorage.levels``); fine-grained buckets expire,
+coarse ones are kept, so older data is available downsampled.
+"""
+from __future__ import absolute_import, division
+import time
+import datetime
+
+from tornado import gen
+
+from arachnado.utils.mongo import motor_from_uri, release_client
+
+
+# sample field -> a function which gets its value from job stats
+SAMPLE_FIELDS = [
+    ('pages', lambda stats: stats.get('response_received_count', 0)),
+    ('items', lambda stats: stats.get('item_scraped_count', 0)),
+    ('bytes', lambda stats: stats.get('downloader/response_bytes', 0)),
+    ('errors', lambda stats: stats.get('log_count/ERROR', 0)),
+    ('queue', lambda stats: (stats.get('scheduler/enqueued', 0) -
+                             stats.get('scheduler/dequeued', 0))),
+]
+
+
+def get_sample(stats):
+    """
+    Return a list of sample values for job stats, in SAMPLE_FIELDS order.
+
+    >>> get_sample({'response_received_count': 10, 'scheduler/enqueued': 15,
+    ...             'scheduler/dequeued': 12})
+    [10, 0, 0, 0, 3]
+    """
+    return [get_value(stats) for _, get_value in SAMPLE_FIELDS]
+
+
+class StatsHistoryStorage(object):
+    """
+    Storage for time series of job stats samples.
+
+    Counters (pages, items, bytes, errors) are cumulative, so rates
+    (e.g. pages/s) are computed as differences between samples;
+    this works the same way for downsampled data.
+    """
+    # (resolution, retention) in seconds; None means "keep forever"
+    levels = ((10, 2 * 24 * 3600), (300, None))
+    bucket_points = 360
+    max_points = 1000
+
+    def __init__(self, mongo_uri):
+        self.mongo_uri = mongo_uri
+        self.client, _, _, _, self.col = motor_from_uri(mongo_uri)
+        self._last_slot = {}  # (job_id, resolution) -> last time slot
+
+    @gen.coroutine
+    def ensure_indexes(self):
+        yield self.col.ensure_index([('job_id', 1), ('res', 1),
+                                     ('start', 1)])
+        yield self.col.ensure_index('expire_at', expireAfterSeconds=0)
+
+    @gen.coroutine
+    def append(self, job_id, timestamp, sample, force=False):
+        """
+        Store a sample (a list of values in SAMPLE_FIELDS order) for a job.
+        A sample is written only to resolutions it starts a new
+        time slot for, unless ``force`` is True (e.g. for the last sample
+        of a job).
+        """
+        futures = []
+        for resolution, retention in self.levels:
+            slot = int(timestamp // resolution)
+            key = job_id, resolution
+            if self._last_slot.get(key) == slot and not force:
+                continue
+            self._last_slot[key] = slot
+            futures.append(self._push(job_id, resolution, retention,
+                                      timestamp, sample))
+        yield futures
+
+    @gen.coroutine
+    def fetch(self, job_id, start=None, end=None, resolution=None):
+        """
+        Return job samples between ``start`` and ``end`` (unix timestamps)
+        as a dict with "fields", "resolution" and "points" keys; each point
+        is a list ``[timestamp, value1, value2, ...]``.
+
+        If ``resolution`` is not set, the finest resolution which has
+        data for ``start`` and gives at most ``max_points`` points is used;
+        otherwise it must be one of the resolutions from ``levels``.
+        """
+        end = end if end is not None else time.time()
+        start = start if start is not None else 0
+        if resolution is None:
+            resolution = self._choose_resolution(start, end)
+        elif resolution not in [res for res, _ in self.levels]:
+            raise ValueError("Invalid resolution: %r (available: %s)" % (
+                resolution, ', '.join(str(res) for res, _ in self.levels)))
+        span = resolution * self.bucket_points
+        cursor = self.col.find({
+            'job_id': job_id,
+            'res': resolution,
+            'start': {'$gt': start - span, '$lte': end},
+        }, sort=[('start', 1)])
+        points = []
+        while (yield cursor.fetch_next):
+            bucket = cursor.next_object()
+            points.extend(p for p in bucket['points'] if start <= p[0] <= end)
+        raise gen.Return({
+            'fields': [name for name, _ in SAMPLE_FIELDS],
+            'resolution': resolution,
+            'points': points,
+        })
+
+    def close(self):
+        """ Release MongoDB client used by this storage """
+        if self.client is not None:
+            release_client(self.client)
+            self.client = None
+
+    def _choose_resolution(self, start, end):
+        now = time.time()
+        for resolution, retention in self.levels:
+            if retention is not None and start < now - retention:
+                continue
+            if (end - start) / resolution <= self.max_points:
+                return resolution
+        return self.levels[-1][0]
+
+    def _push(self, job_id, resolution, retention, timestamp, sample):
+        span = resolution * self.bucket_points
+        bucket_start = int(timestamp // span * span)
+        on_insert = {'job_id': job_id, 'res': resolution,
+                     'start': bucket_start}
+        if retention is not None:
+            on_insert['expire_at'] = datetime.datetime.utcfromtimestamp(
+                bucket_start + span + retention)
+        return self.col.update(
+            {'_id': '%s:%d:%d' % (job_id, resolution, bucket_start)},
+            {'$push': {'points': [round(timestamp, 3)] + list(sample)},
+             '$setOnInsert': on_insert},
+            upsert=True,
+        )
+
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division
+import json
+import math
+
+
+class BloomFilter(object):
+    """
+    Bloom filter for hex digests (e.g. request fingerprints). Bit indexes
+    are computed from the digest itself using double hashing,
+    so digests must be at least 32 hex characters long.
+    """
+    def __init__(self, capacity, error_rate, count=0, bits=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_hashes = max(1, int(math.ceil(-math.log(error_rate, 2))))
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.count = count
+        if bits is None:
+            bits = bytearray((self.num_bits + 7) // 8)
+        self.bits = bits
+
+    def contains(self, h1, h2):
+        bits, num_bits = self.bits, self.num_bits
+        for i in range(self.num_hashes):
+            idx = (h1 + i * h2) % num_bits
+            if not bits[idx >> 3] & (1 << (idx & 7)):
+                return False
+        return True
+
+    def add(self, h1, h2):
+        """ Add a key; return True if it was (probably) present already. """
+        bits, num_bits = self.bits, self.num_bits
+        present = True
+        for i in range(self.num_hashes):
+            idx = (h1 + i * h2) % num_bits
+            mask = 1 << (idx & 7)
+            if not bits[idx >> 3] & mask:
+                bits[idx >> 3] |= mask
+                present = False
+        if not present:
+            self.count += 1
+        return present
+
+    @property
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def estimated_error_rate(self):
+        k = self.num_hashes
+        return (1 - math.exp(-k * self.count / self.num_bits)) ** k
+
+
+class ScalableBloomFilter(object):
+    """
+    Scalable Bloom filter (Almeida et al., 2007) for hex digests.
+
+    When a filter is full a new one with ``growth`` times larger
+    capacity and ``tightening`` times smaller error rate is added,
+    so the total false positive rate stays below ``error_rate``
+    regardless of the number of keys.
+
+    >>> import hashlib
+    >>> keys = [hashlib.sha1(str(i).encode('ascii')).hexdigest()
+    ...         for i in range(1000)]
+    >>> bf = ScalableBloomFilter(initial_capacity=100, error_rate=0.001)
+    >>> any(bf.add(key) for key in keys)
+    False
+    >>> all(key in bf for key in keys)
+    True
+    >>> len(bf), len(bf.filters)
+    (1000, 4)
+    >>> bf.estimated_error_rate() < 0.001
+    True
+
+    Filters can be saved to a file and loaded back:
+
+    >>> import io
+    >>> f = io.BytesIO()
+    >>> bf.save(f)
+    >>> _ = f.seek(0)
+    >>> bf2 = ScalableBloomFilter.load(f)
+    >>> len(bf2), all(key in bf2 for key in keys)
+    (1000, True)
+    """
+    def __init__(self, initial_capacity=100000, error_rate=0.001,
+                 growth=2, tightening=0.9):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = []
+
+    def add(self, key):
+        """ Add a key; return True if it was (probably) present already. """
+        h1, h2 = _hashes(key)
+        for bf in self.filters[:-1]:
+            if bf.contains(h1, h2):
+                return True
+        if not self.filters or self.filters[-1].is_full:
+            if self.filters and self.filters[-1].contains(h1, h2):
+                return True
+            self.filters.append(self._new_filter())
+        return self.filters[-1].add(h1, h2)
+
+    def __contains__(self, key):
+        h1, h2 = _hashes(key)
+        return any(bf.contains(h1, h2) for bf in self.filters)
+
+    def __len__(self):
+        return sum(bf.count for bf in self.filters)
+
+    @property
+    def nbytes(self):
+        return sum(len(bf.bits) for bf in self.filters)
+
+    def estimated_error_rate(self):
+        """ Estimated probability of a false positive """
+        p = 1.0
+        for bf in self.filters:
+            p *= 1 - bf.estimated_error_rate()
+        return 1 - p
+
+    def save(self, f):
+        """ Write filters to a binary file """
+        header = {
+            'initial_capacity': self.initial_capacity,
+            'error_rate': self.error_rate,
+            'growth': self.growth,
+            'tightening': self.tightening,
+            'filters': [[bf.capacity, bf.error_rate, bf.count]
+                        for bf in self.filters],
+        }
+        f.write(json.dumps(header).encode('ascii') + b'\n')
+        for bf in self.filters:
+            f.write(bf.bits)
+
+    @classmethod
+    def load(cls, f):
+        """ Read filters written by :meth:`save` """
+        header = json.loads(f.readline().decode('ascii'))
+        sbf = cls(header['initial_capacity'], header['error_rate'],
+                  header['growth'], header['tightening'])
+        for capacity, error_rate, count in header['filters']:
+            bf = BloomFilter(capacity, error_rate, count)
+            if f.readinto(bf.bits) != len(bf.bits):
+                raise ValueError("Bloom filter file is truncated")
+            sbf.filters.append(bf)
+        return sbf
+
+    def _new_filter(self):
+        n = len(self.filters)
+        return BloomFilter(
+            capacity=int(self.initial_capacity * self.growth ** n),
+            error_rate=(self.error_rate * (1 - self.tightening) *
+                        self.tightening ** n),
+        )
+
+
+def _hashes(key):
+    # hex digests are already uniformly distributed; the second hash
+    # is odd so that indexes don't repeat for power-of-two sizes
+    return int(key[:16], 16), int(key[16:32], 16) | 1
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Least recently used cache limited both by a number of entries
+    and by a total size of values. Entries may have a time-to-live.
+
+    >>> cache = LRUCache(max_items=2, max_bytes=100)
+    >>> cache.put('a', 1, size=10)
+    0
+    >>> cache.put('b', 2, size=10)
+    0
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3, size=10)  # 'b' is the least recently used entry
+    1
+    >>> cache.get('b') is None
+    True
+    >>> cache.put('d', 4, size=95)  # 'a' and 'c' don't fit
+    2
+    >>> len(cache), cache.nbytes
+    (1, 95)
+    """
+    def __init__(self, max_items=1000, max_bytes=64*1024*1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()  # key -> (value, size, expires_at)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        value, size, expires_at = entry
+        if expires_at is not None and expires_at < time.time():
+            self.nbytes -= size
+            return default
+        self._data[key] = entry  # move to the end
+        return value
+
+    def put(self, key, value, size=0, ttl=None):
+        """
+        Add an entry; return a number of evicted entries.
+        Values larger than ``max_bytes`` are not cached.
+        """
+        self.pop(key)
+        if size > self.max_bytes or self.max_items <= 0:
+            return 0
+        expires_at = time.time() + ttl if ttl else None
+        self._data[key] = (value, size, expires_at)
+        self.nbytes += size
+        evicted = 0
+        while len(self._data) > self.max_items or self.nbytes > self.max_bytes:
+            _, (_, old_size, _) = self._data.popitem(last=False)
+            self.nbytes -= old_size
+            evicted += 1
+        return evicted
+
+    def pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
@@ -1,9 +1,29 @@
 from __future__ import absolute_import
-from six.moves.urllib.parse import urlparse
+import os
 
+import six
+from six.moves.urllib.parse import urlparse, urlsplit
+
+from tornado import gen
+from tornado.ioloop import IOLoop
 from scrapy.utils.serialize import ScrapyJSONEncoder
 from bson.objectid import ObjectId
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without "futures" package
+    ThreadPoolExecutor = None
+
 # XXX: this is copy-pasted  to make motor_exporter independent
 class JSONEncoder(ScrapyJSONEncoder):
 
@@ -14,21 +34,224 @@ class JSONEncoder(ScrapyJSONEncoder):
     def default(self, o):
         if isinstance(o, ObjectId):
             return str(o)
+        if isinstance(o, bytes):  # raw page bodies
+            return o.decode('utf8', 'replace')
         return super(JSONEncoder, self).default(o)
 
 _encoder = JSONEncoder()
 
 
+def _stdlib_encode(obj):
+    return _encoder.encode(obj)
+
+
+def _orjson_encode(obj):
+    # datetime objects are passed to JSONEncoder.default
+    # to keep the format compatible with ScrapyJSONEncoder
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    return orjson.dumps(obj, default=_encoder.default,
+                        option=options).decode('utf8')
+
+
+JSON_BACKENDS = {'stdlib': _stdlib_encode}
+if orjson is not None:
+    JSON_BACKENDS['orjson'] = _orjson_encode
+
+_fast_encode = JSON_BACKENDS.get('orjson', _stdlib_encode)
+
+
+def set_json_backend(name):
+    """
+    Set a backend used by :func:`json_encode`. Allowed values are
+    "auto" (orjson if it is installed, stdlib json otherwise)
+    and names from ``JSON_BACKENDS``.
+    """
+    global _fast_encode
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in JSON_BACKENDS else 'stdlib'
+    if name not in JSON_BACKENDS:
+        raise ValueError("JSON backend is not available: %r" % name)
+    _fast_encode = JSON_BACKENDS[name]
+
+
 def json_encode(obj, encoding=None):
     """
     Encode a Python object to JSON.
     Unlike standard json.dumps, datetime.datetime and ObjectID
     objects are supported.
 
-    >>> json_encode([{"o": ObjectId("303132333435363738396162")}, 123])
-    '[{"o": "303132333435363738396162"}, 123]'
+    >>> import json
+    >>> data = [{"o": ObjectId("303132333435363738396162")}, 123]
+    >>> json.loads(json_encode(data)) == [{"o": "303132333435363738396162"}, 123]
+    True
     """
-    return _encoder.encode(obj)
+    try:
+        return _fast_encode(obj)
+    except (TypeError, ValueError, OverflowError):
+        if _fast_encode is _stdlib_encode:
+            raise
+        # e.g. integers which don't fit in 64 bits
+        return _stdlib_encode(obj)
+
+
+class _BroadcastCache(object):
+    """
+    Single-entry cache of an encoded object.
+    An entry is only valid until the current IOLoop callback finishes.
+    """
+    def __init__(self):
+        self.obj = None
+        self.value = None
+
+    def get(self, obj):
+        if obj is self.obj:
+            return self.value
+
+    def set(self, obj, value):
+        if self.obj is None:
+            IOLoop.current().add_callback(self.clear)
+        self.obj, self.value = obj, value
+
+    def clear(self):
+        self.obj = self.value = None
+
+_broadcast_cache = _BroadcastCache()
+_broadcast_async_cache = _BroadcastCache()
+_broadcast_msgpack_cache = _BroadcastCache()
+
+
+def json_encode_broadcast(obj):
+    """
+    Encode ``obj`` to JSON, reusing the result if the same object was
+    encoded before in the current IOLoop callback.
+
+    A signal which is sent to many websocket clients passes the same
+    object to all of them; this way the message is encoded only once.
+    Objects must not be changed after they are encoded.
+    """
+    message = _broadcast_cache.get(obj)
+    if message is None:
+        message = json_encode(obj)
+        _broadcast_cache.set(obj, message)
+    return message
+
+
+# Messages which are approximately larger than this number of bytes
+# are encoded in a thread pool by json_encode_async and
+# msgpack_encode_async.
+JSON_THREAD_THRESHOLD = 256 * 1024
+
+_executor = None
+
+
+def json_encode_async(obj, size=None):
+    """
+    Encode ``obj`` to JSON; return a Future with the result.
+
+    Large objects are encoded in a worker thread, so that the event loop
+    is not blocked; they are copied first (see :func:`snapshot`), so
+    the original object may be changed while it is being encoded.
+    ``size`` is an approximate size of the object (see
+    :func:`approx_doc_size`); it is computed if not passed.
+    Like in :func:`json_encode_broadcast`, an object passed several times
+    in the same IOLoop callback is encoded once.
+    """
+    return _encode_async(json_encode, _broadcast_async_cache, obj, size)
+
+
+def msgpack_encode_async(obj, size=None):
+    """
+    Encode ``obj`` to msgpack; return a Future with the result.
+    Large objects are encoded in a worker thread, like in
+    :func:`json_encode_async`.
+    """
+    return _encode_async(msgpack_encode, _broadcast_msgpack_cache, obj, size)
+
+
+def _encode_async(encode, cache, obj, size):
+    future = cache.get(obj)
+    if future is None:
+        future = _encode_in_thread(encode, obj, size)
+        cache.set(obj, future)
+    return future
+
+
+@gen.coroutine
+def _encode_in_thread(encode, obj, size):
+    global _executor
+    if size is None:
+        size = approx_doc_size(obj, limit=JSON_THREAD_THRESHOLD)
+    if size < JSON_THREAD_THRESHOLD or ThreadPoolExecutor is None:
+        raise gen.Return(encode(obj))
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2)
+    # e.g. stats dicts are changed by crawlers while the message
+    # is encoded in a thread
+    message = yield _executor.submit(encode, snapshot(obj))
+    raise gen.Return(message)
+
+
+def snapshot(obj):
+    """
+    Return a copy of dicts and lists in ``obj``; other values
+    are not copied.
+
+    >>> data = {'stats': {'a': 1}, 'urls': ['http://example.com']}
+    >>> copy = snapshot(data)
+    >>> copy == data, copy['stats'] is data['stats']
+    (True, False)
+    """
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [snapshot(value) for value in obj]
+    return obj
+
+
+def msgpack_encode(obj):
+    """
+    Encode a Python object to msgpack. Values msgpack doesn't support
+    (ObjectId, datetime, etc.) are converted the same way as
+    in :func:`json_encode`.
+    """
+    return msgpack.packb(obj, default=_encoder.default, use_bin_type=True)
+
+
+def msgpack_decode(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+def approx_doc_size(value, limit=None):
+    """
+    Return a rough estimate of a size of ``value`` encoded to BSON or JSON.
+    It doesn't have to be exact. If ``limit`` is set, the object is
+    only walked until its size exceeds ``limit``; the result is
+    larger than ``limit`` in this case.
+
+    >>> approx_doc_size({'url': 'http://example.com', 'items': [1, 2]})
+    69
+    >>> approx_doc_size({'items': list(range(1000))}, limit=100) > 100
+    True
+    """
+    size = 0
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            size += 5
+            for key, val in value.items():
+                size += len(key) + 2
+                stack.append(val)
+        elif isinstance(value, (list, tuple)):
+            size += 5 + 4 * len(value)
+            stack.extend(value)
+        elif isinstance(value, (six.text_type, six.binary_type)):
+            size += 5 + len(value)
+        else:
+            size += 8
+        if limit is not None and size > limit:
+            break
+    return size
 
 
 def decorate_methods(method_names, decorator):
@@ -67,3 +290,38 @@ def get_netloc(url):
     'blog.example.org'
     """
     return urlparse(add_scheme_if_missing(url)).netloc
+
+
+def domain_matcher(domains):
+    """
+    Return a function which checks if an URL belongs to one of ``domains``
+    or their subdomains, like ``scrapy.utils.url.url_is_from_any_domain``,
+    but with domains preprocessed once.
+
+    >>> matches = domain_matcher(['example.org'])
+    >>> matches("http://example.org/foo"), matches("http://BLOG.example.org")
+    (True, True)
+    >>> matches("http://myexample.org/"), matches("http://example.com")
+    (False, False)
+    """
+    domains = [d.lower() for d in domains]
+    exact = frozenset(domains)
+    suffixes = tuple('.' + d for d in domains)
+
+    def matches(url):
+        host = urlsplit(url).netloc.lower()
+        return host in exact or host.endswith(suffixes)
+    return matches
+
+
+def replace_file(src, dst):
+    """
+    Rename ``src`` to ``dst``, replacing ``dst`` if it exists
+    (``os.rename`` fails on Windows in this case).
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:  # Python 2
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
@@ -2,16 +2,160 @@
 from __future__ import absolute_import
 import json
 import logging
+from collections import deque
 
 from tornado import websocket
+from tornado.concurrent import is_future
+from tornado.escape import utf8
+from tornado.ioloop import IOLoop
 
-from arachnado.utils.misc import json_encode
+from arachnado.utils.misc import json_encode, json_encode_broadcast
 
 
 logger = logging.getLogger(__name__)
 
+# continuation, text and binary frames
+_DATA_OPCODES = frozenset([0x0, 0x1, 0x2])
 
-class BaseWSHandler(websocket.WebSocketHandler):
+
+class WSTransportMixin(object):
+    """
+    Websocket handler mixin which enables permessage-deflate compression
+    according to ``[arachnado.websocket]`` config section and provides
+    per-connection traffic counters.
+
+    Call :meth:`init_transport` from ``initialize`` and
+    :meth:`count_message_in` from ``on_message``. Use
+    :meth:`write_ordered` to send messages which are encoded
+    asynchronously.
+    """
+    transport_opts = None
+    messages_in = messages_out = 0
+    message_bytes_in = message_bytes_out = 0
+    wire_bytes_in = wire_bytes_out = 0
+    _ws_connection = None
+    _pending_writes = None
+    _waiting_for = None
+
+    def init_transport(self, opts=None):
+        self.transport_opts = (opts or {}).get('arachnado.websocket', {})
+
+    def get_compression_options(self):
+        opts = self.transport_opts or {}
+        if not opts.get('compression'):
+            return None
+        options = {}
+        if opts.get('compression_level'):
+            options['compression_level'] = int(opts['compression_level'])
+        return options
+
+    @property
+    def ws_connection(self):
+        return self._ws_connection
+
+    @ws_connection.setter
+    def ws_connection(self, connection):
+        # tornado creates the protocol object when the connection is
+        # accepted; its frame reader and writer see compressed data
+        self._ws_connection = connection
+        if connection is not None:
+            self._count_wire_bytes(connection)
+
+    def _count_wire_bytes(self, connection):
+        write_frame = getattr(connection, '_write_frame', None)
+        handle_message = getattr(connection, '_handle_message', None)
+        if write_frame is None or handle_message is None:
+            return
+
+        def _write_frame(fin, opcode, data, *args, **kwargs):
+            if opcode in _DATA_OPCODES:
+                self.wire_bytes_out += len(data)
+            return write_frame(fin, opcode, data, *args, **kwargs)
+
+        def _handle_message(opcode, data):
+            if opcode in _DATA_OPCODES:
+                self.wire_bytes_in += len(data)
+            return handle_message(opcode, data)
+
+        connection._write_frame = _write_frame
+        connection._handle_message = _handle_message
+
+    def write_message(self, message, binary=False):
+        if isinstance(message, dict):
+            message = json_encode(message)
+        # tornado encodes text messages to UTF-8 anyway
+        message = utf8(message)
+        self.messages_out += 1
+        self.message_bytes_out += len(message)
+        return super(WSTransportMixin, self).write_message(message,
+                                                           binary=binary)
+
+    def write_ordered(self, message, binary=False):
+        """
+        Write ``message`` after all messages passed to this method
+        before it. ``message`` may be a Future (e.g. a message which is
+        being encoded in a thread); a message which resolves to None
+        is not sent.
+        """
+        if self._pending_writes is None:
+            self._pending_writes = deque()
+        self._pending_writes.append((message, binary))
+        self._write_pending()
+
+    def _write_pending(self):
+        queue = self._pending_writes
+        while queue:
+            message, binary = queue[0]
+            if is_future(message):
+                if not message.done():
+                    if self._waiting_for is not message:
+                        self._waiting_for = message
+                        IOLoop.current().add_future(message,
+                                                    self._on_message_ready)
+                    return
+                try:
+                    message = message.result()
+                except Exception:
+                    logger.error("Error encoding a message", exc_info=True)
+                    message = None
+            queue.popleft()
+            if message is None:
+                continue
+            try:
+                self.write_message(message, binary=binary)
+            except websocket.WebSocketClosedError:
+                queue.clear()
+
+    def _on_message_ready(self, future):
+        self._waiting_for = None
+        self._write_pending()
+
+    def count_message_in(self, message):
+        self.messages_in += 1
+        self.message_bytes_in += len(utf8(message))
+
+    def get_transport_stats(self):
+        """
+        Return traffic counters of this connection: numbers of messages,
+        their sizes before compression ("message_bytes_*") and sizes of
+        their payloads sent over the wire ("wire_bytes_*"). "compression"
+        is True if permessage-deflate compression is enabled on the server
+        and requested by the client.
+        """
+        extensions = self.request.headers.get('Sec-WebSocket-Extensions', '')
+        return {
+            'compression': (self.get_compression_options() is not None and
+                            'permessage-deflate' in extensions),
+            'messages_in': self.messages_in,
+            'messages_out': self.messages_out,
+            'message_bytes_in': self.message_bytes_in,
+            'message_bytes_out': self.message_bytes_out,
+            'wire_bytes_in': self.wire_bytes_in,
+            'wire_bytes_out': self.wire_bytes_out,
+        }
+
+
+class BaseWSHandler(WSTransportMixin, websocket.WebSocketHandler):
     """
     A base class which knows how to communicate with a client.
     All messages are JSON-encoded objects ``{"event": name, "data": data}``.
@@ -27,7 +171,10 @@ class BaseWSHandler(websocket.WebSocketHandler):
         #     print("write_event {} {}".format(event, data))
         message = None
         try:
-            message = json_encode({'event': event, 'data': data})
+            # the same data object is usually sent to all clients;
+            # it is encoded only once
+            message = '{"event": %s, "data": %s}' % (
+                json_encode(event), json_encode_broadcast(data))
         except Exception as e:
             logger.warn("Invalid event message skipped {} {} {}".format(e, event, data))
             return
@@ -41,6 +188,7 @@ class BaseWSHandler(websocket.WebSocketHandler):
     def on_message(self, message):
         # print("-----------------================")
         # print("on message {}".format(message))
+        self.count_message_in(message)
         try:
             msg = json.loads(message)
             event, data = msg['event'], msg['data']
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare scheduler disk queues: queuelib FifoDiskQueue with pickled
+requests (scrapy.squeues.PickleFifoDiskQueue) and
+arachnado.squeues.CompactFifoDiskQueue.
+
+Usage::
+
+    PYTHONPATH=. python benchmarks/bench_disk_queue.py [--requests 1000000]
+
+Request dicts similar to ``request_to_dict`` results are pushed to a queue
+and then popped; push and pop throughput and the size of queue files
+are reported.
+"""
+from __future__ import absolute_import, print_function
+import os
+import argparse
+import shutil
+import tempfile
+import timeit
+
+from six.moves import cPickle as pickle
+from queuelib.queue import FifoDiskQueue
+
+from arachnado.squeues import CompactFifoDiskQueue
+
+
+class PickleFifoDiskQueue(FifoDiskQueue):
+    # the same as scrapy.squeues.PickleFifoDiskQueue in Scrapy 1.x
+    def push(self, obj):
+        super(PickleFifoDiskQueue, self).push(pickle.dumps(obj, protocol=2))
+
+    def pop(self):
+        data = super(PickleFifoDiskQueue, self).pop()
+        if data:
+            return pickle.loads(data)
+
+
+def make_request(i):
+    return {
+        'url': u'http://example.com/category/%d/page/%d.html' % (i % 100, i),
+        'callback': 'parse',
+        'errback': None,
+        'method': 'GET',
+        'headers': {b'Referer': [b'http://example.com/category/%d/'
+                                 % (i % 100)]},
+        'body': b'',
+        'cookies': {},
+        'meta': {'depth': i % 5, 'download_slot': 'example.com'},
+        '_encoding': 'utf-8',
+        'priority': -(i % 5),
+        'dont_filter': False,
+    }
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+
+def run(queue_cls, requests):
+    root = tempfile.mkdtemp()
+    path = os.path.join(root, 'p0')
+    timer = timeit.default_timer
+    try:
+        queue = queue_cls(path)
+        start = timer()
+        for request in requests:
+            queue.push(request)
+        if hasattr(queue, 'flush'):
+            queue.flush()
+        push_time = timer() - start
+        size = dir_size(path)
+        start = timer()
+        while queue.pop() is not None:
+            pass
+        pop_time = timer() - start
+        queue.close()
+    finally:
+        shutil.rmtree(root)
+    n = len(requests)
+    print("%-22s push %8.0f req/s, pop %8.0f req/s, %7.1f MB on disk" % (
+        queue_cls.__name__, n / push_time, n / pop_time, size / 1024. / 1024))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--requests', type=int, default=1000000)
+    args = p.parse_args()
+
+    requests = [make_request(i) for i in range(args.requests)]
+    run(PickleFifoDiskQueue, requests)
+    run(CompactFifoDiskQueue, requests)
+
+
+if __name__ == '__main__':
+    main()
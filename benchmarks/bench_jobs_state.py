@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare full "jobs:state" snapshots with "jobs:delta" updates.
+
+Usage::
+
+    PYTHONPATH=. python benchmarks/bench_jobs_state.py [--jobs 50] [--seconds 60]
+
+A synthetic crawler process with busy jobs is simulated for ``--seconds``
+seconds of engine ticks (10 per second). The old protocol sends a full
+job list on each of ``--signals`` engine/downloader signals per tick;
+the new one sends a single delta per ``--interval`` seconds.
+Bytes per second and CPU time spent in json_encode are reported.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import random
+import timeit
+
+from arachnado.utils.misc import json_encode
+from arachnado.jobstate import JobsStateTracker
+
+
+def make_job(i, n_stats):
+    return {
+        'id': 'job%d' % i,
+        'job_id': '%024x' % i,
+        'seed': 'http://example%d.com' % i,
+        'status': 'crawling',
+        'stats': {'stat/key/%d' % k: k for k in range(n_stats)},
+        'downloads': make_downloads(i),
+        'args': {},
+        'settings': {},
+    }
+
+
+def make_downloads(i):
+    active = [{'url': 'http://example%d.com/%d' % (i, random.randint(0, 10**6)),
+               'method': 'GET'} for _ in range(8)]
+    return {
+        'active': active,
+        'slots': [{
+            'key': 'example%d.com' % i,
+            'concurrency': 8,
+            'delay': 0.3,
+            'lastseen': random.random(),
+            'len(queue)': random.randint(0, 100),
+            'transferring': active[:4],
+            'active': active,
+        }],
+    }
+
+
+def tick(jobs, n_changed):
+    for job in random.sample(jobs, n_changed):
+        stats = job['stats']
+        for key in random.sample(list(stats), 5):
+            stats[key] += 1
+        job['downloads'] = make_downloads(int(job['id'][3:]))
+
+
+class FakeCrawlerProcess(object):
+    jobs = None
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--jobs', type=int, default=50)
+    p.add_argument('--stats', type=int, default=300)
+    p.add_argument('--changed', type=int, default=10,
+                   help="jobs changed per tick")
+    p.add_argument('--signals', type=int, default=3,
+                   help="full snapshots per tick in the old protocol")
+    p.add_argument('--seconds', type=int, default=60)
+    p.add_argument('--interval', type=float, default=0.5)
+    args = p.parse_args()
+
+    random.seed(0)
+    jobs = [make_job(i, args.stats) for i in range(args.jobs)]
+    cp = FakeCrawlerProcess()
+    tracker = JobsStateTracker(cp, interval=args.interval)
+    cp.jobs = jobs
+    tracker.compute_delta(jobs)
+
+    ticks_per_update = max(1, int(args.interval * 10))
+    full_bytes = delta_bytes = 0
+    full_time = delta_time = diff_time = 0.0
+    timer = timeit.default_timer
+    for n in range(args.seconds * 10):
+        tick(jobs, args.changed)
+        for _ in range(args.signals):
+            start = timer()
+            full_bytes += len(json_encode({'event': 'jobs:state',
+                                           'data': jobs}))
+            full_time += timer() - start
+
+        if n % ticks_per_update == 0:
+            start = timer()
+            delta = tracker.compute_delta(jobs)
+            diff_time += timer() - start
+            if delta is not None:
+                start = timer()
+                delta_bytes += len(json_encode({'event': 'jobs:delta',
+                                                'data': delta}))
+                delta_time += timer() - start
+
+    seconds = float(args.seconds)
+    print("full snapshots: %10.0f bytes/s, json_encode %.3fs CPU/s" % (
+        full_bytes / seconds, full_time / seconds))
+    print("deltas:         %10.0f bytes/s, json_encode %.3fs CPU/s, "
+          "diff %.3fs CPU/s" % (delta_bytes / seconds, delta_time / seconds,
+                                diff_time / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare link extraction and request filtering in CrawlWebsiteSpider
+before and after caching the LinkExtractor.
+
+Usage::
+
+    PYTHONPATH=. python benchmarks/bench_link_extractor.py [--links 10000]
+
+A synthetic page with ``--links`` links (half of them to other domains)
+is parsed; each extracted link then goes through the
+DropRequestsMiddleware check (``should_drop_request``).
+Previously a new LinkExtractor was created for the page and for each
+request; now a cached extractor and a precomputed domain matcher are used.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import timeit
+
+from scrapy.http import HtmlResponse
+from scrapy.linkextractors import LinkExtractor
+
+from arachnado.utils.misc import domain_matcher
+
+
+ALLOW_DOMAIN = 'example.com'
+
+
+def make_page(n_links):
+    links = []
+    for i in range(n_links):
+        domain = ALLOW_DOMAIN if i % 2 else 'other%d.org' % (i % 50)
+        links.append('<a href="http://%s/path/%d.html">link %d</a>' % (
+            domain, i, i))
+    body = '<html><body>%s</body></html>' % '\n'.join(links)
+    return HtmlResponse('http://%s/' % ALLOW_DOMAIN, body=body.encode('ascii'),
+                        encoding='ascii')
+
+
+def new_extractor():
+    return LinkExtractor(allow_domains=[ALLOW_DOMAIN], canonicalize=False)
+
+
+def old_crawl(response):
+    links = new_extractor().extract_links(response)
+    return [link for link in links if new_extractor().matches(link.url)]
+
+
+def make_new_crawl():
+    extractor = new_extractor()
+    matches = domain_matcher([ALLOW_DOMAIN])
+
+    def new_crawl(response):
+        links = extractor.extract_links(response)
+        return [link for link in links if matches(link.url)]
+    return new_crawl
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--links', type=int, default=10000)
+    p.add_argument('--repeat', type=int, default=5)
+    args = p.parse_args()
+
+    response = make_page(args.links)
+    new_crawl = make_new_crawl()
+    assert old_crawl(response) == new_crawl(response)
+
+    for name, func in [('LinkExtractor per call', old_crawl),
+                       ('cached', new_crawl)]:
+        t = min(timeit.repeat(lambda: func(response), number=1,
+                              repeat=args.repeat))
+        print("%-22s %.3fs per page" % (name, t))
+
+    urls = [link.url for link in new_crawl(response)]
+    old_time = min(timeit.repeat(
+        lambda: [new_extractor().matches(url) for url in urls],
+        number=1, repeat=args.repeat))
+    matches = domain_matcher([ALLOW_DOMAIN])
+    new_time = min(timeit.repeat(
+        lambda: [matches(url) for url in urls],
+        number=1, repeat=args.repeat))
+    print("should_drop_request: %.1fus -> %.1fus per request" % (
+        old_time / len(urls) * 1e6, new_time / len(urls) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
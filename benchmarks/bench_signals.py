@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure per-signal overhead of crawler -> process signal routing.
+
+Usage::
+
+    PYTHONPATH=. python benchmarks/bench_signals.py [--signals 100000]
+
+A crawler sends a mix of Scrapy signals; 0, 1 and 20 websocket clients
+are simulated by connecting receivers to process-level signals the
+same way Monitor and JobsStateTracker do. The old approach
+(re-sending every crawler signal to the process SignalManager)
+is compared with SignalRouter.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import timeit
+
+from scrapy import signals
+from scrapy.signalmanager import SignalManager
+
+from arachnado import stats
+from arachnado.crawler_process import (
+    SignalRouter, CrawlerProcessSignals as CPS, SCRAPY_SIGNAL_NAMES,
+    STAT_SIGNALS, agg_stats_changed
+)
+from arachnado.jobstate import JobsStateTracker
+
+
+class FakeStats(object):
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.signals = SignalManager(self)
+
+
+class FakeCrawler(object):
+    def __init__(self):
+        self.signals = SignalManager(self)
+        self.stats = FakeStats(self)
+
+
+class LegacyRouter(SignalManager):
+    """ Signal routing as it was done before SignalRouter """
+    def add_crawler(self, crawler):
+        for name in SCRAPY_SIGNAL_NAMES:
+            crawler.signals.connect(self._resend_signal,
+                                    getattr(signals, name))
+        crawler.stats.signals.connect(self._resend_signal,
+                                      stats.stats_changed)
+
+    def _resend_signal(self, **kwargs):
+        signal = kwargs['signal']
+        if signal in STAT_SIGNALS:
+            signal = STAT_SIGNALS[signal]
+            kwargs['crawler'] = kwargs.pop('sender').crawler
+        else:
+            signal = CPS.signal(signal)
+            kwargs['crawler'] = kwargs.pop('sender')
+        kwargs['signal'] = signal
+        if signal.supports_defer:
+            return self.send_catch_log_deferred(**kwargs)
+        else:
+            return self.send_catch_log(**kwargs)
+
+
+class Client(object):
+    """ Receivers of a websocket client """
+    def __init__(self, manager):
+        manager.connect(self.on_stats_changed, agg_stats_changed)
+        manager.connect(self.on_spider_closed, CPS.spider_closed)
+
+    def on_stats_changed(self, changes, crawler):
+        pass
+
+    def on_spider_closed(self, spider, reason):
+        pass
+
+
+def on_delta(delta):
+    pass
+
+
+def run(router_cls, n_clients, n_signals):
+    manager = router_cls()
+    crawler = FakeCrawler()
+    manager.add_crawler(crawler)
+    clients = [Client(manager) for _ in range(n_clients)]
+    tracker = JobsStateTracker(None)
+    tracker.cp = type('cp', (), {'signals': manager})
+    if n_clients:
+        tracker.subscribe(on_delta)
+    tracker.schedule_update = lambda **kwargs: None
+
+    def send_all():
+        send = crawler.signals.send_catch_log
+        for i in range(n_signals // 4):
+            send(signals.response_received, response=None, request=None,
+                 spider=None)
+            send(signals.request_scheduled, request=None, spider=None)
+            send(signals.response_downloaded, response=None, request=None,
+                 spider=None)
+            crawler.stats.signals.send_catch_log(stats.stats_changed,
+                                                 changes={'a': i})
+
+    seconds = timeit.timeit(send_all, number=1)
+    del clients
+    return seconds * 1e6 / n_signals
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--signals', type=int, default=100000)
+    args = p.parse_args()
+    print("%8s %14s %14s" % ("clients", "old, us/signal", "new, us/signal"))
+    for n_clients in [0, 1, 20]:
+        old = run(LegacyRouter, n_clients, args.signals)
+        new = run(SignalRouter, n_clients, args.signals)
+        print("%8d %14.2f %14.2f" % (n_clients, old, new))
+
+
+if __name__ == '__main__':
+    main()
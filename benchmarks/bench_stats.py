@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure stats collector overhead.
+
+Usage::
+
+    PYTHONPATH=. python benchmarks/bench_stats.py [--calls 1000000]
+
+``inc_value`` is called ``--calls`` times for a mix of keys, with
+``emit_changes`` called every ``--emit-every`` calls (as it happens
+each 0.1s in a crawl). Plain Scrapy StatsCollector, the previous
+EventedStatsCollector (which tracked changes in each stats method)
+and the current EventedStatsCollector are compared.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import functools
+import timeit
+
+from scrapy.settings import Settings
+from scrapy.statscollectors import StatsCollector
+
+from arachnado.stats import EventedStatsCollector
+from arachnado.utils.misc import decorate_methods
+
+
+class FakeCrawler(object):
+    settings = Settings()
+
+
+def store_changed_value(meth):
+    @functools.wraps(meth)
+    def wrapper(self, key, *args, **kwargs):
+        old_value = self._stats.get(key)
+        meth(self, key, *args, **kwargs)
+        value = self._stats.get(key)
+        if value != old_value:
+            self._changes[key] = value
+    return wrapper
+
+
+@decorate_methods(["set_value", "inc_value", "max_value", "min_value"],
+                  store_changed_value)
+class OldEventedStatsCollector(StatsCollector):
+    # change tracking of EventedStatsCollector before it used dirty keys
+    def __init__(self, crawler):
+        super(OldEventedStatsCollector, self).__init__(crawler)
+        self._changes = {}
+
+    def emit_changes(self):
+        if self._changes:
+            changes, self._changes = self._changes, {}
+            return changes
+
+
+class NoEmitStatsCollector(StatsCollector):
+    def emit_changes(self):
+        pass
+
+
+def run(stats, keys, calls, emit_every):
+    inc_value, emit_changes = stats.inc_value, stats.emit_changes
+    n_keys = len(keys)
+    start = timeit.default_timer()
+    for i in range(calls):
+        inc_value(keys[i % n_keys])
+        if i % emit_every == 0:
+            emit_changes()
+    return timeit.default_timer() - start
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--calls', type=int, default=1000000)
+    p.add_argument('--keys', type=int, default=50)
+    p.add_argument('--emit-every', type=int, default=10000)
+    args = p.parse_args()
+
+    keys = ['downloader/response_status_count/%d' % i
+            for i in range(args.keys)]
+    crawler = FakeCrawler()
+    collectors = [
+        ('scrapy StatsCollector', NoEmitStatsCollector(crawler)),
+        ('old EventedStatsCollector', OldEventedStatsCollector(crawler)),
+        ('EventedStatsCollector', EventedStatsCollector(crawler)),
+    ]
+    for name, stats in collectors:
+        t = run(stats, keys, args.calls, args.emit_every)
+        print("%-26s %.3fs (%.0fns per call)" % (
+            name, t, t / args.calls * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -82,6 +82,8 @@ setup(
     extras_require={
         'mongo': [],   # backwards compatibility
         'extras': ['autopager >= 0.2'],
+        'msgpack': ['msgpack >= 0.5.2'],
+        'zstd': ['zstandard'],
         'bot-detector': [
             # bot_detector is an optional dependency for detecting bot/crawler
             # engines in web pages. It's not available on PyPI and needs to be
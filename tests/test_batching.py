@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import tornado.testing
+from tornado import gen
+
+from arachnado.pipelines.batching import BatchInserter
+
+
+class FakeStats(object):
+    def __init__(self):
+        self.stats = {}
+
+    def inc_value(self, key, count=1):
+        self.stats[key] = self.stats.get(key, 0) + count
+
+    def set_value(self, key, value):
+        self.stats[key] = value
+
+    def max_value(self, key, value):
+        self.stats[key] = max(self.stats.get(key, value), value)
+
+
+class FakeBulk(object):
+    def __init__(self, col):
+        self.col = col
+        self.docs = []
+
+    def insert(self, doc):
+        self.docs.append(doc)
+
+    @gen.coroutine
+    def execute(self):
+        yield gen.sleep(0.01)
+        self.col.batches.append(self.docs)
+        raise gen.Return({'nInserted': len(self.docs)})
+
+
+class FakeCollection(object):
+    def __init__(self):
+        self.batches = []
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self)
+
+
+class BatchInserterTest(tornado.testing.AsyncTestCase):
+
+    def get_inserter(self, **kwargs):
+        self.col = FakeCollection()
+        self.stats = FakeStats()
+        return BatchInserter(self.col, self.stats, **kwargs)
+
+    @tornado.testing.gen_test
+    def test_flush_on_size(self):
+        inserter = self.get_inserter(max_items=3, linger=60)
+        for i in range(7):
+            yield inserter.put({'i': i})
+        yield gen.sleep(0.05)
+        self.assertEqual([len(batch) for batch in self.col.batches], [3, 3])
+        yield inserter.join()
+        self.assertEqual([len(batch) for batch in self.col.batches],
+                         [3, 3, 1])
+        self.assertEqual(self.stats.stats['mongo_export/items_stored_count'],
+                         7)
+
+    @tornado.testing.gen_test
+    def test_flush_on_linger(self):
+        inserter = self.get_inserter(max_items=100, linger=0.05)
+        yield inserter.put({'i': 1})
+        yield inserter.put({'i': 2})
+        self.assertEqual(self.col.batches, [])
+        yield gen.sleep(0.2)
+        self.assertEqual(self.col.batches, [[{'i': 1}, {'i': 2}]])
+
+    @tornado.testing.gen_test
+    def test_join_waits_for_prepared_documents(self):
+        inserter = self.get_inserter(max_items=100, linger=60)
+
+        @gen.coroutine
+        def prepare(doc):
+            yield gen.sleep(0.05)
+            doc['prepared'] = True
+
+        docs = [{'i': i} for i in range(3)]
+        for doc in docs:
+            yield inserter.put(doc, lambda doc=doc: prepare(doc))
+        # put doesn't wait for prepare
+        self.assertFalse(any('prepared' in doc for doc in docs))
+        yield inserter.join()
+        self.assertEqual(len(self.col.batches), 1)
+        self.assertTrue(all(doc['prepared'] for doc in self.col.batches[0]))
+
+    @tornado.testing.gen_test
+    def test_backpressure(self):
+        inserter = self.get_inserter(max_items=2, max_pending=2, linger=60)
+        for i in range(6):
+            yield inserter.put({'i': i})
+        self.assertGreater(
+            self.stats.stats['mongo_export/backpressure_wait_count'], 0)
+        yield inserter.join()
+        self.assertEqual(sum(len(batch) for batch in self.col.batches), 6)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import threading
+
+import tornado.testing
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from arachnado.storages import bodies
+
+
+class FileBodyStoreTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(FileBodyStoreTest, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.store = bodies.FileBodyStore(self.root)
+
+    @tornado.testing.gen_test
+    def test_put_get(self):
+        data = b'<html>' * 1000
+        key = bodies.body_hash(data)
+        written = yield self.store.put(key, data)
+        self.assertGreater(written, 0)
+        self.assertLess(written, len(data))
+        self.assertEqual((yield self.store.put(key, data)), 0)
+        self.assertEqual((yield self.store.get(key)), data)
+        self.assertIsNone((yield self.store.get(bodies.body_hash(b''))))
+
+    @tornado.testing.gen_test
+    def test_compressed_in_thread(self):
+        threads = []
+        compress_body = bodies.compress_body
+
+        def compress(data, codec):
+            threads.append(threading.current_thread())
+            return compress_body(data, codec)
+
+        with mock.patch.object(bodies, 'compress_body', side_effect=compress):
+            yield self.store.put(bodies.body_hash(b'<html>'), b'<html>')
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
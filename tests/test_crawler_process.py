@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import tornado.testing
+from pydispatch import dispatcher
+from twisted.internet.defer import Deferred
+from scrapy import Request
+from scrapy.core.downloader import Downloader
+from scrapy.settings import Settings
+from scrapy.signalmanager import SignalManager
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from arachnado import crawler_process
+from arachnado.crawler_process import (
+    ArachnadoDownloader, SignalRouter, signals, agg_stats_changed,
+    CrawlerProcessSignals as CPS
+)
+from arachnado.stats import EventedStatsCollector, stats_changed
+
+
+class FakeCallLaterOnce(object):
+    """ CallLaterOnce which calls the function only when fired by a test """
+    def __init__(self, func):
+        self.func = func
+        self.scheduled = False
+
+    def schedule(self, delay=0):
+        self.scheduled = True
+
+    def cancel(self):
+        self.scheduled = False
+
+    def fire(self):
+        self.scheduled = False
+        self.func()
+
+
+class FakeSlot(object):
+    def __init__(self, queued=0, active=0):
+        self.queue = [None] * queued
+        self.active = set(range(active))
+
+
+class ArachnadoDownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.deferreds = []
+        patches = [
+            mock.patch.object(crawler_process, 'CallLaterOnce',
+                              FakeCallLaterOnce),
+            # Downloader internals are not needed to test the signal
+            mock.patch.object(Downloader, '__init__', return_value=None),
+            mock.patch.object(Downloader, '_enqueue_request', mock.Mock(
+                side_effect=self._enqueue_request)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.downloader = ArachnadoDownloader(crawler=None)
+        self.downloader.signals = SignalManager()
+        self.downloader.slots = {}
+        self.activity = []
+        self.downloader.signals.connect(self.on_activity,
+                                        signals.downloader_activity)
+
+    def _enqueue_request(self, request, spider):
+        self.deferreds.append(Deferred())
+        return self.deferreds[-1]
+
+    def on_activity(self, signal, sender, **kwargs):
+        self.activity.append(kwargs)
+
+    def enqueue(self, slot):
+        request = Request('http://%s/' % slot, meta={'download_slot': slot})
+        return self.downloader._enqueue_request(request, spider=None)
+
+    def test_signals_are_coalesced(self):
+        for _ in range(3):
+            self.enqueue('example.com')
+        self.enqueue('example.org')
+        self.deferreds[0].callback('response')
+        self.assertTrue(self.downloader.send_activity.scheduled)
+        self.assertEqual(self.activity, [])
+        self.downloader.slots['example.com'] = FakeSlot(queued=1, active=1)
+        self.downloader.send_activity.fire()
+        self.assertEqual(self.activity, [{
+            'enqueued': 4,
+            'dequeued': 1,
+            'slots': {
+                'example.com': {'enqueued': 3, 'dequeued': 1,
+                                'len(queue)': 1, 'active': 1},
+                'example.org': {'enqueued': 1, 'dequeued': 0,
+                                'len(queue)': 0, 'active': 0},
+            },
+        }])
+
+    def test_counters_are_reset(self):
+        self.enqueue('example.com')
+        self.downloader.send_activity.fire()
+        self.deferreds[0].errback(ValueError())
+        self.assertTrue(self.downloader.send_activity.scheduled)
+        self.downloader.send_activity.fire()
+        self.assertEqual(len(self.activity), 2)
+        self.assertEqual(self.activity[1]['enqueued'], 0)
+        self.assertEqual(self.activity[1]['dequeued'], 1)
+        self.assertEqual(list(self.activity[1]['slots']), ['example.com'])
+
+    def test_results_are_passed_through(self):
+        dfd = self.enqueue('example.com')
+        results = []
+        dfd.addBoth(results.append)
+        self.deferreds[0].callback('response')
+        self.assertEqual(results, ['response'])
+
+
+class FakeCrawler(object):
+    settings = Settings()
+
+    def __init__(self):
+        self.signals = SignalManager(self)
+        self.stats = EventedStatsCollector(self)
+
+
+def receivers(sender, signal):
+    return list(dispatcher.getAllReceivers(sender, signal))
+
+
+class SignalRouterTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(SignalRouterTest, self).setUp()
+        self.router = SignalRouter(self)
+        self.crawler = FakeCrawler()
+        self.router.add_crawler(self.crawler)
+        self.received = []
+
+    def routes(self, crawler=None):
+        crawler = crawler or self.crawler
+        return len(receivers(crawler, signals.response_received))
+
+    def on_response(self, response, crawler, **kwargs):
+        self.received.append((response, crawler))
+
+    def on_stats(self, changes, crawler, **kwargs):
+        self.received.append((changes, crawler))
+
+    def test_signals_are_routed_when_listened_to(self):
+        self.assertEqual(self.routes(), 0)
+        self.router.connect(self.on_response, CPS.response_received)
+        self.crawler.signals.send_catch_log(signals.response_received,
+                                            response='r1')
+        self.assertEqual(self.received, [('r1', self.crawler)])
+        self.router.disconnect(self.on_response, CPS.response_received)
+        self.assertEqual(self.routes(), 0)
+        self.crawler.signals.send_catch_log(signals.response_received,
+                                            response='r2')
+        self.assertEqual(len(self.received), 1)
+
+    def test_route_is_kept_while_there_are_receivers(self):
+        other = []
+        receiver = lambda response, **kwargs: other.append(response)
+        self.router.connect(self.on_response, CPS.response_received)
+        self.router.connect(receiver, CPS.response_received)
+        self.router.disconnect(self.on_response, CPS.response_received)
+        self.crawler.signals.send_catch_log(signals.response_received,
+                                            response='r1')
+        self.assertEqual(other, ['r1'])
+        self.assertEqual(self.routes(), 1)
+        self.router.disconnect(receiver, CPS.response_received)
+        self.assertEqual(self.routes(), 0)
+
+    def test_crawlers_added_later(self):
+        self.router.connect(self.on_response, CPS.response_received)
+        crawler = FakeCrawler()
+        self.router.add_crawler(crawler)
+        self.assertEqual(self.routes(crawler), 1)
+        crawler.signals.send_catch_log(signals.response_received,
+                                       response='r1')
+        self.assertEqual(self.received, [('r1', crawler)])
+
+    def test_stats_changes(self):
+        self.router.connect(self.on_stats, agg_stats_changed)
+        self.assertEqual(len(receivers(self.crawler.stats, stats_changed)),
+                         1)
+        self.assertEqual(self.router.stats_ticker.subscribers, 1)
+        self.crawler.stats.set_value('pages', 10)
+        self.router.stats_ticker.tick()
+        self.assertEqual(self.received, [({'pages': 10}, self.crawler)])
+        self.router.disconnect(self.on_stats, agg_stats_changed)
+        self.assertEqual(self.router.stats_ticker.subscribers, 0)
+        self.assertEqual(receivers(self.crawler.stats, stats_changed), [])
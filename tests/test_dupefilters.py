@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from scrapy.http import Request
+
+from arachnado.dupefilters import BloomDupeFilter
+
+
+class FakeStats(dict):
+    def set_value(self, key, value):
+        self[key] = value
+
+    def get_value(self, key, default=None):
+        return self.get(key, default)
+
+
+class FakeCrawler(object):
+    def __init__(self):
+        self.stats = FakeStats()
+
+
+def fingerprint(dupefilter, request):
+    return hashlib.sha1(request.url.encode('utf8')).hexdigest()
+
+
+class BloomDupeFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        # fingerprint implementation differs between Scrapy versions
+        patch = mock.patch.object(BloomDupeFilter, 'request_fingerprint',
+                                  fingerprint)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_stats_without_duplicates(self):
+        df = BloomDupeFilter()
+        df.set_crawler(FakeCrawler())
+        df.open()
+        for i in range(10):
+            request = Request('http://example.com/%d' % i)
+            self.assertFalse(df.request_seen(request))
+        df.close('finished')
+        self.assertEqual(df.stats.get_value('dupefilter/bloom/count'), 10)
+        self.assertGreater(df.stats.get_value('dupefilter/bloom/bytes'), 0)
+
+    def test_periodic_save(self):
+        df = BloomDupeFilter(path=self.path, save_interval=60)
+        df.request_seen(Request('http://example.com/1'))
+        self.assertFalse(os.path.exists(os.path.join(self.path,
+                                                     'requests.bloom')))
+        df._saved_at -= 61
+        df.request_seen(Request('http://example.com/2'))
+        df.request_seen(Request('http://example.com/3'))  # not saved yet
+        # the process crashes: close() is not called
+        df = BloomDupeFilter(path=self.path)
+        self.assertTrue(df.request_seen(Request('http://example.com/1')))
+        self.assertTrue(df.request_seen(Request('http://example.com/2')))
+        self.assertFalse(df.request_seen(Request('http://example.com/3')))
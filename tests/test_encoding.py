@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+
+import tornado.testing
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from arachnado.utils import misc
+from arachnado.monitor import stats_changed_event
+
+
+class FakeSpider(object):
+    crawl_id = '1'
+
+
+class FakeCrawler(object):
+    spider = FakeSpider()
+
+
+class BroadcastCacheTest(tornado.testing.AsyncTestCase):
+
+    def test_broadcast_is_encoded_once(self):
+        changes = {'item_scraped_count': 10}
+        with mock.patch.object(misc, 'json_encode',
+                               wraps=misc.json_encode) as json_encode:
+            messages = [
+                misc.json_encode_broadcast(
+                    stats_changed_event(changes, FakeCrawler()))
+                for _ in range(5)
+            ]
+        self.assertEqual(json_encode.call_count, 1)
+        self.assertEqual(len(set(messages)), 1)
+        self.assertEqual(json.loads(messages[0]),
+                         ['1', {'item_scraped_count': 10}])
+
+    def test_new_changes_are_encoded(self):
+        first = stats_changed_event({'a': 1}, FakeCrawler())
+        second = stats_changed_event({'a': 2}, FakeCrawler())
+        self.assertIsNot(first, second)
+        self.assertEqual(second, ['1', {'a': 2}])
+
+
+class JsonEncodeAsyncTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(JsonEncodeAsyncTest, self).setUp()
+        patch = mock.patch.object(misc, 'JSON_THREAD_THRESHOLD', 100)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    @tornado.testing.gen_test
+    def test_large_message_is_encoded_in_thread(self):
+        threads = []
+        json_encode = misc.json_encode
+
+        def encode(obj):
+            threads.append(threading.current_thread())
+            return json_encode(obj)
+
+        data = {'stats': {'key%d' % i: i for i in range(100)}}
+        with mock.patch.object(misc, 'json_encode', side_effect=encode):
+            future = misc.json_encode_async(data)
+            # the object may be changed while it is being encoded
+            for i in range(100, 1000):
+                data['stats']['key%d' % i] = i
+            message = yield future
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+        self.assertEqual(len(json.loads(message)['stats']), 100)
+
+    @tornado.testing.gen_test
+    def test_small_message_is_encoded_in_place(self):
+        with mock.patch.object(misc, 'ThreadPoolExecutor') as executor:
+            message = yield misc.json_encode_async({'a': 1})
+        self.assertEqual(json.loads(message), {'a': 1})
+        self.assertFalse(executor.called)
+
+    @tornado.testing.gen_test
+    def test_async_cache(self):
+        data = {'stats': {'key%d' % i: i for i in range(100)}}
+        first = misc.json_encode_async(data)
+        second = misc.json_encode_async(data)
+        self.assertIs(first, second)
+        yield first
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from twisted.internet import defer
+from scrapy.http import Request, Response
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from arachnado.downloadermiddlewares.httpcache import HttpCacheMiddleware
+
+
+class FakeAsyncStorage(object):
+    responses = {}
+
+    def __init__(self, settings):
+        pass
+
+    def open_spider(self, spider):
+        pass
+
+    def close_spider(self, spider):
+        pass
+
+    def retrieve_response(self, spider, request):
+        raise AssertionError("blocking lookup")
+
+    def retrieve_response_async(self, spider, request):
+        return defer.succeed(self.responses.get(request.url))
+
+    def store_response(self, spider, request, response):
+        pass
+
+
+class HttpCacheMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spider = Spider('test')
+        self.crawler = get_crawler(Spider, {
+            'HTTPCACHE_ENABLED': True,
+            'HTTPCACHE_STORAGE': __name__ + '.FakeAsyncStorage',
+        })
+        self.mw = HttpCacheMiddleware.from_crawler(self.crawler)
+        self.stats = self.crawler.stats
+        FakeAsyncStorage.responses = {
+            'http://example.com/': Response('http://example.com/', body=b'ok'),
+        }
+
+    def process_request(self, url):
+        results = []
+        d = self.mw.process_request(Request(url), self.spider)
+        d.addBoth(results.append)
+        return results[0]
+
+    def test_hit(self):
+        response = self.process_request('http://example.com/')
+        self.assertEqual(response.body, b'ok')
+        self.assertIn('cached', response.flags)
+        self.assertEqual(self.stats.get_value('httpcache/hit'), 1)
+
+    def test_miss(self):
+        self.assertIsNone(self.process_request('http://example.com/missing'))
+        self.assertEqual(self.stats.get_value('httpcache/miss'), 1)
+        self.assertIsInstance(self.mw.storage, FakeAsyncStorage)
+
+    def test_dont_cache(self):
+        request = Request('http://example.com/', meta={'dont_cache': True})
+        self.assertIsNone(self.mw.process_request(request, self.spider))
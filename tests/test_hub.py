@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import tornado.testing
+from tornado import gen
+from bson.objectid import ObjectId
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from arachnado.storages import hub
+
+
+class FakeCursor(object):
+    """ A cursor which returns a document per IOLoop iteration """
+    def __init__(self, docs):
+        self.docs = list(docs)
+
+    @property
+    @gen.coroutine
+    def fetch_next(self):
+        yield gen.moment
+        raise gen.Return(bool(self.docs))
+
+    def next_object(self):
+        return self.docs.pop(0)
+
+
+class TailHubTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TailHubTest, self).setUp()
+        patch = mock.patch.object(hub, 'MongoTailStorage')
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.hub = hub.TailHub('mongodb://localhost/db/items')
+
+    def get_storage(self):
+        tail, = self.hub._tails.values()
+        return tail.storage
+
+    def test_fetch_delay_is_recomputed(self):
+        fast = self.hub.subscribe(lambda doc: None, {'a': 1})
+        slow = self.hub.subscribe(lambda doc: None, {'a': 1}, fetch_delay=2)
+        storage = self.get_storage()
+        self.assertEqual(storage.fetch_delay, 2)
+        self.hub.unsubscribe(slow)
+        self.assertEqual(storage.fetch_delay, 0)
+        self.hub.subscribe(lambda doc: None, {'a': 1}, fetch_delay=0.5)
+        self.assertEqual(storage.fetch_delay, 0.5)
+        self.hub.unsubscribe(fast)
+        self.assertEqual(storage.fetch_delay, 0.5)
+
+    def start_tail(self, docs):
+        """ Start a tail which has sent ``docs`` """
+        self.hub.subscribe(lambda doc: None, {'a': 1})
+        tail, = self.hub._tails.values()
+        tail.storage.find_cursor.return_value = FakeCursor(docs)
+        for doc in docs:
+            tail._on_document(doc)
+        return tail
+
+    @tornado.testing.gen_test
+    def test_unsubscribe_during_catch_up(self):
+        docs = [{'_id': ObjectId()} for _ in range(5)]
+        self.start_tail(docs)
+        received = []
+
+        def callback(doc):
+            received.append(doc)
+            if len(received) == 2:
+                self.hub.unsubscribe(subscription)
+
+        subscription = self.hub.subscribe(callback, {'a': 1}, last_id=0)
+        yield gen.sleep(0.01)
+        self.assertEqual(received, docs[:2])
+
+    @tornado.testing.gen_test
+    def test_pending_documents_after_unsubscribe(self):
+        docs = [{'_id': ObjectId()} for _ in range(3)]
+        tail = self.start_tail(docs)
+        received = []
+        subscription = self.hub.subscribe(received.append, {'a': 1},
+                                          last_id=0)
+        # a new document is sent while the subscriber catches up
+        tail._on_document({'_id': ObjectId()})
+        self.hub.unsubscribe(subscription)
+        yield gen.sleep(0.01)
+        self.assertEqual(received, [])
+
+    @tornado.testing.gen_test
+    def test_catch_up(self):
+        docs = [{'_id': ObjectId()} for _ in range(3)]
+        tail = self.start_tail(docs)
+        received = []
+        self.hub.subscribe(received.append, {'a': 1}, last_id=0)
+        # a document sent during a catch-up is delivered after it
+        new_doc = {'_id': ObjectId()}
+        tail._on_document(new_doc)
+        yield gen.sleep(0.01)
+        self.assertEqual(received, docs + [new_doc])
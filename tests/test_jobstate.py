@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import tornado.testing
+from tornado import gen
+from scrapy.signalmanager import SignalManager
+
+from arachnado.crawler_process import CrawlerProcessSignals as CPS
+from arachnado.jobstate import JobsStateTracker
+
+
+class FakeCrawlerProcess(object):
+    def __init__(self):
+        self.signals = SignalManager(self)
+        self.jobs = []
+
+
+def job(job_id, status='crawling', **stats):
+    return {'id': job_id, 'status': status, 'stats': stats}
+
+
+class JobsStateTrackerTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(JobsStateTrackerTest, self).setUp()
+        self.cp = FakeCrawlerProcess()
+        self.tracker = JobsStateTracker(self.cp, interval=0.01)
+        self.deltas = []
+
+    def on_delta(self, delta):
+        self.deltas.append(delta)
+
+    def test_new_jobs(self):
+        delta = self.tracker.compute_delta([job('a', pages=1), job('b')])
+        self.assertEqual(delta, {
+            'seq': 1,
+            'jobs': [
+                {'id': 'a', 'version': 1, 'full': True,
+                 'changes': job('a', pages=1)},
+                {'id': 'b', 'version': 1, 'full': True, 'changes': job('b')},
+            ],
+            'removed': [],
+            'order': ['a', 'b'],
+        })
+
+    def test_changed_fields(self):
+        self.tracker.compute_delta([job('a', pages=1, items=1), job('b')])
+        delta = self.tracker.compute_delta([
+            job('a', status='suspended', pages=2), job('b')])
+        self.assertEqual(delta, {
+            'seq': 2,
+            'jobs': [{'id': 'a', 'version': 2, 'full': False, 'changes': {
+                'status': 'suspended',
+                'stats': {'pages': 2},
+                'stats_removed': ['items'],
+            }}],
+            'removed': [],
+        })
+
+    def test_removed_and_reordered_jobs(self):
+        self.tracker.compute_delta([job('a'), job('b'), job('c')])
+        delta = self.tracker.compute_delta([job('c'), job('a')])
+        self.assertEqual(delta, {'seq': 2, 'jobs': [], 'removed': ['b'],
+                                 'order': ['c', 'a']})
+        # a job which is started again gets a full update
+        delta = self.tracker.compute_delta([job('c'), job('a'), job('b')])
+        self.assertEqual(delta['jobs'], [
+            {'id': 'b', 'version': 1, 'full': True, 'changes': job('b')}])
+
+    def test_seq_is_monotonic(self):
+        jobs_lists = [
+            [job('a')],
+            [job('a')],  # no changes
+            [job('a', pages=1)],
+            [job('a', pages=1), job('b')],
+            [job('a', pages=1), job('b')],
+            [job('b')],
+            [],
+        ]
+        seqs = []
+        for jobs in jobs_lists:
+            delta = self.tracker.compute_delta(jobs)
+            if delta is not None:
+                seqs.append(delta['seq'])
+        self.assertEqual(seqs, [1, 2, 3, 4, 5])
+        self.assertEqual(self.tracker.seq, 5)
+
+    def test_shared_stats_are_copied(self):
+        stats = {'pages': 1}
+        self.cp.jobs = [{'id': 'a', 'status': 'crawling', 'stats': stats}]
+        self.tracker.update()
+        stats['pages'] = 2
+        delta = self.tracker.compute_delta(self.cp.jobs)
+        self.assertEqual(delta['jobs'][0]['changes'], {'stats': {'pages': 2}})
+
+    def test_snapshot(self):
+        self.tracker.subscribe(self.on_delta)
+        self.cp.jobs = [job('a'), job('b')]
+        self.tracker.compute_delta(self.cp.jobs)
+        self.cp.jobs = [job('a', pages=1), job('b')]
+        # pending changes are sent before the snapshot is returned
+        snapshot = self.tracker.snapshot()
+        self.assertEqual(snapshot, [dict(job('a', pages=1), version=2),
+                                    dict(job('b'), version=1)])
+        self.assertEqual([delta['seq'] for delta in self.deltas], [2])
+        self.tracker.unsubscribe(self.on_delta)
+
+    @tornado.testing.gen_test
+    def test_updates_are_coalesced(self):
+        self.tracker.subscribe(self.on_delta)
+        self.cp.jobs = [job('a')]
+        for pages in range(5):
+            self.cp.jobs = [job('a', pages=pages)]
+            self.cp.signals.send_catch_log(CPS.engine_tick)
+        yield gen.sleep(0.05)
+        self.assertEqual(len(self.deltas), 1)
+        self.assertEqual(self.deltas[0]['jobs'][0]['changes'],
+                         job('a', pages=4))
+        self.tracker.unsubscribe(self.on_delta)
+
+    @tornado.testing.gen_test
+    def test_signals_are_disconnected(self):
+        self.tracker.subscribe(self.on_delta)
+        self.tracker.unsubscribe(self.on_delta)
+        self.cp.jobs = [job('a')]
+        self.cp.signals.send_catch_log(CPS.engine_tick)
+        yield gen.sleep(0.05)
+        self.assertEqual(self.deltas, [])
+        self.assertEqual(self.tracker.seq, 0)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+from collections import deque
+
+import tornado.testing
+from tornado import gen
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from arachnado import metrics
+
+
+class FakeStats(object):
+    def __init__(self, stats):
+        self.stats = stats
+
+    def get_stats(self):
+        return self.stats
+
+
+class FakeSpider(object):
+    def __init__(self, crawl_id, name):
+        self.crawl_id = crawl_id
+        self.name = name
+
+
+class FakeSlot(object):
+    concurrency = 8
+
+    def __init__(self):
+        self.active = {1, 2}
+        self.transferring = {1}
+        self.queue = deque([3])
+
+
+class FakeCrawler(object):
+    def __init__(self, crawl_id, stats):
+        self.spider = FakeSpider(crawl_id, 'generic')
+        self.stats = FakeStats(stats)
+        self.metrics = metrics.CrawlerMetrics()
+        self.engine = mock.Mock()
+        self.engine.downloader.slots = {'example.com': FakeSlot()}
+
+
+class FakeCrawlerProcess(object):
+    def __init__(self):
+        self.crawlers = []
+        self.finished_jobs = []
+        self.procmon = mock.Mock()
+        self.procmon.get_recent.return_value = {'cpu_percent': 12.5,
+                                                'ram_rss': 1024}
+
+    def get_active_crawlers(self):
+        return self.crawlers
+
+
+class MetricsExporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cp = FakeCrawlerProcess()
+        self.cp.crawlers.append(FakeCrawler('1', {
+            'downloader/request_count': 10,
+            'item_scraped_count': 3,
+            'downloader/response_status_count/200': 8,
+            'downloader/response_status_count/404': 2,
+            'scheduler/enqueued': 15,
+            'scheduler/dequeued': 10,
+        }))
+        self.cp.finished_jobs.append({'id': '0', 'stats': {
+            'downloader/request_count': 5,
+            'downloader/response_status_count/200': 5,
+        }})
+        self.loop_lag = metrics.LoopLagMonitor()
+        self.exporter = metrics.MetricsExporter(self.cp, cache_ttl=60,
+                                                loop_lag=self.loop_lag)
+
+    def samples(self):
+        return [line for line in self.exporter.render().splitlines()
+                if not line.startswith('#')]
+
+    def test_render(self):
+        self.loop_lag.histogram.observe(0.02)
+        self.cp.crawlers[0].metrics.mongo_export_latency.observe(0.2)
+        samples = self.samples()
+        for line in [
+            'arachnado_process_cpu_percent 12.5',
+            'arachnado_process_resident_memory_bytes 1024',
+            'arachnado_event_loop_lag_seconds_bucket{le="0.025"} 1',
+            'arachnado_event_loop_lag_seconds_count 1',
+            'arachnado_job_requests_total{job="1",spider="generic"} 10',
+            'arachnado_requests_total 15',
+            'arachnado_items_total 3',
+            'arachnado_job_responses_total{job="1",spider="generic",'
+            'status="404"} 2',
+            'arachnado_responses_total{status="200"} 13',
+            'arachnado_job_scheduler_depth{job="1",spider="generic"} 5',
+            'arachnado_jobs{state="active"} 1',
+            'arachnado_jobs{state="finished"} 1',
+            'arachnado_mongo_export_latency_seconds_count'
+            '{job="1",spider="generic"} 1',
+            'arachnado_slot_active_requests'
+            '{job="1",slot="example.com",spider="generic"} 2',
+            'arachnado_slot_queued_requests'
+            '{job="1",slot="example.com",spider="generic"} 1',
+        ]:
+            self.assertIn(line, samples)
+        self.assertNotIn('arachnado_process_open_fds', '\n'.join(samples))
+
+    def test_finished_job_is_not_active(self):
+        self.cp.finished_jobs.append({'id': '1', 'stats': {}})
+        samples = self.samples()
+        self.assertIn('arachnado_jobs{state="active"} 0', samples)
+        self.assertFalse([line for line in samples if 'job="1"' in line])
+
+    def test_mongo_clients(self):
+        wait_time = metrics.Histogram()
+        wait_time.observe(0.3)
+        registry = mock.Mock()
+        registry.get_stats.return_value = {
+            'clients_count': 1,
+            'clients': [{'uri': 'mongodb://localhost/', 'refs': 3,
+                         'max_pool_size': 100, 'open_connections': 2,
+                         'waiting_count': 0, 'wait_time': wait_time}],
+        }
+        self.exporter.mongo_clients = registry
+        samples = self.samples()
+        for line in [
+            'arachnado_mongo_clients 1',
+            'arachnado_mongo_client_refs{uri="mongodb://localhost/"} 3',
+            'arachnado_mongo_pool_open_connections'
+            '{uri="mongodb://localhost/"} 2',
+            'arachnado_mongo_pool_wait_seconds_bucket'
+            '{le="0.5",uri="mongodb://localhost/"} 1',
+            'arachnado_mongo_pool_wait_seconds_count'
+            '{uri="mongodb://localhost/"} 1',
+        ]:
+            self.assertIn(line, samples)
+
+    def test_cache(self):
+        first = self.exporter.render()
+        self.cp.crawlers = []
+        self.assertIs(self.exporter.render(), first)
+
+
+class LoopLagMonitorTest(tornado.testing.AsyncTestCase):
+
+    @tornado.testing.gen_test
+    def test_wall_clock_jump_is_not_lag(self):
+        monitor = metrics.LoopLagMonitor(interval=0.01)
+        monitor.start()
+        self.addCleanup(monitor.stop)
+        jump = time.time() + 3600
+        with mock.patch('time.time', return_value=jump):
+            yield gen.sleep(0.1)
+        self.assertGreater(monitor.histogram.count, 0)
+        self.assertLess(monitor.histogram.sum, 1)
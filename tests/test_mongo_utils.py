@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import tornado.testing
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from arachnado.utils import mongo
+
+
+class MotorClientRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(mongo.motor, 'MotorClient',
+                                  side_effect=lambda *a, **kw: mock.Mock())
+        self.MotorClient = patch.start()
+        self.addCleanup(patch.stop)
+        self.registry = mongo.MotorClientRegistry(max_pool_size=10)
+
+    def test_shared_client(self):
+        items = self.registry.acquire('mongodb://localhost/arachnado/items')
+        jobs = self.registry.acquire('mongodb://localhost/arachnado/jobs')
+        other = self.registry.acquire('mongodb://localhost/other/items')
+        self.assertIs(items, jobs)
+        self.assertIs(items, other)
+        self.assertEqual(self.MotorClient.call_count, 1)
+        args, kwargs = self.MotorClient.call_args
+        self.assertEqual(args, ('mongodb://localhost/',))
+        self.assertEqual(kwargs[mongo.MAX_POOL_SIZE_OPTION], 10)
+        client, = self.registry.get_stats()['clients']
+        self.assertEqual(client['refs'], 3)
+
+    def test_closed_on_last_release(self):
+        first = self.registry.acquire('mongodb://localhost/arachnado/items')
+        second = self.registry.acquire('mongodb://localhost/arachnado/jobs')
+        self.registry.release(first)
+        self.assertFalse(first.close.called)
+        self.registry.release(second)
+        first.close.assert_called_once_with()
+        self.assertEqual(self.registry.get_stats()['clients_count'], 0)
+
+        # a new client is created after the old one is closed
+        third = self.registry.acquire('mongodb://localhost/arachnado/items')
+        self.assertIsNot(third, first)
+        self.registry.release(first)  # already released: ignored
+        self.assertFalse(third.close.called)
+
+    def test_different_servers(self):
+        first = self.registry.acquire('mongodb://host1/arachnado/items')
+        second = self.registry.acquire('mongodb://host2/arachnado/items')
+        self.assertIsNot(first, second)
+        self.assertEqual(self.registry.get_stats()['clients_count'], 2)
+
+
+class MotorFromUriTest(tornado.testing.AsyncTestCase):
+
+    def test_client_options(self):
+        # clients connect lazily, so a server is not needed
+        client, db_name, db, col_name, col = mongo.motor_from_uri(
+            'mongodb://localhost:27017/arachnado/items')
+        self.addCleanup(mongo.release_client, client)
+        self.assertEqual((db_name, col_name), ('arachnado', 'items'))
+        self.assertIs(mongo.motor_from_uri(
+            'mongodb://localhost:27017/arachnado/jobs')[0], client)
+        mongo.release_client(client)
+
+
+class PoolListenerTest(unittest.TestCase):
+
+    def test_wait_time(self):
+        listener = mongo._PoolListener()
+        with mock.patch('time.time', side_effect=[10.0, 10.5]):
+            listener.connection_check_out_started(None)
+            self.assertEqual(listener.waiting_count, 1)
+            listener.connection_checked_out(None)
+        stats = listener.get_stats()
+        self.assertEqual(stats['waiting_count'], 0)
+        self.assertEqual(stats['checked_out_connections'], 1)
+        self.assertEqual(stats['wait_time'].count, 1)
+        self.assertEqual(stats['wait_time'].sum, 0.5)
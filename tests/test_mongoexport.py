@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import copy
+
+import tornado.testing
+from tornado import gen
+from bson.objectid import ObjectId
+from scrapy.settings import Settings
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import arachnado.crawler_process  # adds spider_closing signal
+from arachnado.pipelines import mongoexport
+from arachnado.utils.mongo import restore_stats_keys
+
+
+class FakeStats(object):
+    def __init__(self):
+        self.stats = {}
+
+    def get_stats(self):
+        return self.stats
+
+    def get_value(self, key, default=None):
+        return self.stats.get(key, default)
+
+    def set_value(self, key, value):
+        self.stats[key] = value
+
+    def inc_value(self, key, count=1):
+        self.stats[key] = self.stats.get(key, 0) + count
+
+
+class FakeCrawler(object):
+    def __init__(self, settings):
+        self.settings = Settings(settings)
+        self.stats = FakeStats()
+        self.signals = mock.Mock()
+
+
+class FakeJobsCollection(object):
+    """ Applies $set, $inc and $unset updates to a single document """
+    def __init__(self):
+        self.doc = {}
+
+    @gen.coroutine
+    def update(self, query, update):
+        self.check_conflicts(update)
+        for path, value in update.get('$set', {}).items():
+            parent, key = self._parent(path)
+            parent[key] = copy.deepcopy(value)
+        for path, value in update.get('$inc', {}).items():
+            parent, key = self._parent(path)
+            parent[key] = parent.get(key, 0) + value
+        for path in update.get('$unset', {}):
+            parent, key = self._parent(path)
+            parent.pop(key, None)
+
+    def check_conflicts(self, update):
+        paths = [path for op in update.values() for path in op]
+        assert len(paths) == len(set(paths)), update
+
+    def _parent(self, path):
+        doc = self.doc
+        parts = path.split('.')
+        for part in parts[:-1]:
+            doc = doc.setdefault(part, {})
+        return doc, parts[-1]
+
+
+class FakeItemsCollection(object):
+    def __init__(self):
+        self.docs = []
+        self.find_one_count = 0
+
+    @gen.coroutine
+    def insert(self, doc):
+        doc['_id'] = ObjectId()
+        self.docs.append(copy.deepcopy(doc))
+
+    @gen.coroutine
+    def find_one(self, query, fields=None, sort=None):
+        # only queries used by MongoExportPipeline._find_unchanged_body
+        self.find_one_count += 1
+        assert sort == [('_id', -1)]
+        docs = [doc for doc in self.docs if doc['url'] == query['url']]
+        raise gen.Return(docs[-1] if docs else None)
+
+
+class StatsUpdateTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(StatsUpdateTest, self).setUp()
+        self.jobs_col = FakeJobsCollection()
+        patch = mock.patch.object(mongoexport, 'motor_from_uri',
+                                  return_value=(None, None, None, None,
+                                                self.jobs_col))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.crawler = FakeCrawler({
+            'MONGO_EXPORT_ENABLED': True,
+            'MONGO_EXPORT_ITEMS_URI': 'mongodb://localhost/db/items',
+            'MONGO_EXPORT_JOBS_URI': 'mongodb://localhost/db/jobs',
+        })
+        self.pipeline = mongoexport.MongoExportPipeline(self.crawler)
+        self.pipeline.job_id = str(ObjectId())
+
+    @gen.coroutine
+    def assert_stored(self, stats):
+        self.crawler.stats.stats = stats
+        yield self.pipeline._update_stats()
+        self.assertEqual(restore_stats_keys(self.jobs_col.doc), stats)
+
+    @tornado.testing.gen_test
+    def test_round_trip(self):
+        yield self.assert_stored({
+            'downloader/request_count': 1,
+            'downloader/exception_type_count/twisted.internet.error.'
+            'TimeoutError': 1,
+            'finish_reason': 'finished',
+        })
+        yield self.assert_stored({
+            'downloader/request_count': 5,
+            'downloader/exception_type_count/twisted.internet.error.'
+            'TimeoutError': 3,
+            'start_time': 'yesterday',
+        })
+
+    @tornado.testing.gen_test
+    def test_escaped_keys_collision(self):
+        yield self.assert_stored({'a.b': 1, 'a_b': 10})
+        yield self.assert_stored({'a.b': 2, 'a_b': 15})
+        yield self.assert_stored({'a_b': 20, 'a.b': 5})
+        yield self.assert_stored({'a_b': 21})
+        yield self.assert_stored({'a_b': 22, 'a.b': 1})
+
+
+class DedupBodiesTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(DedupBodiesTest, self).setUp()
+        self.items_col = FakeItemsCollection()
+        patch = mock.patch.object(mongoexport, 'motor_from_uri',
+                                  return_value=(None, None, None, None,
+                                                self.items_col))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.crawler = FakeCrawler({
+            'MONGO_EXPORT_ENABLED': True,
+            'MONGO_EXPORT_JOBID_KEY': '_job_id',
+            'MONGO_EXPORT_DEDUP_BODIES': True,
+        })
+        self.pipeline = mongoexport.MongoExportPipeline(self.crawler)
+
+    @gen.coroutine
+    def store(self, job_id, body, url='http://example.com'):
+        item = {'_job_id': job_id, 'body': body}
+        if url is not None:
+            item['url'] = url
+        yield self.pipeline._process_body(item)
+        yield self.items_col.insert(item)
+        raise gen.Return(item)
+
+    @tornado.testing.gen_test
+    def test_unchanged_body(self):
+        first = yield self.store('1', u'<html>привет</html>')
+        self.assertIn('body', first)
+        self.assertNotIn('unchanged_since', first)
+        second = yield self.store('2', u'<html>привет</html>')
+        self.assertNotIn('body', second)
+        self.assertEqual(second['body_hash'], first['body_hash'])
+        self.assertEqual(second['body_length'], 25)  # UTF-8 bytes
+        self.assertEqual(second['unchanged_since'],
+                         {'job_id': '1', 'item_id': first['_id']})
+        # the page which has the body is referenced, not the previous one
+        third = yield self.store('3', u'<html>привет</html>')
+        self.assertEqual(third['unchanged_since'], second['unchanged_since'])
+        stats = self.crawler.stats.stats
+        self.assertEqual(stats['mongo_export/dedup_hit_count'], 2)
+        self.assertEqual(stats['mongo_export/dedup_miss_count'], 1)
+        self.assertEqual(stats['mongo_export/dedup_bytes_saved'], 50)
+        self.assertEqual(stats['mongo_export/dedup_hit_rate'], 0.6667)
+
+    @tornado.testing.gen_test
+    def test_only_the_latest_page_is_compared(self):
+        yield self.store('1', u'old')
+        yield self.store('2', u'new')
+        item = yield self.store('3', u'old')
+        self.assertEqual(item['body'], u'old')
+        self.assertNotIn('unchanged_since', item)
+        other_url = yield self.store('3', u'new', url='http://example.org')
+        self.assertNotIn('unchanged_since', other_url)
+
+    @tornado.testing.gen_test
+    def test_items_without_url(self):
+        yield self.store('1', u'body', url=None)
+        item = yield self.store('2', u'body', url=None)
+        self.assertEqual(item['body'], u'body')
+        self.assertIn('body_hash', item)
+        self.assertEqual(self.items_col.find_one_count, 0)
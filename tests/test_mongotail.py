@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import time
+
+import tornado.testing
+from tornado import gen
+from bson.objectid import ObjectId
+from pymongo.errors import InvalidOperation
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from arachnado.storages import mongotail, notifier
+from arachnado.storages.notifier import ChangeNotifier
+
+
+class FakeCursor(object):
+    """ A cursor which runs a query when the first batch is fetched """
+    def __init__(self, col, query):
+        self.col = col
+        self.query = query
+        self.docs = None
+
+    @gen.coroutine
+    def _fetch(self):
+        last_id = self.query.get('_id', {}).get('$gt')
+        docs = [doc for doc in self.col.docs
+                if last_id is None or doc['_id'] > last_id]
+        yield gen.sleep(self.col.latency)  # a round trip
+        self.docs = docs
+
+    @property
+    @gen.coroutine
+    def fetch_next(self):
+        if self.docs is None:
+            yield self._fetch()
+        raise gen.Return(bool(self.docs))
+
+    def next_object(self):
+        return self.docs.pop(0)
+
+
+class FakeCollection(object):
+    def __init__(self):
+        self.docs = []
+        self.find_count = 0
+        self.latency = 0.01
+
+    def find(self, query, fields=None):
+        self.find_count += 1
+        return FakeCursor(self, query)
+
+    def insert(self, doc):
+        doc['_id'] = ObjectId()
+        self.docs.append(doc)
+
+
+class MongoTailStorageTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(MongoTailStorageTest, self).setUp()
+        self.col = FakeCollection()
+        self.notifier = ChangeNotifier('mongodb://localhost/db/col')
+        self.notifier.mode = 'change_stream'
+        patches = [
+            mock.patch('arachnado.storages.mongo.motor_from_uri',
+                       return_value=(None, 'db', None, 'col', self.col)),
+            mock.patch.object(mongotail, 'acquire_notifier',
+                              return_value=self.notifier),
+            mock.patch.object(mongotail, 'release_notifier'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.storage = mongotail.MongoTailStorage('mongodb://localhost/db/col')
+        self.storage.poll_interval = 0.2
+        self.storage.idle_poll_interval = 5
+        self.received = []
+        self.addCleanup(self.storage.untail)
+
+    def tail(self):
+        # subscribing to "tailed" event starts tailing
+        self.storage.subscribe('tailed', self.on_tailed)
+
+    def on_tailed(self, data):
+        self.received.append((time.time(), data))
+
+    def insert(self, value):
+        self.col.insert({'value': value})
+        self.notifier._notify()
+        return time.time()
+
+    @gen.coroutine
+    def wait_for(self, count, timeout=2):
+        deadline = time.time() + timeout
+        while len(self.received) < count and time.time() < deadline:
+            yield gen.sleep(0.01)
+
+    @tornado.testing.gen_test
+    def test_insert_while_sending(self):
+        # a notification arrives while documents are being sent
+        for value in range(3):
+            self.col.insert({'value': value})
+        self.storage.fetch_delay = 0.05
+        self.tail()
+        yield self.wait_for(1)
+        inserted_at = self.insert('new')
+        yield self.wait_for(4)
+        self.assertEqual([data['value'] for _, data in self.received],
+                         [0, 1, 2, 'new'])
+        self.assertLess(self.received[-1][0] - inserted_at, 0.5)
+
+    @tornado.testing.gen_test
+    def test_insert_during_query(self):
+        # a notification arrives while an empty query is running;
+        # the query takes longer than notifications are coalesced
+        self.col.latency = self.notifier.notify_delay * 2
+        self.tail()
+        yield gen.sleep(self.col.latency * 3)  # the first query is empty
+        find_count = self.col.find_count
+        self.notifier._notify_all()
+        while self.col.find_count == find_count:
+            yield gen.sleep(0.001)
+        inserted_at = self.insert('new')
+        yield self.wait_for(1)
+        self.assertEqual([data['value'] for _, data in self.received],
+                         ['new'])
+        self.assertLess(self.received[-1][0] - inserted_at, 0.5)
+
+    @tornado.testing.gen_test
+    def test_requery_rate_is_limited(self):
+        # other documents are inserted to the collection all the time
+        self.tail()
+        yield gen.sleep(0.05)
+        find_count = self.col.find_count
+        for _ in range(50):
+            self.notifier._notify()
+            yield gen.sleep(0.01)
+        # 0.5s of notifications, re-queries are at least 0.2s apart
+        self.assertLessEqual(self.col.find_count - find_count, 3)
+
+
+class FakeChangeStream(object):
+    def __init__(self):
+        self.future = None
+        self.closed = False
+
+    def next(self):
+        self.future = gen.Future()
+        return self.future
+
+    def close(self):
+        self.closed = True
+        self.future.set_exception(InvalidOperation("stream is closed"))
+
+
+class ChangeNotifierTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(ChangeNotifierTest, self).setUp()
+        self.stream = FakeChangeStream()
+        self.col = mock.Mock()
+        self.col.watch.return_value = self.stream
+        self.client = object()
+        patches = [
+            mock.patch.object(notifier, 'motor_from_uri', return_value=(
+                self.client, 'db', None, 'col', self.col)),
+            mock.patch.object(notifier, 'release_client'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.notifier = ChangeNotifier('mongodb://localhost/db/col')
+
+    @tornado.testing.gen_test
+    def test_change_stream(self):
+        self.notifier.start()
+        yield gen.sleep(0.01)
+        self.assertEqual(self.notifier.mode, 'change_stream')
+        generation = self.notifier.generation
+        self.stream.future.set_result({'_id': 'token'})
+        yield self.notifier.wait(1)
+        self.assertEqual(self.notifier.generation, generation + 1)
+        self.notifier.stop()
+        yield gen.sleep(0.01)
+        self.assertTrue(self.stream.closed)
+
+    @tornado.testing.gen_test
+    def test_stop_closes_stream(self):
+        self.notifier.start()
+        yield gen.sleep(0.01)
+        self.notifier.stop()
+        yield gen.sleep(0.01)
+        self.assertTrue(self.stream.closed)
+        notifier.release_client.assert_called_once_with(self.client)
+        self.assertFalse(self.notifier.active)
+
+
+class FindCursorTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(FindCursorTest, self).setUp()
+        self.col = FakeCollection()
+        self.col.aggregate = mock.Mock()
+        patch = mock.patch('arachnado.storages.mongo.motor_from_uri',
+                           return_value=(None, 'db', None, 'col', self.col))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.storage = mongotail.MongoTailStorage('mongodb://localhost/db/col')
+
+    def test_plain_projection_uses_find(self):
+        cursor = self.storage.find_cursor({'a': 1}, {'url': True})
+        self.assertIsInstance(cursor, FakeCursor)
+        self.assertFalse(self.col.aggregate.called)
+
+    def test_computed_fields_are_projected(self):
+        body = {'$substrCP': ['$body', 0, 10]}
+        self.storage.find_cursor({'a': 1}, {'url': True, 'body': body},
+                                 sort_by_id=True)
+        self.col.aggregate.assert_called_once_with([
+            {'$match': {'a': 1}},
+            {'$sort': {'_id': 1}},
+            {'$project': {'url': True, 'body': body}},
+        ], cursor={})
+
+    def test_computed_fields_are_added(self):
+        body = {'$substrCP': ['$body', 0, 10]}
+        self.storage.find_cursor({}, {'headers': 0, 'body': body})
+        self.col.aggregate.assert_called_once_with([
+            {'$match': {}},
+            {'$project': {'headers': 0}},
+            {'$addFields': {'body': body}},
+        ], cursor={})
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from scrapy import Request
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+from scrapy.exceptions import NotConfigured
+
+from arachnado.spidermiddlewares.pageitems import PageItemsMiddleware
+
+
+class FakeCrawler(object):
+    def __init__(self, settings=None):
+        self.settings = Settings(settings)
+
+
+def page_item(response, **settings):
+    middleware = PageItemsMiddleware(FakeCrawler(settings))
+    return middleware.get_page_item(response, [])
+
+
+class PageItemsBodyTest(unittest.TestCase):
+    body = u'<html><body>привет</body></html>'.encode('cp1251')
+
+    def setUp(self):
+        self.response = HtmlResponse('http://example.com', body=self.body,
+                                     encoding='cp1251')
+
+    def test_decoded_body(self):
+        item = page_item(self.response)
+        self.assertEqual(item['body'], u'<html><body>привет</body></html>')
+        self.assertNotIn('body_encoding', item)
+
+    def test_raw_body(self):
+        item = page_item(self.response, PAGEITEMS_RAW_BODY=True)
+        self.assertEqual(item['body'], self.body)
+        self.assertIsInstance(item['body'], bytes)
+        self.assertEqual(item['body_encoding'], 'cp1251')
+
+
+class ProcessSpiderOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.middleware = PageItemsMiddleware(FakeCrawler())
+        self.response = HtmlResponse('http://example.com', body=b'<html/>')
+        self.produced = []
+
+    def callback_output(self):
+        for i in range(3):
+            self.produced.append(i)
+            yield {'i': i}
+            yield Request('http://example.com/%d' % i)
+
+    def test_requests_are_streamed(self):
+        output = self.middleware.process_spider_output(
+            self.response, self.callback_output(), spider=None)
+        request = next(output)
+        # the request is passed before the callback produced other results
+        self.assertEqual(request.url, 'http://example.com/0')
+        self.assertEqual(self.produced, [0])
+        self.assertEqual([r.url for r in [next(output), next(output)]],
+                         ['http://example.com/1', 'http://example.com/2'])
+        page = next(output)
+        self.assertEqual(page['items'], [{'i': 0}, {'i': 1}, {'i': 2}])
+        self.assertEqual(page['url'], 'http://example.com')
+        self.assertEqual(page['_type'], 'page')
+        self.assertEqual(list(output), [])
+
+    def test_page_without_items(self):
+        output = list(self.middleware.process_spider_output(
+            self.response, iter([]), spider=None))
+        self.assertEqual(len(output), 1)
+        self.assertEqual(output[0]['items'], [])
+
+    def test_disabled(self):
+        with self.assertRaises(NotConfigured):
+            PageItemsMiddleware(FakeCrawler({'PAGEITEMS_ENABLED': False}))
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from collections import deque
+
+from six.moves import cPickle as pickle
+from queuelib.queue import FifoDiskQueue
+
+from arachnado.squeues import SegmentFifoDiskQueue, CompactFifoDiskQueue
+
+
+class SmallQueue(SegmentFifoDiskQueue):
+    segment_size = 200
+    batch_size = 7
+    batch_bytes = 100
+
+
+def crash(queue):
+    """ Release file handles without saving anything """
+    queue._unmap()
+    queue._write_file.close()
+
+
+class SegmentFifoDiskQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'queue')
+
+    def record(self, i):
+        return ('record-%d-' % i).encode('ascii') * (i % 4)
+
+    def test_random_push_pop_reopen(self):
+        rnd = random.Random(0)
+        queue = SmallQueue(self.path)
+        expected = deque()
+        for i in range(3000):
+            action = rnd.random()
+            if action < 0.55:
+                queue.push(self.record(i))
+                expected.append(self.record(i))
+            elif action < 0.98:
+                self.assertEqual(queue.pop(),
+                                 expected.popleft() if expected else None)
+            else:
+                queue.close()
+                queue = SmallQueue(self.path)
+            self.assertEqual(len(queue), len(expected))
+        while expected:
+            self.assertEqual(queue.pop(), expected.popleft())
+        self.assertIsNone(queue.pop())
+        queue.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_reopen_after_crash(self):
+        rnd = random.Random(1)
+        for attempt in range(20):
+            queue = SmallQueue(self.path)
+            expected = deque()
+            for i in range(rnd.randint(0, 300)):
+                if rnd.random() < 0.6:
+                    queue.push(self.record(i))
+                    expected.append(self.record(i))
+                elif expected:
+                    self.assertEqual(queue.pop(), expected.popleft())
+            queue.flush()
+            # a batch which is written partially when the process crashes
+            queue._write_file.write(b'\x00\x00\x01')
+            crash(queue)
+
+            queue = SmallQueue(self.path)
+            self.assertEqual(len(queue), len(expected))
+            while expected:
+                self.assertEqual(queue.pop(), expected.popleft())
+            self.assertIsNone(queue.pop())
+            queue.close()
+            self.assertFalse(os.path.exists(self.path))
+
+    def test_unsaved_changes_are_lost_after_crash(self):
+        queue = SmallQueue(self.path)
+        for i in range(10):
+            queue.push(self.record(i))  # 7 records are written
+        queue.pop()
+        crash(queue)
+        queue = SmallQueue(self.path)
+        self.assertEqual(len(queue), 7)
+        self.assertEqual([queue.pop() for _ in range(7)],
+                         [self.record(i) for i in range(7)])
+        queue.close()
+
+
+class CompactFifoDiskQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'queue')
+
+    def test_legacy_queue_is_imported(self):
+        requests = [{'url': 'http://example.com/%d' % i, 'meta': {'i': i}}
+                    for i in range(10)]
+        legacy = FifoDiskQueue(self.path)
+        for request in requests:
+            legacy.push(pickle.dumps(request, protocol=2))
+        legacy.close()
+
+        queue = CompactFifoDiskQueue(self.path)
+        self.assertEqual(len(queue), len(requests))
+        # imported requests are saved even if nothing else is pushed
+        # and the queue is not closed properly
+        crash(queue)
+        queue = CompactFifoDiskQueue(self.path)
+        self.assertFalse(os.path.exists(os.path.join(self.path,
+                                                     'info.json')))
+        for request in requests:
+            popped = queue.pop()
+            self.assertEqual(popped['url'], request['url'])
+            self.assertEqual(popped['meta'], request['meta'])
+        self.assertIsNone(queue.pop())
+        queue.close()
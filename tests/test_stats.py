@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import gc
+import unittest
+
+import tornado.testing
+from tornado import gen
+from scrapy.settings import Settings
+
+from arachnado.stats import EventedStatsCollector, StatsTicker, stats_changed
+
+
+class FakeCrawler(object):
+    settings = Settings()
+
+
+class EventedStatsCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = EventedStatsCollector(FakeCrawler())
+
+    def test_changes(self):
+        self.stats.set_value('a', 1)
+        self.stats.inc_value('b')
+        self.assertEqual(self.stats._get_changes(), {'a': 1, 'b': 1})
+        self.stats.set_value('a', 1)
+        self.stats.inc_value('b')
+        self.assertEqual(self.stats._get_changes(), {'b': 2})
+        self.assertEqual(self.stats._get_changes(), {})
+
+    def test_value_restored_after_clear(self):
+        self.stats.set_value('a', 1)
+        self.stats._get_changes()
+        self.stats.clear_stats()
+        self.assertEqual(self.stats._get_changes(), {})
+        self.stats.set_value('a', 1)
+        self.assertEqual(self.stats._get_changes(), {'a': 1})
+
+    def test_value_restored_after_set_stats(self):
+        self.stats.set_value('a', 1)
+        self.stats._get_changes()
+        self.stats.set_stats({'b': 2})
+        self.assertEqual(self.stats._get_changes(), {'b': 2})
+        self.stats.set_value('a', 1)
+        self.assertEqual(self.stats._get_changes(), {'a': 1})
+
+
+class StatsTickerTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(StatsTickerTest, self).setUp()
+        self.ticker = StatsTicker(min_interval=0.01, max_interval=0.05)
+        self.addCleanup(self.ticker.set_subscribers, 0)
+        self.changes = []
+
+    def add_collector(self):
+        stats = EventedStatsCollector(FakeCrawler())
+        stats.signals.connect(self.on_changes, stats_changed)
+        self.ticker.add(stats)
+        return stats
+
+    def on_changes(self, sender, changes, **kwargs):
+        self.changes.append((sender, changes))
+
+    def test_interval(self):
+        self.assertFalse(self.ticker._task.is_running())
+        self.ticker.set_subscribers(1)
+        self.assertTrue(self.ticker._task.is_running())
+        self.assertEqual(self.ticker._task.callback_time, 10)
+        self.ticker.set_subscribers(9)
+        self.assertEqual(self.ticker._task.callback_time, 30)
+        self.ticker.set_subscribers(100)
+        self.assertEqual(self.ticker._task.callback_time, 50)
+        self.ticker.set_subscribers(0)
+        self.assertFalse(self.ticker._task.is_running())
+
+    def test_tick(self):
+        first, second = self.add_collector(), self.add_collector()
+        first.set_value('a', 1)
+        second.inc_value('b')
+        self.ticker.tick()
+        self.assertEqual(sorted(self.changes, key=lambda c: list(c[1])),
+                         [(first, {'a': 1}), (second, {'b': 1})])
+        self.ticker.tick()
+        self.assertEqual(len(self.changes), 2)
+
+    @tornado.testing.gen_test
+    def test_changes_are_accumulated_without_subscribers(self):
+        stats = self.add_collector()
+        stats.set_value('a', 1)
+        stats.set_value('a', 2)
+        yield gen.sleep(0.05)
+        self.assertEqual(self.changes, [])
+        self.ticker.set_subscribers(1)
+        yield gen.sleep(0.05)
+        self.assertEqual(self.changes, [(stats, {'a': 2})])
+
+    def test_collectors_are_not_kept_alive(self):
+        self.add_collector()
+        gc.collect()
+        self.assertEqual(len(self.ticker._collectors), 0)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import tornado.testing
+from tornado import gen
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from arachnado.storages import stats_history
+from arachnado.storages.stats_history import StatsHistoryStorage
+
+
+class FakeCursor(object):
+    def __init__(self, docs):
+        self.docs = docs
+
+    @property
+    def fetch_next(self):
+        return gen.maybe_future(bool(self.docs))
+
+    def next_object(self):
+        return self.docs.pop(0)
+
+
+class FakeCollection(object):
+    """ Stores buckets updated by StatsHistoryStorage._push """
+    def __init__(self):
+        self.buckets = {}
+        self.find_queries = []
+
+    def update(self, spec, document, upsert=False):
+        bucket = self.buckets.get(spec['_id'])
+        if bucket is None:
+            bucket = dict(document['$setOnInsert'], _id=spec['_id'],
+                          points=[])
+            self.buckets[spec['_id']] = bucket
+        bucket['points'].append(document['$push']['points'])
+        return gen.maybe_future(None)
+
+    def find(self, query, sort=None):
+        self.find_queries.append(query)
+        start = query['start']
+        docs = sorted(
+            (bucket for bucket in self.buckets.values()
+             if bucket['job_id'] == query['job_id'] and
+             bucket['res'] == query['res'] and
+             start['$gt'] < bucket['start'] <= start['$lte']),
+            key=lambda bucket: bucket['start'])
+        return FakeCursor(docs)
+
+
+class StatsHistoryStorageTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(StatsHistoryStorageTest, self).setUp()
+        self.col = FakeCollection()
+        patches = [
+            mock.patch.object(stats_history, 'motor_from_uri', return_value=(
+                None, 'db', None, 'history', self.col)),
+            mock.patch.object(stats_history, 'release_client'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.storage = StatsHistoryStorage('mongodb://localhost/db/history')
+        self.storage.levels = ((10, 3600), (100, None))
+        self.storage.bucket_points = 5
+        self.addCleanup(self.storage.close)
+
+    def points(self, resolution):
+        return [point[0]
+                for _, bucket in sorted(self.col.buckets.items())
+                if bucket['res'] == resolution
+                for point in bucket['points']]
+
+    @tornado.testing.gen_test
+    def test_samples_are_written_once_per_slot(self):
+        for timestamp in [1000, 1001, 1009, 1010, 1025, 1099, 1100]:
+            yield self.storage.append('job', timestamp, [1, 2, 3, 4, 5])
+        self.assertEqual(self.points(10), [1000, 1010, 1025, 1099, 1100])
+        self.assertEqual(self.points(100), [1000, 1100])
+        yield self.storage.append('job', 1101, [1, 2, 3, 4, 5], force=True)
+        self.assertEqual(self.points(10)[-1], 1101)
+        self.assertEqual(self.points(100)[-1], 1101)
+
+    @tornado.testing.gen_test
+    def test_buckets(self):
+        for timestamp in range(1000, 1200, 10):
+            yield self.storage.append('job', timestamp, [0] * 5)
+        # 5 points of 10s resolution per bucket
+        buckets = list(self.col.buckets.values())
+        self.assertEqual(sorted(bucket['start'] for bucket in buckets
+                                if bucket['res'] == 10),
+                         [1000, 1050, 1100, 1150])
+        # only fine-grained buckets expire
+        self.assertTrue(all(bucket['expire_at'] for bucket in buckets
+                            if bucket['res'] == 10))
+        self.assertFalse(any('expire_at' in bucket for bucket in buckets
+                             if bucket['res'] == 100))
+
+    @tornado.testing.gen_test
+    def test_fetch_bucket_boundaries(self):
+        for timestamp in range(1000, 1200, 10):
+            yield self.storage.append('job', timestamp, [timestamp] * 5)
+        yield self.storage.append('other', 1100, [0] * 5)
+        # start is in the middle of a bucket which started before it
+        result = yield self.storage.fetch('job', 1030, 1110, resolution=10)
+        self.assertEqual(result['resolution'], 10)
+        self.assertEqual([point[0] for point in result['points']],
+                         list(range(1030, 1111, 10)))
+        self.assertEqual(result['points'][0], [1030] * 6)
+        self.assertEqual(result['fields'],
+                         ['pages', 'items', 'bytes', 'errors', 'queue'])
+        # the last point of a bucket and the first point of the next one
+        result = yield self.storage.fetch('job', 1040, 1050, resolution=10)
+        self.assertEqual([point[0] for point in result['points']],
+                         [1040, 1050])
+
+    @tornado.testing.gen_test
+    def test_invalid_resolution(self):
+        with self.assertRaises(ValueError):
+            yield self.storage.fetch('job', 1000, 1100, resolution=60)
+        self.assertEqual(self.col.find_queries, [])
+
+    def test_choose_resolution(self):
+        self.storage.max_points = 10
+        with mock.patch.object(stats_history.time, 'time',
+                               return_value=10000):
+            choose = self.storage._choose_resolution
+            self.assertEqual(choose(9000, 9100), 10)
+            # too many points
+            self.assertEqual(choose(9000, 9200), 100)
+            # fine-grained data is expired
+            self.assertEqual(choose(6000, 6050), 100)
+            # too many points for any resolution
+            self.assertEqual(choose(0, 10000), 100)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import json
+
+import tornado.testing
+import tornado.web
+import tornado.websocket
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from arachnado.utils import misc
+from arachnado.wsbase import BaseWSHandler
+
+
+class EchoHandler(BaseWSHandler):
+    def initialize(self, opts):
+        self.init_transport(opts)
+
+    def on_event(self, event, data):
+        if event == 'stats':
+            self.write_event('stats', self.get_transport_stats())
+        elif event == 'ordered':
+            # a large message encoded in a thread, a message which
+            # is not sent, then small messages
+            self.write_ordered(misc.json_encode_async(data))
+            skipped = Future()
+            self.write_ordered(skipped)
+            self.write_ordered('small')
+            IOLoop.current().call_later(0.01, skipped.set_result, None)
+            self.write_ordered('last')
+        else:
+            self.write_event(event, data)
+
+
+class TransportStatsTest(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        opts = {'arachnado.websocket': {'compression': '1'}}
+        return tornado.web.Application([
+            (r'/ws', EchoHandler, {'opts': opts}),
+        ])
+
+    @tornado.testing.gen_test
+    def test_traffic_is_counted(self):
+        url = 'ws://localhost:%d/ws' % self.get_http_port()
+        client = yield tornado.websocket.websocket_connect(url)
+        echo = json.dumps({'event': 'echo', 'data': u'привет'})
+        client.write_message(echo)
+        response = yield client.read_message()
+        client.write_message(json.dumps({'event': 'stats', 'data': None}))
+        stats = json.loads((yield client.read_message()))['data']
+        self.assertEqual(stats['messages_in'], 2)
+        self.assertEqual(stats['messages_out'], 1)
+        self.assertEqual(stats['message_bytes_out'],
+                         len(response.encode('utf8')))
+        self.assertGreater(stats['message_bytes_in'], len(echo))
+        self.assertFalse(stats['compression'])  # the client didn't ask
+        self.assertEqual(stats['wire_bytes_out'], stats['message_bytes_out'])
+        self.assertEqual(stats['wire_bytes_in'], stats['message_bytes_in'])
+        client.close()
+
+    @tornado.testing.gen_test
+    def test_compressed_traffic_is_counted(self):
+        url = 'ws://localhost:%d/ws' % self.get_http_port()
+        client = yield tornado.websocket.websocket_connect(
+            url, compression_options={})
+        echo = json.dumps({'event': 'echo', 'data': 'spam' * 1000})
+        client.write_message(echo)
+        response = yield client.read_message()
+        client.write_message(json.dumps({'event': 'stats', 'data': None}))
+        stats = json.loads((yield client.read_message()))['data']
+        self.assertTrue(stats['compression'])
+        self.assertEqual(stats['message_bytes_out'], len(response))
+        self.assertGreater(stats['wire_bytes_out'], 0)
+        self.assertLess(stats['wire_bytes_out'],
+                        stats['message_bytes_out'] / 10)
+        self.assertLess(stats['wire_bytes_in'],
+                        stats['message_bytes_in'] / 10)
+        client.close()
+
+    @tornado.testing.gen_test
+    def test_messages_are_ordered(self):
+        url = 'ws://localhost:%d/ws' % self.get_http_port()
+        client = yield tornado.websocket.websocket_connect(url)
+        data = {'key%d' % i: 'x' * 100 for i in range(1000)}
+        with mock.patch.object(misc, 'JSON_THREAD_THRESHOLD', 100):
+            client.write_message(json.dumps({'event': 'ordered',
+                                             'data': data}))
+            messages = []
+            for _ in range(3):
+                messages.append((yield client.read_message()))
+        self.assertEqual(json.loads(messages[0]), data)
+        self.assertEqual(messages[1:], ['small', 'last'])
+        client.close()